@@ -1,99 +1,613 @@
+import asyncio
+import csv
+import hashlib
+import hmac
+import itertools
+import json
 import logging
+import math
+import multiprocessing
 import os
-from datetime import datetime
-import pytz
-from jdatetime import datetime as jdatetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import shutil
+import signal
+import sqlite3
+import sys
+import tempfile
+import time
+import zipfile
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from copy import deepcopy
+from datetime import datetime, timezone
+from enum import Enum
+from functools import lru_cache, wraps
+from operator import itemgetter
+from io import BytesIO, StringIO
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.ext import (
     ApplicationBuilder,
+    ApplicationHandlerStop,
+    BasePersistence,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
+    PersistenceInput,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters
 )
-from flask import Flask
-from fpdf import FPDF
-import arabic_reshaper
-from bidi.algorithm import get_display
-from PIL import Image, ImageEnhance
+from telegram.error import BadRequest, RetryAfter
+# fpdf (به همراه fontTools و Pillow)، arabic_reshaper و bidi سنگین‌اند و فقط برای ساخت PDF لازم‌اند؛
+# pytz و jdatetime هم فقط برای ساعت تهران. در اولین استفاده import می‌شوند تا شروع ربات و اولین پاسخ منتظرشان نماند.
 import threading
+import tornado.web
 
 # --- تنظیمات لاگ ---
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
+# fpdf فونت هر PDF را با fontTools subset می‌کند و fontTools هر مرحله را در سطح INFO لاگ می‌کند (~۲۵ خط برای هر پیش‌فاکتور)
+logging.getLogger('fontTools').setLevel(logging.WARNING)
+
+# --- متریک‌ها (فرمت متنی Prometheus روی /metrics) ---
+# بدون وابستگی اضافه: شمارنده‌ها و هیستوگرام‌ها در حافظه‌ی همین پروسه نگه داشته می‌شوند.
+# برچسب‌ها فقط مقادیر محدود دارند (نام handler، endpoint تلگرام، نوع پست کانال)، پس تعداد سری‌ها ثابت می‌ماند.
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS_HELP = {
+    'volta_updates_total': ('counter', 'آپدیت‌های دریافت شده'),
+    'volta_update_queue_seconds': ('histogram', 'انتظار آپدیت در صف از دریافت webhook تا شروع پردازش'),
+    'volta_update_queue_depth': ('gauge', 'آپدیت‌های در انتظار پردازش'),
+    'volta_updates_running': ('gauge', 'آپدیت‌هایی که handler شان همین حالا اجرا می‌شود'),
+    'volta_updates_waiting': ('gauge', 'آپدیت‌های منتظر آپدیت قبلی همان کاربر یا سقف هم‌زمانی'),
+    'volta_handler_seconds': ('histogram', 'مدت اجرای هر handler'),
+    'volta_callback_seconds': ('histogram', 'مدت اجرای هر مسیر callback'),
+    'volta_telegram_request_seconds': ('histogram', 'زمان پاسخ Bot API برای هر endpoint (بدون انتظار rate limiter)'),
+    'volta_send_wait_seconds': ('histogram', 'انتظار درخواست‌ها در rate limiter'),
+    'volta_send_queue_depth': ('gauge', 'درخواست‌های منتظر در rate limiter'),
+    'volta_telegram_sent_total': ('counter', 'درخواست‌های ارسال شده از rate limiter'),
+    'volta_telegram_retry_after_total': ('counter', 'پاسخ‌های 429 تلگرام'),
+    'volta_telegram_gave_up_total': ('counter', 'درخواست‌هایی که بعد از چند 429 رها شدند'),
+    'volta_invoice_renders_total': ('counter', 'پیش‌فاکتورهای ساخته شده'),
+    'volta_invoice_render_seconds': ('histogram', 'مدت ساخت PDF پیش‌فاکتور (شامل انتظار برای worker)'),
+    'volta_invoice_pdf_bytes_total': ('counter', 'حجم PDF های ساخته شده'),
+    'volta_invoices_inflight': ('gauge', 'پیش‌فاکتورهای در حال ساخت یا در صف'),
+    'volta_work_rejected_total': ('counter', 'کارهایی که به خاطر پر بودن صف worker ها ساخته نشدند (queue=invoice|batch)'),
+    'volta_channel_notifications_total': ('counter', 'اعلان‌های ثبت شده برای کانال'),
+    'volta_channel_posts_total': ('counter', 'پیام‌های ارسال شده به کانال'),
+    'volta_channel_buffered': ('gauge', 'اعلان‌های منتظر پیام خلاصه'),
+    'volta_receipts_total': ('counter', 'رسیدهای پرداخت دریافت شده (result=new|duplicate|reused|unhashed)'),
+    'volta_receipt_hash_seconds': ('histogram', 'دانلود و hash ادراکی هر رسید'),
+    'volta_errors_total': ('counter', 'لاگ‌های سطح ERROR'),
+    'volta_event_loop_lag_seconds': ('histogram', 'تأخیر event loop نسبت به زمان‌بندی'),
+}
+# EVENT_LOOP_LAG_INTERVAL: فاصله‌ی (ثانیه) اندازه‌گیری تأخیر event loop
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.5"))
+
+class Metrics:
+    """
+    شمارنده‌ها، gauge ها و هیستوگرام‌ها؛ collectors (به نام هر collector) هنگام هر scrape مقادیر لحظه‌ای
+    (مثل طول صف‌ها) را می‌گذارند.
+    """
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.values = {}
+        self.histograms = {}
+        self.collectors = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(labels.items()))
+        self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.values[(name, tuple(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(labels.items()))
+        series = self.histograms.get(key)
+        if series is None:
+            # شمارش هر bucket جداگانه (آخری +Inf)، مجموع، تعداد
+            series = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @staticmethod
+    def label_text(labels, extra=()):
+        pairs = [*labels, *extra]
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+    def render(self):
+        for collect in list(self.collectors.values()):
+            try:
+                collect()
+            except Exception as e:
+                logging.warning(f"⚠️ خطای جمع‌آوری متریک: {e}")
+        lines = []
+        for name, (kind, help_text) in METRICS_HELP.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'histogram':
+                for (series_name, labels), (counts, total, count) in list(self.histograms.items()):
+                    if series_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket_count in zip([*self.buckets, '+Inf'], counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{self.label_text(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_sum{self.label_text(labels)} {total}")
+                    lines.append(f"{name}_count{self.label_text(labels)} {count}")
+            else:
+                for (series_name, labels), value in list(self.values.items()):
+                    if series_name == name:
+                        lines.append(f"{name}{self.label_text(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+class ErrorCounter(logging.Handler):
+    """همه‌ی logging.error های ربات (و خطاهای handler که PTB لاگ می‌کند) در volta_errors_total شمرده می‌شوند."""
+
+    def emit(self, record):
+        metrics.inc('volta_errors_total')
+
+logging.getLogger().addHandler(ErrorCounter(logging.ERROR))
+
+def timed(handler):
+    """مدت اجرای handler را در volta_handler_seconds ثبت می‌کند."""
+
+    @wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        finally:
+            metrics.observe('volta_handler_seconds', time.perf_counter() - started, handler=handler.__name__)
+
+    return wrapper
+
+async def watch_event_loop_lag(interval=EVENT_LOOP_LAG_INTERVAL):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        metrics.observe('volta_event_loop_lag_seconds', max(time.perf_counter() - started - interval, 0.0))
 
 # --- توکن از محیط بگیر ---
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("❌ متغیر محیطی BOT_TOKEN تنظیم نشده است!")
 
-# --- جدول قیمت‌ها ---
-PRICES = {
-    'sensor_type': {
-        'NTC10K': 350_000,
-        'PT100': 450_000,
-        'DS18B20': 400_000
-    },
-    'dimensions': {
-        '6×50': 150_000,
-        '4×25': 100_000,
-        '8×75': 200_000
-    },
-    'wire_length_per_cm': 2000,
-    'base_price': 50_000
-}
+# --- شناسه‌ی این پروسه وقتی چند worker با هم اجرا می‌شوند (به بخش state مشترک نگاه کنید) ---
+WORKER_ID = os.getenv("WORKER_ID", "")
+
+# --- کانال دریافت سفارش‌ها و رسیدها ---
+CHANNEL_ID = int(os.getenv("CHANNEL_ID", "-1002591533364"))
+
+# --- کاتالوگ محصولات و قیمت‌ها ---
+# همه‌ی قیمت‌ها، گزینه‌ها و پله‌های ضریب طول در CATALOG_PATH تعریف شده‌اند. فایل هنگام بارگذاری
+# به جدول‌های جستجو و منوها تبدیل می‌شود و اگر تغییر کند بدون ری‌استارت دوباره خوانده می‌شود.
+# CATALOG_CHECK_INTERVAL: حداقل فاصله‌ی (ثانیه) بین دو بررسی تغییر فایل
+CATALOG_PATH = os.getenv("CATALOG_PATH", "catalog.json")
+CATALOG_CHECK_INTERVAL = float(os.getenv("CATALOG_CHECK_INTERVAL", "5"))
 
-def calculate_price(context):
+def option_menu(options, prefix, back):
+    rows = [
+        [InlineKeyboardButton(option.get('button', option['label']), callback_data=f"{prefix}{option['id']}")]
+        for option in options if option.get('menu', True)
+    ]
+    rows.append([InlineKeyboardButton("🔙 بازگشت", callback_data=back)])
+    return InlineKeyboardMarkup(rows)
+
+def option_aliases(options, target):
+    return {key.lower(): option[target] for option in options for key in (option['id'], option['label'])}
+
+def resolve_alias(aliases, value):
+    # بیشتر سطرها شناسه را دقیقاً همان‌طور که هست دارند؛ strip/lower فقط وقتی لازم است
+    return aliases.get(value) or aliases.get(value.strip().lower())
+
+class Catalog:
+    """نسخه‌ی کامپایل شده‌ی catalog.json؛ هر قیمت با چند جستجوی dict محاسبه می‌شود."""
+
+    def __init__(self, data):
+        order = data['order']
+        calc = data['calculator']
+        for option in order['sensors'] + order['dimensions'] + calc['sensors'] + calc['sheaths']:
+            # route_callback شناسه را بعد از آخرین '_' جدا می‌کند
+            if '_' in option['id']:
+                raise ValueError(f"شناسه‌ی {option['id']} نباید '_' داشته باشد")
+        tiers = calc['length_factors']
+        if tiers[-1]['max_length'] is not None or any(t['max_length'] is None for t in tiers[:-1]):
+            raise ValueError("فقط آخرین پله‌ی ضریب طول باید بدون max_length باشد")
+
+        # --- سفارش آنلاین ---
+        self.base_price = order['base_price']
+        self.wire_price_per_cm = order['wire_length_per_cm']
+        self.sensor_prices = {option['label']: option['price'] for option in order['sensors']}
+        self.dimension_prices = {option['label']: option['price'] for option in order['dimensions']}
+        self.sensor_choices = {f"sensor_{option['id']}": option['label'] for option in order['sensors']}
+        self.dimension_choices = {f"dim_{option['id']}": option['label'] for option in order['dimensions']}
+        self.min_wire_length = order['wire_length']['min']
+        self.max_wire_length = order['wire_length']['max']
+        self.sensor_type_menu = option_menu(order['sensors'], 'sensor_', 'order')
+        self.dimensions_menu = option_menu(order['dimensions'], 'dim_', 'order')
+
+        # --- ماشین حساب ---
+        self.calc_sensor_prices = {option['id']: option['price'] for option in calc['sensors']}
+        self.calc_sheath_prices = {option['id']: option['price'] for option in calc['sheaths']}
+        self.calc_sensor_labels = {option['id']: option['label'] for option in calc['sensors']}
+        self.calc_sheath_labels = {option['id']: option['label'] for option in calc['sheaths']}
+        self.price_list_lengths = calc['price_list_lengths']
+        self.cable_price_per_meter = calc['cable_per_meter']
+        self.assembly = calc['assembly']
+        self.extra = calc['extra']
+        self.profit = calc['profit']
+        self.length_bounds = sorted(tier['max_length'] for tier in tiers[:-1])
+        self.length_factors = [tier['factor'] for tier in sorted(tiers[:-1], key=lambda t: t['max_length'])]
+        self.length_factors.append(tiers[-1]['factor'])
+        self.calculator_menu = option_menu(calc['sensors'], 'calc_sensor_', 'products')
+
+        # --- نام‌هایی که در فایل‌های استعلام گروهی پذیرفته می‌شوند (شناسه یا عنوان، بدون حساسیت به حروف) ---
+        self.sensor_aliases = option_aliases(order['sensors'], 'label')
+        self.dimension_aliases = option_aliases(order['dimensions'], 'label')
+        self.calc_sensor_aliases = option_aliases(calc['sensors'], 'id')
+        self.calc_sheath_aliases = option_aliases(calc['sheaths'], 'id')
+        self.calc_sheath_menu = option_menu(calc['sheaths'], 'calc_sheath_', 'calculator')
+
+    def order_price(self, user_data):
+        total = self.base_price
+        total += self.sensor_prices.get(user_data['sensor_type'], 0)
+        total += self.dimension_prices.get(user_data['dimensions'], 0)
+        total += self.wire_price_per_cm * int(user_data['wire_length'])
+        return total * int(user_data['quantity'])
+
+    def calc_price(self, sensor_id, sheath_id, length):
+        base_price = (
+            self.calc_sensor_prices.get(sensor_id, 0) + self.calc_sheath_prices.get(sheath_id, 0)
+            + length * self.cable_price_per_meter + self.assembly + self.extra + self.profit
+        )
+        # فاکتور سختی کار: اولین پله‌ای که طول از max_length آن بیشتر نباشد
+        return int(base_price * self.length_factors[bisect_left(self.length_bounds, length)])
+
+def read_catalog(path):
+    with open(path, encoding='utf-8') as f:
+        return Catalog(json.load(f))
+
+catalog = read_catalog(CATALOG_PATH)
+catalog_mtime = os.stat(CATALOG_PATH).st_mtime_ns
+catalog_checked = time.monotonic()
+
+def get_catalog():
+    global catalog, catalog_mtime, catalog_checked
+    now = time.monotonic()
+    if now - catalog_checked < CATALOG_CHECK_INTERVAL:
+        return catalog
+    catalog_checked = now
+    try:
+        mtime = os.stat(CATALOG_PATH).st_mtime_ns
+        if mtime != catalog_mtime:
+            catalog = read_catalog(CATALOG_PATH)
+            catalog_mtime = mtime
+            logging.info("🔄 کاتالوگ قیمت‌ها دوباره بارگذاری شد.")
+    except Exception as e:
+        # تا اصلاح فایل، نسخه‌ی قبلی کاتالوگ استفاده می‌شود
+        logging.error(f"❌ خطای بارگذاری دوباره‌ی کاتالوگ: {e}")
+    return catalog
+
+def calculate_price(user_data):
     try:
-        if not all(key in context.user_data for key in ['sensor_type', 'dimensions', 'wire_length', 'quantity']):
+        if not all(key in user_data for key in ['sensor_type', 'dimensions', 'wire_length', 'quantity']):
             return None
-        total = PRICES['base_price']
-        total += PRICES['sensor_type'].get(context.user_data['sensor_type'], 0)
-        total += PRICES['dimensions'].get(context.user_data['dimensions'], 0)
-        total += PRICES['wire_length_per_cm'] * int(context.user_data['wire_length'])
-        total *= int(context.user_data['quantity'])
-        return total
+        return get_catalog().order_price(user_data)
     except Exception as e:
         logging.error(f"❌ خطای محاسبه قیمت: {e}")
         return None
 
-# --- تابع کمکی: دریافت زمان به وقت تهران و شمسی ---
-def get_tehran_time():
-    tehran_tz = pytz.timezone('Asia/Tehran')
-    now = datetime.now(tehran_tz)
+# --- ساعت تهران: منطقه‌ی زمانی یک بار resolve می‌شود و بخش‌های تاریخ برای هر دقیقه یک بار ساخته می‌شوند ---
+@lru_cache(maxsize=1)
+def tehran_tz():
+    import pytz
+    return pytz.timezone('Asia/Tehran')
+
+# text: "1405/07/26 - 14:05" | jalali_date: "1405/07/26" | date_compact: "14050726" (شماره فاکتور)
+# month_compact: "140507" | gregorian_date: "2026-10-18"
+TehranTime = namedtuple('TehranTime', 'text jalali_date time date_compact month_compact gregorian_date')
+tehran_time_cache = (None, None)
+
+def tehran_now():
+    global tehran_time_cache
+    # اختلاف تهران با UTC مضرب کامل دقیقه است، پس دقیقه‌ی epoch همان دقیقه‌ی تهران است
+    minute = int(time.time() // 60)
+    cached_minute, cached = tehran_time_cache
+    if minute == cached_minute:
+        return cached
+    from jdatetime import datetime as jdatetime
+    now = datetime.fromtimestamp(minute * 60, tehran_tz())
     j_now = jdatetime.fromgregorian(datetime=now)
-    return f"{j_now.strftime('%Y/%m/%d')} - {now.strftime('%H:%M')}"
+    jalali_date = f"{j_now.year:04d}/{j_now.month:02d}/{j_now.day:02d}"
+    clock = f"{now.hour:02d}:{now.minute:02d}"
+    parts = TehranTime(
+        text=f"{jalali_date} - {clock}",
+        jalali_date=jalali_date,
+        time=clock,
+        date_compact=jalali_date.replace('/', ''),
+        month_compact=jalali_date[:7].replace('/', ''),
+        gregorian_date=f"{now.year:04d}-{now.month:02d}-{now.day:02d}",
+    )
+    tehran_time_cache = (minute, parts)
+    return parts
+
+def get_tehran_time():
+    return tehran_now().text
+
+# --- شکل‌دهی متن فارسی برای PDF (reshape + bidi) با کش LRU ---
+# SHAPING_CACHE_SIZE: حداکثر تعداد رشته‌های شکل‌داده‌شده‌ای که نگه داشته می‌شوند
+# آمار hit/miss از shape_text.cache_info() در دسترس است
+SHAPING_CACHE_SIZE = int(os.getenv("SHAPING_CACHE_SIZE", "1024"))
+
+@lru_cache(maxsize=SHAPING_CACHE_SIZE)
+def shape_text(text):
+    import arabic_reshaper
+    from bidi.algorithm import get_display
+    return get_display(arabic_reshaper.reshape(text))
+
+# --- متن‌های ثابت پیش‌فاکتور (در اولین استفاده شکل داده می‌شوند و بعد از کش shape_text می‌آیند) ---
+INVOICE_TEXT = {
+    'title': "پیش‌فاکتور سفارش",
+    'price_list_title': "لیست قیمت سنسورهای دما",
+    'price_list_note': "قیمت‌ها به تومان و برای یک عدد سنسور با طول کابل مشخص شده است.",
+    'shop_info': "ولتا استور | فروشگاه تخصصی سنسورهای صنعتی",
+    'contact_info': "تلفن: 09359636526 | تهران، سه راه مرزداران",
+    'footer1': "با تشکر از اعتماد شما به ولتا استور",
+    'footer2': "سفارش شما در دسترسی است و به زودی پیگیری می‌شود.",
+}
+INVOICE_TABLE_LABELS = [
+    ('sensor_type', "نوع سنسور"),
+    ('dimensions', "ابعاد غلاف"),
+    ('wire_length', "طول سیم"),
+    ('quantity', "تعداد"),
+    ('final_price', "قیمت کل"),
+]
 
 # --- مسیر فونت و لوگو ---
 FONT_PATH = 'Vazirmatn-Regular.ttf'
 LOGO_PATH = 'volta_store_logo.png'
 
-# --- منوها ---
-main_menu = [
+# --- صف‌های ساخت فایل (خارج از event loop) ---
+# پیش‌فاکتور مشتری‌ها و کارهای سنگین فایلی (/invoices، /pricelist، استعلام CSV) worker های جدا دارند تا
+# یک خروجی ماهانه‌ی ادمین جلوی پیش‌فاکتور مشتری‌ها را نگیرد. هر صف تعداد منتظرها را محدود می‌کند و
+# بیشتر از آن کار را رد می‌کند (asyncio.QueueFull) تا کارهای منتظر بی‌حد در حافظه جمع نشوند.
+# fpdf پایتون خالص است و در تمام مدت ساخت GIL را نگه می‌دارد، پس worker ها به طور پیش‌فرض پروسه‌ی جدا هستند؛
+# روی thread ها event loop باز هم پشت ساخت PDF ها منتظر می‌ماند.
+# WORK_POOL: process یا thread
+# INVOICE_WORKERS: تعداد thread های ساخت پیش‌فاکتور سفارش‌ها
+# INVOICE_QUEUE_SIZE: تعداد پیش‌فاکتورهایی که می‌توانند پشت worker ها منتظر بمانند
+# BATCH_WORKERS: تعداد thread های کارهای فایلی
+# BATCH_QUEUE_SIZE: تعداد کارهای فایلی که می‌توانند منتظر بمانند
+INVOICE_WORKERS = int(os.getenv("INVOICE_WORKERS", "2"))
+INVOICE_QUEUE_SIZE = int(os.getenv("INVOICE_QUEUE_SIZE", "20"))
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "1"))
+BATCH_QUEUE_SIZE = int(os.getenv("BATCH_QUEUE_SIZE", "4"))
+WORK_POOL = os.getenv("WORK_POOL", "process")
+
+class WorkQueue:
+    """حداکثر workers کار هم‌زمان روی thread pool و queue_size کار منتظر؛ بیشتر از آن asyncio.QueueFull."""
+
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self.workers = workers
+        self.executor = None
+        self.slots = asyncio.Semaphore(workers)
+        self.queue_size = queue_size
+        self.waiting = 0
+
+    def pool(self):
+        # با اولین کار (یا warm) ساخته می‌شود: صف‌های ProcessPoolExecutor با spawn همان موقع پروسه‌ی
+        # resource tracker را بالا می‌آورند و import bot (در worker ها هم) نباید منتظرش بماند
+        if self.executor is None:
+            if WORK_POOL == 'process':
+                # worker ها bot را از نو import می‌کنند (بدون کپی state این پروسه)
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+        return self.executor
+
+    def busy(self):
+        return self.slots.locked()
+
+    def full(self):
+        return self.busy() and self.waiting >= self.queue_size
+
+    def warm(self):
+        """همه‌ی worker ها را از همین حالا بالا می‌آورد و قالب پیش‌فاکتور را در هر کدام می‌سازد."""
+        loop = asyncio.get_running_loop()
+        return asyncio.gather(*(
+            loop.run_in_executor(self.pool(), prewarm_invoice_template) for _ in range(self.workers)
+        ))
+
+    async def run(self, func, *args, queued=None):
+        """queued: اگر کار باید منتظر بماند، بعد از گرفتن جایش در صف صدا زده می‌شود (مثلاً برای خبر دادن به کاربر)."""
+        if self.full():
+            metrics.inc('volta_work_rejected_total', queue=self.name)
+            raise asyncio.QueueFull(self.name)
+        self.waiting += 1
+        try:
+            if queued and self.busy():
+                await queued()
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.pool(), func, *args)
+        finally:
+            self.slots.release()
+
+invoice_queue = WorkQueue('invoice', INVOICE_WORKERS, INVOICE_QUEUE_SIZE)
+batch_queue = WorkQueue('batch', BATCH_WORKERS, BATCH_QUEUE_SIZE)
+BUSY_TEXT = "⏳ ربات در حال ساخت فایل‌های دیگر است؛ لطفاً چند دقیقه‌ی دیگر دوباره تلاش کنید."
+
+# INVOICE_ARCHIVE_DIR: پوشه‌ی بایگانی پیش‌فاکتورها (خالی = بدون بایگانی)
+INVOICE_ARCHIVE_DIR = os.getenv("INVOICE_ARCHIVE_DIR", "")
+# INVOICE_PREWARM: قالب پیش‌فاکتور بعد از شروع ربات در پس‌زمینه ساخته شود (0 = در اولین سفارش)
+INVOICE_PREWARM = os.getenv("INVOICE_PREWARM", "1") == "1"
+
+# --- منوها و کیبوردها ---
+# همه‌ی کیبوردها یک بار هنگام شروع ساخته می‌شوند؛ InlineKeyboardMarkup تغییرناپذیر است
+# و می‌تواند بین همه‌ی کاربران و آپدیت‌ها مشترک باشد.
+def back_keyboard(callback_data, text="🔙 بازگشت"):
+    return InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data=callback_data)]])
+
+MAIN_MENU = InlineKeyboardMarkup([
     [InlineKeyboardButton("📦 محصولات", callback_data='products')],
     [InlineKeyboardButton("📞 تماس با ما", callback_data='contact')]
-]
-product_menu = [
+])
+PRODUCT_MENU = InlineKeyboardMarkup([
     [InlineKeyboardButton("🌡️ سنسور دمای NTC10K", callback_data='ntc10k')],
     [InlineKeyboardButton("🛍️ ثبت سفارش آنلاین", callback_data='order')],
     [InlineKeyboardButton("🧮 ماشین حساب تخمین قیمت", callback_data='calculator')],
     [InlineKeyboardButton("⬅️ بازگشت به منو اصلی", callback_data='back_main')]
-]
-ntc10k_menu = [
+])
+NTC10K_MENU = InlineKeyboardMarkup([
     [InlineKeyboardButton("🔧 مشخصات فنی", callback_data='specs')],
     [InlineKeyboardButton("📐 ابعاد و مشخصات فیزیکی", callback_data='dimensions')],
     [InlineKeyboardButton("🏭 کاربردها", callback_data='uses')],
     [InlineKeyboardButton("⚙️ شرایط کاری", callback_data='conditions')],
     [InlineKeyboardButton("📸 گالری تصاویر محصول", callback_data='images')],
     [InlineKeyboardButton("🔙 بازگشت به منوی محصولات", callback_data='back_products')]
-]
+])
+IMAGES_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🖼️ نمای نزدیک", callback_data='image_closeup')],
+    [InlineKeyboardButton("🖼️ نصب شده روی دستگاه", callback_data='image_installed')],
+    [InlineKeyboardButton("🔙 بازگشت به منوی قبل", callback_data='ntc10k')]
+])
+ORDER_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🎯 انتخاب نوع سنسور", callback_data='select_sensor_type')],
+    [InlineKeyboardButton("📐 انتخاب ابعاد غلاف", callback_data='select_dimensions')],
+    [InlineKeyboardButton("📍 طول سیم", callback_data='select_wire_length')],
+    [InlineKeyboardButton("🔢 تعداد", callback_data='select_quantity')],
+    [InlineKeyboardButton("📞 اطلاعات تماس", callback_data='enter_contact_info')],
+    [InlineKeyboardButton("✅ ثبت نهایی سفارش", callback_data='final_order')],
+    [InlineKeyboardButton("🔙 بازگشت به منوی قبل", callback_data='back_products')]
+])
+CALC_RESULT_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 محاسبه مجدد", callback_data='calculator')],
+    [InlineKeyboardButton("🛍️ ثبت سفارش آنلاین", callback_data='order')],
+    [InlineKeyboardButton("🏠 منوی اصلی", callback_data='back_main')]
+])
+PAYMENT_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💳 شماره کارت", callback_data='card_number')],
+    [InlineKeyboardButton("📱 شماره شبا", callback_data='sheba_number')],
+    [InlineKeyboardButton("🏦 شماره حساب", callback_data='account_number')],
+    [InlineKeyboardButton("🔙 بازگشت", callback_data='back_products')]
+])
+SEND_RECEIPT_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📸 ارسال رسید پرداخت", callback_data='send_receipt')],
+    [InlineKeyboardButton("🔙 بازگشت", callback_data='payment_info')]
+])
+FINALIZE_PAYMENT_MENU = back_keyboard('payment_info', "💳 نهایی‌سازی سفارش و پرداخت")
+CONTACT_BACK = back_keyboard('back_main', "🔙 بازگشت به منوی قبل")
+PRODUCT_INFO_BACK = back_keyboard('ntc10k', "🔙 بازگشت به منوی قبل")
+ORDER_BACK = back_keyboard('order')
+CALCULATOR_BACK = back_keyboard('calculator')
+PAYMENT_BACK = back_keyboard('payment_info')
+HOME_BACK = back_keyboard('back_main', "🏠 بازگشت به منوی اصلی")
+
+# --- قالب خلاصه سفارش ---
+ORDER_SUMMARY_TEMPLATE = """📋 مشخصات سفارش شما:
+🎯 نوع سنسور: {}
+📐 ابعاد غلاف: {}
+📏 طول سیم: {}
+🔢 تعداد: {}"""
+ORDER_SUMMARY_FIELDS = [('sensor_type', ''), ('dimensions', ''), ('wire_length', ' سانتی‌متر'), ('quantity', ' عدد')]
+NOT_SELECTED = "❌ انتخاب نشده"
+
+def render_order_summary(session):
+    values = []
+    for key, unit in ORDER_SUMMARY_FIELDS:
+        value = getattr(session, key)
+        values.append(f"✨ {value}{unit}" if value else NOT_SELECTED)
+    return ORDER_SUMMARY_TEMPLATE.format(*values)
+
+# --- سشن کاربر (context.user_data): یک رکورد فشرده با __slots__ به جای dict ---
+class SessionState(Enum):
+    """ورودی‌ای که ربات از کاربر منتظر است؛ همیشه فقط یکی، پس حالت‌ها نمی‌توانند هم را بپوشانند."""
+    IDLE = 'idle'
+    WIRE_LENGTH = 'wire_length'
+    QUANTITY = 'quantity'
+    CUSTOMER_NAME = 'customer_name'
+    CUSTOMER_PHONE = 'customer_phone'
+    CALC_LENGTH = 'calc_length'
+    RECEIPT = 'receipt'
+
+    # اعضای Enum یکتا هستند؛ hash شناسه‌ای جایگزین Enum.__hash__ (پایتونی و کند) در جدول dispatch می‌شود
+    __hash__ = object.__hash__
+
+SESSION_FIELDS = ('sensor_type', 'dimensions', 'wire_length', 'quantity',
+                  'customer_first_name', 'customer_last_name', 'customer_phone',
+                  'calc_sensor', 'calc_sheath', 'open_invoice')
+# فیلدهایی که /start پاک نمی‌کند: رسید سفارش ثبت شده ممکن است بعد از برگشتن به منو فرستاده شود
+KEPT_ON_RESET = ('open_invoice',)
+
+class Session:
+    """
+    داده‌ی هر کاربر (ContextTypes(user_data=Session)). فیلد انتخاب نشده None است.
+    در دیتابیس و backend مشترک به شکل dict ذخیره می‌شود (to_dict / load).
+    """
+    __slots__ = ('state', 'orders_term') + SESSION_FIELDS
+
+    def __init__(self):
+        self.clear()
+
+    def reset(self):
+        """شروع دوباره (/start)؛ فیلدهای KEPT_ON_RESET می‌مانند."""
+        self.state = SessionState.IDLE
+        for field in SESSION_FIELDS:
+            if field not in KEPT_ON_RESET:
+                setattr(self, field, None)
+
+    def clear(self):
+        self.state = SessionState.IDLE
+        self.orders_term = None
+        for field in SESSION_FIELDS:
+            setattr(self, field, None)
+
+    def order(self):
+        """فیلدهای پر شده به شکل dict (برای قیمت‌گذاری، دفتر سفارش‌ها و پیش‌فاکتور)."""
+        return {field: value for field in SESSION_FIELDS if (value := getattr(self, field)) is not None}
+
+    def to_dict(self):
+        data = self.order()
+        if self.state is not SessionState.IDLE:
+            data['state'] = self.state.value
+        if self.orders_term is not None:
+            data['orders_term'] = self.orders_term
+        return data
+
+    def load(self, data, overwrite=True):
+        """داده‌ی ذخیره شده را می‌خواند؛ با overwrite=False فقط فیلدهای خالی پر می‌شوند."""
+        for field in SESSION_FIELDS:
+            value = data.get(field)
+            if value is not None and (overwrite or getattr(self, field) is None):
+                setattr(self, field, value)
+        if data.get('orders_term') is not None and (overwrite or self.orders_term is None):
+            self.orders_term = data['orders_term']
+        if overwrite or self.state is SessionState.IDLE:
+            # to_dict حالت IDLE را نمی‌نویسد
+            try:
+                self.state = SessionState(data.get('state', SessionState.IDLE.value))
+            except ValueError:
+                # حالتی که نسخه‌ی دیگری از بات ذخیره کرده و این نسخه نمی‌شناسد
+                logging.warning(f"⚠️ حالت ناشناخته‌ی سشن {data['state']!r}؛ سشن به حالت عادی برگشت.")
+                self.state = SessionState.IDLE
 
 # --- دستور /start ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data.clear()
+    context.user_data.reset()
     try:
         await update.message.delete()
     except:
@@ -106,522 +620,1415 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 🔸 پشتیبانی ۲۴ ساعته
 لطفاً یکی از گزینه‌های زیر را انتخاب کنید:
 """
-    reply_markup = InlineKeyboardMarkup(main_menu)
-    await update.message.reply_text(welcome_text, reply_markup=reply_markup)
+    await update.message.reply_text(welcome_text, reply_markup=MAIN_MENU)
 
 # --- نمایش خلاصه سفارش ---
 async def show_order_summary(query, context):
-    order_text = """📋 مشخصات سفارش شما:
-🎯 نوع سنسور: {}
-📐 ابعاد غلاف: {}
-📏 طول سیم: {}
-🔢 تعداد: {}""".format(
-        f"✨ {context.user_data.get('sensor_type')}" if context.user_data.get('sensor_type') else "❌ انتخاب نشده",
-        f"✨ {context.user_data.get('dimensions')}" if context.user_data.get('dimensions') else "❌ انتخاب نشده",
-        f"✨ {context.user_data.get('wire_length')} سانتی‌متر" if context.user_data.get('wire_length') else "❌ انتخاب نشده",
-        f"✨ {context.user_data.get('quantity')} عدد" if context.user_data.get('quantity') else "❌ انتخاب نشده"
-    )
-    reply_markup = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🎯 انتخاب نوع سنسور", callback_data='select_sensor_type')],
-        [InlineKeyboardButton("📐 انتخاب ابعاد غلاف", callback_data='select_dimensions')],
-        [InlineKeyboardButton("📍 طول سیم", callback_data='select_wire_length')],
-        [InlineKeyboardButton("🔢 تعداد", callback_data='select_quantity')],
-        [InlineKeyboardButton("📞 اطلاعات تماس", callback_data='enter_contact_info')],
-        [InlineKeyboardButton("✅ ثبت نهایی سفارش", callback_data='final_order')],
-        [InlineKeyboardButton("🔙 بازگشت به منوی قبل", callback_data='back_products')]
-    ])
-    await query.edit_message_text(text=order_text, reply_markup=reply_markup)
+    await query.edit_message_text(text=render_order_summary(context.user_data), reply_markup=ORDER_MENU)
 
-# --- هندل کلیک روی دکمه ---
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    data = query.data
-
-    if data == 'products':
-        reply_markup = InlineKeyboardMarkup(product_menu)
-        await query.edit_message_text(text="📌 منوی محصولات:", reply_markup=reply_markup)
-
-    elif data == 'ntc10k':
-        reply_markup = InlineKeyboardMarkup(ntc10k_menu)
-        await query.edit_message_text(
-            text="🌡️ سنسور دمای NTC10K\nلطفاً یکی از گزینه‌های زیر را انتخاب کنید:",
-            reply_markup=reply_markup
-        )
-
-    elif data == 'contact':
-        contact_text = """✨ ارتباط با ولتا استور ✨
-👤 مدیر فروش: محمد حسین داودی
-📱 تلفن تماس: 09359636526
-📍 آدرس: تهران، سه راه مرزداران، برج نگین رضا
-⏰ ساعات پاسخگویی:
-شنبه تا چهارشنبه: 9:00 - 18:00
-پنجشنبه: 9:00 - 13:00"""
-        reply_markup = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔙 بازگشت به منوی قبل", callback_data='back_main')]
-        ])
-        await query.edit_message_text(text=contact_text, reply_markup=reply_markup)
-
-    # --- اطلاعات محصول ---
-    product_info = {
-        'specs': {
-            'title': '📘 مشخصات فنی:',
-            'content': """- نوع سنسور: 103AT-2-NTC
+# --- اطلاعات محصول ---
+PRODUCT_INFO = {
+    'specs': {
+        'title': '📘 مشخصات فنی:',
+        'content': """- نوع سنسور: 103AT-2-NTC
 - محدوده دما: -50 تا +110°C
 - دقت اندازه‌گیری: ±0.5°C
 - نوع اتصال: 2 سیمه 
 - جنس غلاف: استیل ضدزنگ"""
-        },
-        'dimensions': {
-            'title': '📏 ویژگی‌های فیزیکی:',
-            'content': """- طول غلاف: 50 میلی‌متر
+    },
+    'dimensions': {
+        'title': '📏 ویژگی‌های فیزیکی:',
+        'content': """- طول غلاف: 50 میلی‌متر
 - قطر غلاف: 6 میلی‌متر
 - طول سیم: 2 متر
 - وزن: 50 گرم
 - نوع نصب: مجاورتی"""
-        },
-        'uses': {
-            'title': '🏭 کاربردها:',
-            'content': """- صنایع غذایی
+    },
+    'uses': {
+        'title': '🏭 کاربردها:',
+        'content': """- صنایع غذایی
 - دیگ بخار
 - تجهیزات آزمایشگاهی
 - چیلر و تهویه مطبوع
 - خطوط تولید صنعتی"""
-        },
-        'conditions': {
-            'title': '🌡️ شرایط کاری:',
-            'content': """- دمای کاری: -50 تا +110°C
+    },
+    'conditions': {
+        'title': '🌡️ شرایط کاری:',
+        'content': """- دمای کاری: -50 تا +110°C
 - فشار قابل تحمل: تا 10 بار
 - مقاومت در برابر رطوبت: دارد"""
-        }
     }
+}
 
-    if data in product_info:
-        info = product_info[data]
-        text = f"{info['title']}\n{info['content']}"
-        reply_markup = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔙 بازگشت به منوی قبل", callback_data='ntc10k')]
-        ])
-        await query.edit_message_text(text=text, reply_markup=reply_markup)
-
-    elif data == 'images':
-        reply_markup = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🖼️ نمای نزدیک", callback_data='image_closeup')],
-            [InlineKeyboardButton("🖼️ نصب شده روی دستگاه", callback_data='image_installed')],
-            [InlineKeyboardButton("🔙 بازگشت به منوی قبل", callback_data='ntc10k')]
-        ])
-        await query.edit_message_text(text="📷 لطفاً یک تصویر را انتخاب کنید:", reply_markup=reply_markup)
-
-    elif data in ['image_closeup', 'image_installed']:
-        photo_url = "https://via.placeholder.com/300x200?text=Close+Up" if data == 'image_closeup' else "https://via.placeholder.com/300x200?text=Installed+View"
-        await query.message.reply_photo(photo=photo_url)
-        await query.answer()
+CONTACT_TEXT = """✨ ارتباط با ولتا استور ✨
+👤 مدیر فروش: محمد حسین داودی
+📱 تلفن تماس: 09359636526
+📍 آدرس: تهران، سه راه مرزداران، برج نگین رضا
+⏰ ساعات پاسخگویی:
+شنبه تا چهارشنبه: 9:00 - 18:00
+پنجشنبه: 9:00 - 13:00"""
 
-    elif data == 'order':
-        await show_order_summary(query, context)
+PAYMENT_INFO = {
+    'card_number': "💳 شماره کارت:\n6037-9975-9975-9975\nبه نام: محمد حسین داودی\nبانک: ملی",
+    'sheba_number': "📱 شماره شبا:\nIR06-0170-0000-0012-3456-7890-01\nبه نام: محمد حسین داودی\nبانک: ملی",
+    'account_number': "🏦 شماره حساب:\n0012345678901\nبه نام: محمد حسین داودی\nبانک: ملی"
+}
 
-    # --- انتخاب نوع سنسور ---
-    elif data == 'select_sensor_type':
-        keyboard = [
-            [InlineKeyboardButton("🌡️ NTC10K", callback_data='sensor_ntc10k')],
-            [InlineKeyboardButton("🌡️ PT100", callback_data='sensor_pt100')],
-            [InlineKeyboardButton("🔙 بازگشت", callback_data='order')]
-        ]
-        await query.edit_message_text(
-            text="🎯 لطفاً نوع سنسور را انتخاب کنید:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+GALLERY_IMAGES = {
+    'image_closeup': "https://via.placeholder.com/300x200?text=Close+Up",
+    'image_installed': "https://via.placeholder.com/300x200?text=Installed+View"
+}
 
-    # --- پردازش انتخاب نوع سنسور ---
-    elif data.startswith('sensor_'):
-        sensor_type = 'NTC10K' if data == 'sensor_ntc10k' else 'PT100'
-        context.user_data['sensor_type'] = sensor_type
-        await query.answer(f"نوع سنسور {sensor_type} انتخاب شد")
-        await show_order_summary(query, context)
-
-    # --- انتخاب ابعاد غلاف ---
-    elif data == 'select_dimensions':
-        keyboard = [
-            [InlineKeyboardButton("📏 6×50", callback_data='dim_6x50')],
-            [InlineKeyboardButton("📏 4×25", callback_data='dim_4x25')],
-            [InlineKeyboardButton("🔙 بازگشت", callback_data='order')]
-        ]
-        await query.edit_message_text(
-            text="📐 لطفاً ابعاد غلاف را انتخاب کنید:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+# پاسخ به دکمه‌های منوهای قدیمی که گزینه‌شان دیگر در کاتالوگ نیست
+STALE_OPTION_TEXT = "⚠️ این گزینه دیگر موجود نیست، لطفاً دوباره انتخاب کنید."
+
+# --- کش file_id رسانه‌ها: هر فایل فقط یک بار به تلگرام منتقل می‌شود ---
+# MEDIA_CACHE_PATH: فایل JSON که file_id ها در آن نگه داشته می‌شوند (خالی = فقط در حافظه)
+# MEDIA_WARMUP_CHAT_ID: چتی که رسانه‌ها هنگام شروع در آن آپلود و بلافاصله حذف می‌شوند
+#                       تا اولین کاربر منتظر آپلود نماند (خالی = بدون pre-warm)
+MEDIA_CACHE_PATH = os.getenv("MEDIA_CACHE_PATH", "media_cache.json")
+MEDIA_WARMUP_CHAT_ID = int(os.getenv("MEDIA_WARMUP_CHAT_ID") or 0)
+
+def media_file_id(message, media_type):
+    media = message.photo[-1] if media_type == 'photo' else getattr(message, media_type)
+    return media.file_id
+
+class MediaRegistry:
+    """
+    نگهداری file_id رسانه‌های ثابت:
+    - اولین ارسال، فایل (یا URL) را می‌فرستد و file_id برگشتی را ذخیره می‌کند.
+    - ارسال‌های بعدی فقط file_id را می‌فرستند.
+    - اگر منبع یک کلید عوض شود یا تلگرام file_id را نپذیرد، دوباره آپلود می‌شود.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file_ids = {}
+        self.locks = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    self.file_ids = json.load(f)
+            except Exception as e:
+                logging.error(f"❌ خطای خواندن کش رسانه‌ها: {e}")
 
-    # --- پردازش انتخاب ابعاد ---
-    elif data.startswith('dim_'):
-        dimensions = '6×50' if data == 'dim_6x50' else '4×25'
-        context.user_data['dimensions'] = dimensions
-        await query.answer(f"ابعاد {dimensions} انتخاب شد")
-        await show_order_summary(query, context)
+    def get(self, key, source):
+        entry = self.file_ids.get(key)
+        return entry['file_id'] if entry and entry['source'] == source else None
 
-    # --- انتخاب طول سیم ---
-    elif data == 'select_wire_length':
-        context.user_data['awaiting_wire_length'] = True
-        await query.edit_message_text(
-            text="📏 لطفاً طول سیم را به سانتی‌متر وارد کنید (40 تا 500):",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data='order')]])
-        )
+    def remember(self, key, source, file_id):
+        self.file_ids[key] = {'source': source, 'file_id': file_id}
+        self.save()
 
-    # --- انتخاب تعداد ---
-    elif data == 'select_quantity':
-        context.user_data['awaiting_quantity'] = True
-        await query.edit_message_text(
-            text="🔢 لطفاً تعداد مورد نیاز را وارد کنید:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data='order')]])
-        )
+    def forget(self, key):
+        if self.file_ids.pop(key, None):
+            self.save()
 
-    # --- درخواست اطلاعات تماس ---
-    elif data == 'enter_contact_info':
-        context.user_data['awaiting_customer_name'] = True
-        await query.edit_message_text(
-            text="📝 لطفاً نام و نام خانوادگی خود را وارد کنید:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data='order')]])
-        )
+    def save(self):
+        if not self.path:
+            return
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.file_ids, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logging.error(f"❌ خطای ذخیره‌ی کش رسانه‌ها: {e}")
+
+    @staticmethod
+    def read_source(source):
+        # URL ها را خود تلگرام دریافت می‌کند؛ فایل‌های محلی یک بار خوانده و آپلود می‌شوند
+        if source.startswith(('http://', 'https://')):
+            return source
+        with open(source, 'rb') as f:
+            return f.read()
+
+    async def send(self, send, media_type, key, source, **kwargs):
+        """send یکی از متدهای ارسال (مثل bot.send_photo یا message.reply_photo) است."""
+        file_id = self.get(key, source)
+        if file_id is None:
+            # دو کلیک همزمان روی رسانه‌ی جدید فقط یک آپلود انجام می‌دهند
+            async with self.locks.setdefault(key, asyncio.Lock()):
+                file_id = self.get(key, source)
+                if file_id is None:
+                    message = await send(**{media_type: self.read_source(source)}, **kwargs)
+                    self.remember(key, source, media_file_id(message, media_type))
+                    return message
+        try:
+            return await send(**{media_type: file_id}, **kwargs)
+        except BadRequest as e:
+            logging.warning(f"⚠️ file_id ذخیره شده برای {key} پذیرفته نشد، دوباره آپلود می‌شود: {e}")
+            self.forget(key)
+            return await self.send(send, media_type, key, source, **kwargs)
+
+    async def prewarm(self, bot, chat_id, assets, media_type='photo'):
+        send = getattr(bot, f"send_{media_type}")
+        for key, source in assets.items():
+            if self.get(key, source):
+                continue
+            try:
+                message = await self.send(send, media_type, key, source, chat_id=chat_id, disable_notification=True)
+                await message.delete()
+            except Exception as e:
+                logging.error(f"❌ خطای آپلود اولیه‌ی {key}: {e}")
 
-    # --- ثبت نهایی سفارش ---
-    elif data == 'final_order':
-        required_keys = ['sensor_type', 'dimensions', 'wire_length', 'quantity', 'customer_first_name', 'customer_phone']
-        if not all(key in context.user_data for key in required_keys):
-            await query.answer("❌ لطفاً اطلاعات تماس را کامل کنید.", show_alert=True)
-        else:
-            final_price = calculate_price(context)
-            if final_price is None:
-                await query.answer("⚠️ خطایی در محاسبه قیمت رخ داد.")
-                return
-
-            order_details = f"""✅ سفارش جدید با مشخصات زیر ثبت شد:
-- نوع سنسور: {context.user_data.get('sensor_type')}
-- ابعاد غلاف: {context.user_data.get('dimensions')}
-- طول سیم: {context.user_data.get('wire_length')} سانتی‌متر
-- تعداد: {context.user_data.get('quantity')} عدد
-💰 قیمت کل: {final_price:,} تومان
-📱 برای نهایی کردن سفارش با @admin در تماس باشید."""
+media_registry = MediaRegistry(MEDIA_CACHE_PATH)
 
-            try:
-                # ارسال به کاربر
-                payment_keyboard = [[InlineKeyboardButton("💳 نهایی‌سازی سفارش و پرداخت", callback_data='payment_info')]]
-                await context.bot.send_message(
-                    chat_id=query.from_user.id,
-                    text=order_details,
-                    reply_markup=InlineKeyboardMarkup(payment_keyboard)
-                )
-
-                # --- ساخت و ارسال PDF ---
-                user_name = query.from_user.full_name
-                user_id = query.from_user.id
-                try:
-                    pdf_path = create_invoice_pdf(context, user_name, user_id)
-                    await context.bot.send_document(
-                        chat_id=query.from_user.id,
-                        document=open(pdf_path, 'rb'),
-                        caption="📄 پیش‌فاکتور سفارش شما"
-                    )
-                    os.remove(pdf_path)
-                except Exception as pdf_error:
-                    logging.error(f"❌ خطای ساخت PDF: {pdf_error}")
-                    await context.bot.send_message(
-                        chat_id=query.from_user.id,
-                        text="⚠️ در ایجاد پیش‌فاکتور مشکلی پیش آمد، اما سفارش شما ثبت شد."
-                    )
+# --- هندلرهای دکمه‌ها (هر callback_data یک تابع) ---
+async def show_products(query, context):
+    await query.edit_message_text(text="📌 منوی محصولات:", reply_markup=PRODUCT_MENU)
+
+async def show_ntc10k(query, context):
+    await query.edit_message_text(
+        text="🌡️ سنسور دمای NTC10K\nلطفاً یکی از گزینه‌های زیر را انتخاب کنید:",
+        reply_markup=NTC10K_MENU
+    )
 
-                # ارسال به کانال (فقط یک بار)
-                if not context.user_data.get('order_sent_to_channel', False):
-                    await context.bot.send_message(chat_id=-1002591533364, text=order_details)
-                    context.user_data['order_sent_to_channel'] = True
+async def show_contact(query, context):
+    await query.edit_message_text(text=CONTACT_TEXT, reply_markup=CONTACT_BACK)
 
-                # ویرایش پیام فعلی
-                await query.edit_message_text(
-                    text=f"{order_details}\n✨ سفارش و پیش‌فاکتور برای شما ارسال شد.",
-                    reply_markup=InlineKeyboardMarkup(payment_keyboard)
-                )
-                await query.answer("✅ سفارش و پیش‌فاکتور با موفقیت ارسال شد.")
+async def show_product_info(query, context):
+    info = PRODUCT_INFO[query.data]
+    text = f"{info['title']}\n{info['content']}"
+    await query.edit_message_text(text=text, reply_markup=PRODUCT_INFO_BACK)
+
+async def show_images(query, context):
+    await query.edit_message_text(text="📷 لطفاً یک تصویر را انتخاب کنید:", reply_markup=IMAGES_MENU)
+
+async def send_gallery_image(query, context):
+    await media_registry.send(query.message.reply_photo, 'photo', query.data, GALLERY_IMAGES[query.data])
+    await query.answer()
+
+async def show_order(query, context):
+    await show_order_summary(query, context)
+
+# --- انتخاب نوع سنسور ---
+async def select_sensor_type(query, context):
+    await query.edit_message_text(
+        text="🎯 لطفاً نوع سنسور را انتخاب کنید:",
+        reply_markup=get_catalog().sensor_type_menu
+    )
 
+# --- پردازش انتخاب نوع سنسور ---
+async def choose_sensor(query, context):
+    sensor_type = get_catalog().sensor_choices.get(query.data)
+    if sensor_type is None:
+        await query.answer(STALE_OPTION_TEXT)
+        await select_sensor_type(query, context)
+        return
+    context.user_data.sensor_type = sensor_type
+    await query.answer(f"نوع سنسور {sensor_type} انتخاب شد")
+    await show_order_summary(query, context)
+
+# --- انتخاب ابعاد غلاف ---
+async def select_dimensions(query, context):
+    await query.edit_message_text(
+        text="📐 لطفاً ابعاد غلاف را انتخاب کنید:",
+        reply_markup=get_catalog().dimensions_menu
+    )
+
+# --- پردازش انتخاب ابعاد ---
+async def choose_dimensions(query, context):
+    dimensions = get_catalog().dimension_choices.get(query.data)
+    if dimensions is None:
+        await query.answer(STALE_OPTION_TEXT)
+        await select_dimensions(query, context)
+        return
+    context.user_data.dimensions = dimensions
+    await query.answer(f"ابعاد {dimensions} انتخاب شد")
+    await show_order_summary(query, context)
+
+# --- انتخاب طول سیم ---
+async def select_wire_length(query, context):
+    catalog = get_catalog()
+    context.user_data.state = SessionState.WIRE_LENGTH
+    await query.edit_message_text(
+        text=f"📏 لطفاً طول سیم را به سانتی‌متر وارد کنید ({catalog.min_wire_length} تا {catalog.max_wire_length}):",
+        reply_markup=ORDER_BACK
+    )
+
+# --- انتخاب تعداد ---
+async def select_quantity(query, context):
+    context.user_data.state = SessionState.QUANTITY
+    await query.edit_message_text(
+        text="🔢 لطفاً تعداد مورد نیاز را وارد کنید:",
+        reply_markup=ORDER_BACK
+    )
+
+# --- درخواست اطلاعات تماس ---
+async def enter_contact_info(query, context):
+    context.user_data.state = SessionState.CUSTOMER_NAME
+    await query.edit_message_text(
+        text="📝 لطفاً نام و نام خانوادگی خود را وارد کنید:",
+        reply_markup=ORDER_BACK
+    )
+
+# --- اعلان‌های کانال (سفارش‌ها و رسیدها): صف روی دیسک و ارسال دسته‌ای ---
+# CHANNEL_QUEUE_PATH: فایل SQLite صف؛ هر اعلان تا ارسال موفق در آن می‌ماند و بعد از ری‌استارت هم ارسال می‌شود
+# CHANNEL_DIGEST_WINDOW: اعلان‌ها هر چند ثانیه یک بار در یک پیام خلاصه (و رسیدها در یک آلبوم) ارسال شوند
+#                        (0 = هر اعلان بلافاصله و جداگانه، مثل قبل)
+# CHANNEL_DIGEST_SIZE: با رسیدن تعداد اعلان‌های منتظر به این عدد، بدون انتظار ارسال می‌شوند (آلبوم حداکثر ۱۰ عکس دارد)
+# CHANNEL_URGENT_PRICE: سفارش‌هایی با این مبلغ یا بیشتر بدون انتظار و جداگانه ارسال می‌شوند (0 = غیرفعال)
+# CHANNEL_SHUTDOWN_TIMEOUT: هنگام خاموش شدن، حداکثر چند ثانیه برای ارسال اعلان‌های باقی‌مانده صبر شود؛
+#                           بقیه در صف روی دیسک می‌مانند و بعد از شروع دوباره ارسال می‌شوند
+CHANNEL_QUEUE_PATH = os.getenv("CHANNEL_QUEUE_PATH", f"channel_queue-{WORKER_ID}.db" if WORKER_ID else "channel_queue.db")
+CHANNEL_DIGEST_WINDOW = float(os.getenv("CHANNEL_DIGEST_WINDOW", "0"))
+CHANNEL_DIGEST_SIZE = min(int(os.getenv("CHANNEL_DIGEST_SIZE", "10")), 10)
+CHANNEL_URGENT_PRICE = int(os.getenv("CHANNEL_URGENT_PRICE", "0"))
+CHANNEL_SHUTDOWN_TIMEOUT = float(os.getenv("CHANNEL_SHUTDOWN_TIMEOUT", "10"))
+# فاصله‌ی تلاش دوباره برای اعلان‌هایی که ارسالشان ناموفق بوده
+CHANNEL_RETRY_INTERVAL = 30
+TELEGRAM_TEXT_LIMIT = 4096
+DIGEST_SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+
+class ChannelQueue:
+    """صف اعلان‌های کانال در SQLite؛ همه‌ی دسترسی‌ها روی یک thread جداگانه انجام می‌شوند."""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='channel')
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS notifications (id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT NOT NULL, photo TEXT)"
+            )
+        return self.conn
+
+    def push(self, text, photo):
+        conn = self.connect()
+        with conn:
+            return conn.execute("INSERT INTO notifications (text, photo) VALUES (?, ?)", (text, photo)).lastrowid
+
+    def pending(self, limit):
+        return self.connect().execute(
+            "SELECT id, text, photo FROM notifications ORDER BY id LIMIT ?", (limit,)
+        ).fetchall()
+
+    def delete(self, ids):
+        conn = self.connect()
+        with conn:
+            conn.executemany("DELETE FROM notifications WHERE id = ?", [(item_id,) for item_id in ids])
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+class ChannelNotifier:
+    """
+    هر اعلان اول در صف روی دیسک نوشته می‌شود و فقط بعد از ارسال موفق حذف می‌شود (حداقل یک بار).
+    - بدون بازه (CHANNEL_DIGEST_WINDOW=0) یا برای اعلان فوری: بلافاصله و جداگانه ارسال می‌شود.
+    - در حالت دسته‌ای: متن‌ها در یک پیام خلاصه و عکس‌ها در یک آلبوم ارسال می‌شوند.
+    """
+
+    def __init__(self, queue, window=CHANNEL_DIGEST_WINDOW, size=CHANNEL_DIGEST_SIZE):
+        self.queue = queue
+        self.window = window
+        self.size = size
+        self.buffered = 0
+        self.inflight = set()
+        self.senders = set()
+        self.closing = False
+        self.wake = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+
+    async def notify(self, bot, text, photo=None, urgent=False):
+        metrics.inc('volta_channel_notifications_total')
+        try:
+            item_id = await self.queue.run(self.queue.push, text, photo)
+        except Exception as e:
+            logging.error(f"❌ خطای ثبت اعلان در صف کانال: {e}")
+            item_id = None
+        if item_id is not None and self.closing:
+            # بعد از drain: برای اجرای بعدی در صف می‌ماند
+            return
+        if item_id is not None and self.window and not urgent:
+            self.buffered += 1
+            if self.buffered >= self.size:
+                self.wake.set()
+            return
+        # ارسال فوری؛ اگر ناموفق باشد در صف می‌ماند و در دور بعد ارسال می‌شود
+        self.inflight.add(item_id)
+        self.senders.add(asyncio.current_task())
+        try:
+            await self.send_single(bot, text, photo)
+            if item_id is not None:
+                await self.queue.run(self.queue.delete, [item_id])
+        except Exception as e:
+            logging.error(f"❌ خطای ارسال به کانال: {e}")
+        finally:
+            self.inflight.discard(item_id)
+            self.senders.discard(asyncio.current_task())
+
+    async def send_single(self, bot, text, photo):
+        if photo:
+            await bot.send_photo(chat_id=CHANNEL_ID, photo=photo, caption=text)
+        else:
+            await bot.send_message(chat_id=CHANNEL_ID, text=text)
+        metrics.inc('volta_channel_posts_total', kind='single')
+
+    async def flush(self, bot):
+        async with self.flush_lock:
+            self.buffered = 0
+            while True:
+                rows = [row for row in await self.queue.run(self.queue.pending, self.size + len(self.inflight))
+                        if row[0] not in self.inflight][:self.size]
+                if not rows:
+                    return
+                photos = [row for row in rows if row[2]]
+                texts = [row for row in rows if not row[2]]
+                if len(photos) == 1:
+                    await self.send_single(bot, photos[0][1], photos[0][2])
+                elif photos:
+                    await bot.send_media_group(
+                        chat_id=CHANNEL_ID,
+                        media=[InputMediaPhoto(media=photo, caption=text) for _, text, photo in photos]
+                    )
+                    metrics.inc('volta_channel_posts_total', kind='album')
+                if photos:
+                    await self.queue.run(self.queue.delete, [row[0] for row in photos])
+                if texts:
+                    for chunk in self.digest_chunks([text for _, text, _ in texts]):
+                        await bot.send_message(chat_id=CHANNEL_ID, text=chunk)
+                        metrics.inc('volta_channel_posts_total', kind='digest')
+                    await self.queue.run(self.queue.delete, [row[0] for row in texts])
+                if len(rows) < self.size:
+                    return
+
+    async def drain(self, bot, timeout=CHANNEL_SHUTDOWN_TIMEOUT):
+        """
+        برای خاموش شدن: ارسال‌های فوری در جریان و بعد صف، حداکثر تا timeout ثانیه. ارسال‌هایی که تا آن موقع
+        (مثلاً پشت سقف ۲۰ پیام در دقیقه‌ی کانال) نرسیده‌اند لغو می‌شوند و در صف روی دیسک می‌مانند، تا
+        application.stop() که منتظر task های create_task است معطلشان نشود. اعلان‌های بعدی فقط در صف نوشته می‌شوند.
+        """
+        self.closing = True
+        deadline = time.monotonic() + timeout
+        if self.senders:
+            _, pending = await asyncio.wait(set(self.senders), timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        await asyncio.wait_for(self.flush(bot), max(deadline - time.monotonic(), 0))
+
+    @staticmethod
+    def digest_chunks(texts):
+        if len(texts) == 1:
+            yield texts[0]
+            return
+        chunk = f"📦 خلاصه‌ی {len(texts)} اعلان جدید | 🕒 {tehran_now().text}"
+        for text in texts:
+            if len(chunk) + len(DIGEST_SEPARATOR) + len(text) > TELEGRAM_TEXT_LIMIT:
+                yield chunk
+                chunk = text
+            else:
+                chunk += DIGEST_SEPARATOR + text
+        yield chunk
+
+    async def run(self, bot):
+        # اعلان‌هایی که قبل از ری‌استارت ارسال نشده‌اند همان ابتدا ارسال می‌شوند
+        while True:
+            try:
+                await self.flush(bot)
             except Exception as e:
-                logging.error(f"❌ خطای ارسال: {e}")
-                await query.answer("⚠️ خطایی در ارسال سفارش رخ داد.")
-
-    # --- ماشین حساب تخمین قیمت ---
-    elif data == 'calculator':
-        keyboard = [
-            [InlineKeyboardButton("NTC 5K", callback_data='calc_sensor_5000')],
-            [InlineKeyboardButton("NTC 10K", callback_data='calc_sensor_12000')],
-            [InlineKeyboardButton("🔙 بازگشت", callback_data='products')]
-        ]
-        await query.edit_message_text(
-            text="🔧 لطفاً نوع سنسور را انتخاب کنید:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+                logging.error(f"❌ خطای ارسال خلاصه به کانال: {e}")
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.window or CHANNEL_RETRY_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+
+channel_notifier = ChannelNotifier(ChannelQueue(CHANNEL_QUEUE_PATH))
+
+# --- حذف آپدیت‌ها و سفارش‌های تکراری (idempotency) ---
+# تلگرام بعد از timeout همان آپدیت را دوباره می‌فرستد و کاربر ممکن است دکمه‌ی ثبت سفارش را دو بار بزند.
+# UPDATE_DEDUPE_WINDOW: مدت (ثانیه) به خاطر سپردن update_id های دیده شده
+# ORDER_DEDUPE_WINDOW: سفارشی با همان مشخصات از همان کاربر در این مدت (ثانیه) دوباره ثبت نمی‌شود
+# DEDUPE_MAX_KEYS: سقف کلیدهای نگه داشته شده در حافظه (قدیمی‌ترها زودتر کنار می‌روند)
+UPDATE_DEDUPE_WINDOW = float(os.getenv("UPDATE_DEDUPE_WINDOW", "600"))
+ORDER_DEDUPE_WINDOW = float(os.getenv("ORDER_DEDUPE_WINDOW", "600"))
+DEDUPE_MAX_KEYS = int(os.getenv("DEDUPE_MAX_KEYS", "10000"))
+ORDER_FINGERPRINT_FIELDS = ('sensor_type', 'dimensions', 'wire_length', 'quantity',
+                            'customer_first_name', 'customer_last_name', 'customer_phone')
+
+class DedupeWindow:
+    """
+    کلیدهایی که در بازه‌ی ttl دیده شده‌اند؛ حافظه به max_keys کلید محدود است.
+    اگر state مشترک فعال باشد، کلید در backend هم گرفته می‌شود تا تکراری‌هایی که به worker دیگری رسیده‌اند هم حذف شوند.
+    """
+
+    def __init__(self, name, ttl, max_keys=DEDUPE_MAX_KEYS):
+        self.name = name
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.seen = OrderedDict()
+
+    def claim_local(self, key):
+        now = time.monotonic()
+        # ttl برای همه یکسان است، پس ترتیب درج همان ترتیب انقضاست
+        while self.seen and (next(iter(self.seen.values())) <= now or len(self.seen) >= self.max_keys):
+            self.seen.popitem(last=False)
+        if key in self.seen:
+            return False
+        self.seen[key] = now + self.ttl
+        return True
+
+    async def claim(self, key):
+        """True اگر این اولین بار است که key در این بازه دیده می‌شود."""
+        if not self.claim_local(key):
+            return False
+        if shared_state:
+            return await shared_state.run(shared_state.backend.add, f"dedupe:{self.name}:{key}", WORKER_ID or '1', self.ttl)
+        return True
+
+    async def release(self, key):
+        """claim کاری که انجام نشد پس گرفته می‌شود تا تلاش دوباره پذیرفته شود."""
+        self.seen.pop(key, None)
+        if shared_state:
+            await shared_state.run(shared_state.backend.delete, f"dedupe:{self.name}:{key}")
+
+update_dedupe = DedupeWindow('update', UPDATE_DEDUPE_WINDOW)
+order_dedupe = DedupeWindow('order', ORDER_DEDUPE_WINDOW)
+
+def order_fingerprint(user_id, user_data):
+    fields = [user_id] + [user_data.get(key) for key in ORDER_FINGERPRINT_FIELDS]
+    return hashlib.sha256(json.dumps(fields, ensure_ascii=False).encode('utf-8')).hexdigest()[:32]
+
+async def drop_duplicate_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """قبل از همه‌ی handler ها (گروه -1) اجرا می‌شود؛ آپدیت تکراری به هیچ handler دیگری نمی‌رسد."""
+    if not await update_dedupe.claim(update.update_id):
+        logging.info(f"🔁 آپدیت تکراری {update.update_id} نادیده گرفته شد.")
+        raise ApplicationHandlerStop
+
+# --- ثبت نهایی سفارش ---
+async def final_order(query, context):
+    required_keys = ['sensor_type', 'dimensions', 'wire_length', 'quantity', 'customer_first_name', 'customer_phone']
+    order = context.user_data.order()
+    if not all(key in order for key in required_keys):
+        await query.answer("❌ لطفاً اطلاعات تماس را کامل کنید.", show_alert=True)
+        return
+
+    final_price = calculate_price(order)
+    if final_price is None:
+        await query.answer("⚠️ خطایی در محاسبه قیمت رخ داد.")
+        return
+
+    # --- هر سفارش فقط یک بار: دو بار زدن دکمه، سفارش، PDF و پیام کانال را تکرار نمی‌کند ---
+    fingerprint = order_fingerprint(query.from_user.id, order)
+    if not await order_dedupe.claim(fingerprint):
+        await query.answer("✅ این سفارش قبلاً ثبت شده است.", show_alert=True)
+        return
+
+    # تا وقتی پیام سفارش به کاربر نرسیده، خطا claim را آزاد می‌کند تا کاربر بتواند دوباره تلاش کند
+    delivered = False
+    try:
+        # --- ثبت در دفتر سفارش‌ها و گرفتن شماره‌ی فاکتور یکتا ---
+        order['invoice_number'] = await record_order(order, final_price, query.from_user.id)
+        # رسید پرداختی که بعد از این می‌رسد به همین سفارش وصل می‌شود
+        context.user_data.open_invoice = order['invoice_number']
+
+        order_details = f"""✅ سفارش جدید با مشخصات زیر ثبت شد:
+🧾 شماره فاکتور: {order['invoice_number']}
+- نوع سنسور: {order['sensor_type']}
+- ابعاد غلاف: {order['dimensions']}
+- طول سیم: {order['wire_length']} سانتی‌متر
+- تعداد: {order['quantity']} عدد
+💰 قیمت کل: {final_price:,} تومان
+📱 برای نهایی کردن سفارش با @admin در تماس باشید."""
 
-    elif data.startswith('calc_sensor_'):
-        price = int(data.split('_')[2])
-        context.user_data['calc_sensor_price'] = price
-        await query.answer("نوع سنسور انتخاب شد")
-        keyboard = [
-            [InlineKeyboardButton("25×4", callback_data='calc_sheath_11000')],
-            [InlineKeyboardButton("50×4", callback_data='calc_sheath_12000')],
-            [InlineKeyboardButton("100×4", callback_data='calc_sheath_34000')],
-            [InlineKeyboardButton("25×5", callback_data='calc_sheath_12000')],
-            [InlineKeyboardButton("50×5", callback_data='calc_sheath_13000')],
-            [InlineKeyboardButton("30×5", callback_data='calc_sheath_13000')],
-            [InlineKeyboardButton("30×6", callback_data='calc_sheath_10000')],
-            [InlineKeyboardButton("40×6", callback_data='calc_sheath_14000')],
-            [InlineKeyboardButton("50×6 سرتخت", callback_data='calc_sheath_19000')],
-            [InlineKeyboardButton("50×6 سرگرد", callback_data='calc_sheath_19000')],
-            [InlineKeyboardButton("🔙 بازگشت", callback_data='calculator')]
-        ]
-        await query.edit_message_text(
-            text="🔧 لطفاً نوع غلاف را انتخاب کنید:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+        # ارسال به کاربر
+        await context.bot.send_message(
+            chat_id=query.from_user.id,
+            text=order_details,
+            reply_markup=FINALIZE_PAYMENT_MENU
         )
+        delivered = True
 
-    elif data.startswith('calc_sheath_'):
-        price = int(data.split('_')[2])
-        context.user_data['calc_sheath_price'] = price
-        await query.answer("نوع غلاف انتخاب شد")
-        context.user_data['awaiting_calc_length'] = True
-        await query.edit_message_text(
-            text="📏 لطفاً طول کابل را به متر وارد کنید (مثلاً 2.5):",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data='calculator')]])
+        # --- ساخت و ارسال PDF (در پس‌زمینه، بدون قفل کردن ربات) ---
+        context.application.create_task(
+            send_invoice(context.bot, order, final_price, query.from_user.full_name, query.from_user.id)
         )
 
-    elif data == 'back_main':
-        await query.edit_message_text(text="🛒 به فروشگاه ولتا استور خوش آمدید!", reply_markup=InlineKeyboardMarkup(main_menu))
-
-    elif data == 'back_products':
-        await query.edit_message_text(text="📌 منوی محصولات:", reply_markup=InlineKeyboardMarkup(product_menu))
-
-    elif data == 'payment_info':
-        payment_text = "💳 لطفاً از یکی از روش‌های زیر برای پرداخت استفاده کنید:"
-        payment_menu = [
-            [InlineKeyboardButton("💳 شماره کارت", callback_data='card_number')],
-            [InlineKeyboardButton("📱 شماره شبا", callback_data='sheba_number')],
-            [InlineKeyboardButton("🏦 شماره حساب", callback_data='account_number')],
-            [InlineKeyboardButton("🔙 بازگشت", callback_data='back_products')]
-        ]
-        await query.edit_message_text(text=payment_text, reply_markup=InlineKeyboardMarkup(payment_menu))
-
-    elif data in ['card_number', 'sheba_number', 'account_number']:
-        payment_info = {
-            'card_number': "💳 شماره کارت:\n6037-9975-9975-9975\nبه نام: محمد حسین داودی\nبانک: ملی",
-            'sheba_number': "📱 شماره شبا:\nIR06-0170-0000-0012-3456-7890-01\nبه نام: محمد حسین داودی\nبانک: ملی",
-            'account_number': "🏦 شماره حساب:\n0012345678901\nبه نام: محمد حسین داودی\nبانک: ملی"
-        }
-        send_receipt_button = [
-            [InlineKeyboardButton("📸 ارسال رسید پرداخت", callback_data='send_receipt')],
-            [InlineKeyboardButton("🔙 بازگشت", callback_data='payment_info')]
-        ]
-        await query.edit_message_text(
-            text=f"{payment_info[data]}\n✨ پس از پرداخت، لطفاً رسید را ارسال کنید.",
-            reply_markup=InlineKeyboardMarkup(send_receipt_button)
-        )
+        # ارسال به کانال (تکرار همین سفارش بالاتر کنار گذاشته شده است)
+        urgent = bool(CHANNEL_URGENT_PRICE) and final_price >= CHANNEL_URGENT_PRICE
+        context.application.create_task(channel_notifier.notify(context.bot, order_details, urgent=urgent))
 
-    elif data == 'send_receipt':
-        context.user_data['awaiting_receipt'] = True
+        # ویرایش پیام فعلی
         await query.edit_message_text(
-            text="📸 لطفاً تصویر رسید پرداخت را ارسال کنید.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data='payment_info')]])
+            text=f"{order_details}\n✨ سفارش و پیش‌فاکتور برای شما ارسال شد.",
+            reply_markup=FINALIZE_PAYMENT_MENU
         )
+        await query.answer("✅ سفارش و پیش‌فاکتور با موفقیت ارسال شد.")
 
-# --- هندلر پیام‌های متنی ---
-async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # --- ورود طول سیم ---
-    if 'awaiting_wire_length' in context.user_data and context.user_data['awaiting_wire_length']:
-        try:
-            length = int(update.message.text.strip())
-            if 40 <= length <= 500:
-                context.user_data['wire_length'] = length
-                context.user_data['awaiting_wire_length'] = False
+    except Exception as e:
+        logging.error(f"❌ خطای ارسال: {e}")
+        if not delivered:
+            await order_dedupe.release(fingerprint)
+        await query.answer("⚠️ خطایی در ارسال سفارش رخ داد.")
+
+# --- ماشین حساب تخمین قیمت ---
+async def show_calculator(query, context):
+    await query.edit_message_text(
+        text="🔧 لطفاً نوع سنسور را انتخاب کنید:",
+        reply_markup=get_catalog().calculator_menu
+    )
 
-                # ارسال دوباره منوی سفارش
-                order_text = """📋 مشخصات سفارش شما:
-🎯 نوع سنسور: {}
-📐 ابعاد غلاف: {}
-📏 طول سیم: {}
-🔢 تعداد: {}""".format(
-                    f"✨ {context.user_data.get('sensor_type')}" if context.user_data.get('sensor_type') else "❌ انتخاب نشده",
-                    f"✨ {context.user_data.get('dimensions')}" if context.user_data.get('dimensions') else "❌ انتخاب نشده",
-                    f"✨ {length} سانتی‌متر",
-                    f"✨ {context.user_data.get('quantity')} عدد" if context.user_data.get('quantity') else "❌ انتخاب نشده"
-                )
-                reply_markup = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🎯 انتخاب نوع سنسور", callback_data='select_sensor_type')],
-                    [InlineKeyboardButton("📐 انتخاب ابعاد غلاف", callback_data='select_dimensions')],
-                    [InlineKeyboardButton("📍 طول سیم", callback_data='select_wire_length')],
-                    [InlineKeyboardButton("🔢 تعداد", callback_data='select_quantity')],
-                    [InlineKeyboardButton("📞 اطلاعات تماس", callback_data='enter_contact_info')],
-                    [InlineKeyboardButton("✅ ثبت نهایی سفارش", callback_data='final_order')],
-                    [InlineKeyboardButton("🔙 بازگشت به منوی قبل", callback_data='back_products')]
-                ])
-                await update.message.reply_text(text=order_text, reply_markup=reply_markup)
+async def choose_calc_sensor(query, context):
+    catalog = get_catalog()
+    sensor_id = query.data[len('calc_sensor_'):]
+    if sensor_id not in catalog.calc_sensor_prices:
+        await query.answer(STALE_OPTION_TEXT)
+        await show_calculator(query, context)
+        return
+    context.user_data.calc_sensor = sensor_id
+    await query.answer("نوع سنسور انتخاب شد")
+    await query.edit_message_text(
+        text="🔧 لطفاً نوع غلاف را انتخاب کنید:",
+        reply_markup=catalog.calc_sheath_menu
+    )
+
+async def choose_calc_sheath(query, context):
+    catalog = get_catalog()
+    sheath_id = query.data[len('calc_sheath_'):]
+    if sheath_id not in catalog.calc_sheath_prices:
+        await query.answer(STALE_OPTION_TEXT)
+        await query.edit_message_text(text="🔧 لطفاً نوع غلاف را انتخاب کنید:", reply_markup=catalog.calc_sheath_menu)
+        return
+    context.user_data.calc_sheath = sheath_id
+    await query.answer("نوع غلاف انتخاب شد")
+    context.user_data.state = SessionState.CALC_LENGTH
+    await query.edit_message_text(
+        text="📏 لطفاً طول کابل را به متر وارد کنید (مثلاً 2.5):",
+        reply_markup=CALCULATOR_BACK
+    )
+
+async def back_main(query, context):
+    await query.edit_message_text(text="🛒 به فروشگاه ولتا استور خوش آمدید!", reply_markup=MAIN_MENU)
+
+async def back_products(query, context):
+    await query.edit_message_text(text="📌 منوی محصولات:", reply_markup=PRODUCT_MENU)
+
+async def show_payment_info(query, context):
+    payment_text = "💳 لطفاً از یکی از روش‌های زیر برای پرداخت استفاده کنید:"
+    await query.edit_message_text(text=payment_text, reply_markup=PAYMENT_MENU)
+
+async def show_payment_method(query, context):
+    await query.edit_message_text(
+        text=f"{PAYMENT_INFO[query.data]}\n✨ پس از پرداخت، لطفاً رسید را ارسال کنید.",
+        reply_markup=SEND_RECEIPT_MENU
+    )
+
+async def send_receipt(query, context):
+    context.user_data.state = SessionState.RECEIPT
+    await query.edit_message_text(
+        text="📸 لطفاً تصویر رسید پرداخت را ارسال کنید.",
+        reply_markup=PAYMENT_BACK
+    )
+
+# --- دفتر سفارش‌ها (ledger) ---
+# ORDER_DB_PATH: فایل SQLite دفتر سفارش‌ها (خالی = بدون ثبت)
+# ADMIN_IDS: شناسه‌ی کاربری ادمین‌ها (با کاما جدا شده) برای دستور /orders
+# ORDERS_PAGE_SIZE: تعداد سفارش‌ها در هر صفحه‌ی /orders
+ORDER_DB_PATH = os.getenv("ORDER_DB_PATH", "orders.db")
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+ORDERS_PAGE_SIZE = int(os.getenv("ORDERS_PAGE_SIZE", "10"))
+
+class OrderLedger:
+    """
+    دفتر فقط-افزودنی سفارش‌ها در SQLite (حالت WAL).
+    شماره‌ی فاکتور از تاریخ شمسی و شناسه‌ی یکتای ردیف ساخته می‌شود، پس تکراری نمی‌شود.
+    همه‌ی دسترسی‌ها روی یک thread جداگانه انجام می‌شوند.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ledger')
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS orders (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    invoice_number TEXT UNIQUE,
+                    user_id INTEGER NOT NULL,
+                    customer_name TEXT,
+                    phone TEXT,
+                    sensor_type TEXT,
+                    dimensions TEXT,
+                    wire_length INTEGER,
+                    quantity INTEGER,
+                    total_price INTEGER,
+                    order_date TEXT,
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS ix_orders_user ON orders (user_id, id);
+                CREATE INDEX IF NOT EXISTS ix_orders_phone ON orders (phone, id);
+                CREATE INDEX IF NOT EXISTS ix_orders_sensor ON orders (sensor_type, id);
+                CREATE INDEX IF NOT EXISTS ix_orders_created ON orders (created_at);
+                CREATE TABLE IF NOT EXISTS receipts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    invoice_number TEXT,
+                    user_id INTEGER NOT NULL,
+                    receipt_hash TEXT,
+                    file_id TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS ix_receipts_invoice ON receipts (invoice_number);
+            """)
+        return self.conn
+
+    def append(self, order, final_price, user_id):
+        conn = self.connect()
+        now = tehran_now()
+        customer_name = f"{order.get('customer_first_name', '')} {order.get('customer_last_name', '')}".strip()
+        with conn:
+            cursor = conn.execute(
+                """INSERT INTO orders (user_id, customer_name, phone, sensor_type, dimensions, wire_length,
+                                       quantity, total_price, order_date, created_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (user_id, customer_name, order.get('customer_phone'), order.get('sensor_type'),
+                 order.get('dimensions'), order.get('wire_length'), order.get('quantity'),
+                 final_price, now.text, time.time())
+            )
+            invoice_number = f"{now.date_compact}-{cursor.lastrowid}"
+            conn.execute("UPDATE orders SET invoice_number = ? WHERE id = ?", (invoice_number, cursor.lastrowid))
+        return invoice_number
+
+    def page(self, before_id=None, term=None, limit=ORDERS_PAGE_SIZE):
+        """صفحه‌بندی cursor-based: سفارش‌های با id کمتر از before_id، جدیدترین اول."""
+        where, params = [], []
+        if term:
+            if term.isdigit() and term.startswith('0'):
+                where.append("phone = ?")
+                params.append(term)
+            elif term.isdigit():
+                where.append("user_id = ?")
+                params.append(int(term))
             else:
-                await update.message.reply_text("❌ لطفاً عددی بین 40 تا 500 وارد کنید.")
-        except ValueError:
-            await update.message.reply_text("❌ فقط عدد معتبر وارد کنید.")
+                where.append("sensor_type = ?")
+                params.append(term)
+        if before_id is not None:
+            where.append("id < ?")
+            params.append(before_id)
+        sql = "SELECT id, invoice_number, order_date, customer_name, phone, sensor_type, quantity, total_price FROM orders"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        return self.connect().execute(sql, params).fetchall()
+
+    def month(self, month):
+        """سفارش‌های یک ماه شمسی (مثلاً '140507') به ترتیب ثبت؛ بازه روی ایندکس یکتای invoice_number."""
+        return self.connect().execute(
+            """SELECT invoice_number, order_date, customer_name, phone, sensor_type, dimensions,
+                      wire_length, quantity, total_price
+               FROM orders WHERE invoice_number >= ? AND invoice_number < ? ORDER BY id""",
+            (month, f"{month}~")
+        ).fetchall()
+
+    def add_receipt(self, invoice_number, user_id, receipt_hash, file_id):
+        conn = self.connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO receipts (invoice_number, user_id, receipt_hash, file_id, created_at) VALUES (?, ?, ?, ?, ?)",
+                (invoice_number, user_id, receipt_hash, file_id, time.time())
+            )
+
+    def recent_receipts(self, limit):
+        """آخرین رسیدهای hash شده، قدیمی‌ترین اول (برای پر کردن دوباره‌ی ReceiptIndex بعد از ری‌استارت)."""
+        rows = self.connect().execute(
+            "SELECT receipt_hash, user_id, invoice_number FROM receipts WHERE receipt_hash IS NOT NULL ORDER BY id DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
+        return rows[::-1]
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
 
-    # --- ورود تعداد ---
-    elif 'awaiting_quantity' in context.user_data and context.user_data['awaiting_quantity']:
+order_ledger = OrderLedger(ORDER_DB_PATH) if ORDER_DB_PATH else None
+
+async def record_order(order, final_price, user_id):
+    """سفارش را در دفتر ثبت می‌کند و شماره‌ی فاکتور را برمی‌گرداند؛ اگر ثبت ممکن نبود شماره‌ی قدیمی ساخته می‌شود."""
+    if order_ledger:
         try:
-            quantity = int(update.message.text.strip())
-            if quantity > 0:
-                context.user_data['quantity'] = quantity
-                context.user_data['awaiting_quantity'] = False
+            return await order_ledger.run(order_ledger.append, order, final_price, user_id)
+        except Exception as e:
+            logging.error(f"❌ خطای ثبت سفارش در دفتر: {e}")
+    return f"{user_id}-{tehran_now().date_compact}"
+
+# --- دستور /orders برای ادمین‌ها ---
+# سقف callback_data در Bot API (بایت UTF-8)
+CALLBACK_DATA_LIMIT = 64
+
+def orders_page_callback(before_id, term, session):
+    """
+    callback_data دکمه‌ی صفحه‌ی بعد: 'orders_page_<id>:<term>'. عبارتی که در CALLBACK_DATA_LIMIT جا نشود
+    در سشن ادمین (orders_term) می‌ماند و دکمه فقط '#' و هش کوتاه آن را دارد.
+    """
+    data = f"orders_page_{before_id}:{term or ''}"
+    if len(data.encode('utf-8')) <= CALLBACK_DATA_LIMIT and not (term or '').startswith('#'):
+        return data
+    session.orders_term = term
+    return f"orders_page_{before_id}:#{orders_term_key(term)}"
+
+def orders_term_key(term):
+    return hashlib.sha256(term.encode('utf-8')).hexdigest()[:8]
+
+async def render_orders_page(before_id, term, session):
+    rows = await order_ledger.run(order_ledger.page, before_id, term)
+    if not rows:
+        return "📭 سفارشی یافت نشد.", None
+    lines = ["📒 سفارش‌ها:"]
+    for _, invoice_number, order_date, customer_name, phone, sensor_type, quantity, total_price in rows:
+        lines.append(f"🧾 {invoice_number} | {order_date}\n👤 {customer_name} | 📱 {phone}\n🎯 {sensor_type} × {quantity} | 💰 {total_price:,} تومان")
+    reply_markup = None
+    if len(rows) == ORDERS_PAGE_SIZE:
+        reply_markup = back_keyboard(orders_page_callback(rows[-1][0], term, session), "⬅️ سفارش‌های قدیمی‌تر")
+    return "\n\n".join(lines), reply_markup
+
+async def orders_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS or not order_ledger:
+        return
+    term = context.args[0] if context.args else None
+    text, reply_markup = await render_orders_page(None, term, context.user_data)
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+async def show_orders_page(query, context):
+    if query.from_user.id not in ADMIN_IDS or not order_ledger:
+        await query.answer()
+        return
+    cursor, _, term = query.data[len('orders_page_'):].partition(':')
+    if not cursor.isdigit():
+        # callback_data دستکاری شده یا از نسخه‌ی دیگری از ربات
+        await query.answer()
+        return
+    if term.startswith('#'):
+        # عبارت بلند در سشن؛ اگر ادمین بعد از این دکمه جستجوی دیگری کرده باشد، این دکمه کهنه است
+        stored = context.user_data.orders_term
+        if stored is None or orders_term_key(stored) != term[1:]:
+            await query.answer("⌛ این جستجو منقضی شده است؛ دوباره /orders را بفرستید.", show_alert=True)
+            return
+        term = stored
+    text, reply_markup = await render_orders_page(int(cursor), term or None, context.user_data)
+    await query.message.reply_text(text, reply_markup=reply_markup)
+    await query.answer()
+
+# --- دستور /invoices برای ادمین‌ها: همه‌ی پیش‌فاکتورهای یک ماه در یک PDF (یا zip با فایل‌های جدا) ---
+def ledger_invoice(row):
+    invoice_number, order_date, customer_name, phone, sensor_type, dimensions, wire_length, quantity, total_price = row
+    order = {
+        'invoice_number': invoice_number,
+        'order_date': order_date,
+        'customer_first_name': customer_name or 'نامشخص',
+        'customer_phone': phone or 'نامشخص',
+        'sensor_type': sensor_type,
+        'dimensions': dimensions,
+        'wire_length': wire_length,
+        'quantity': quantity,
+    }
+    return order, total_price
+
+async def invoices_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS or not order_ledger:
+        return
+    args = context.args or []
+    month = args[0] if args else tehran_now().month_compact
+    if len(month) != 6 or not month.isdigit():
+        await update.message.reply_text("❌ ماه را به شکل 140507 وارد کنید. مثال: /invoices 140507 zip")
+        return
+    as_zip = 'zip' in args[1:]
+
+    rows = await order_ledger.run(order_ledger.month, month)
+    if not rows:
+        await update.message.reply_text("📭 سفارشی در این ماه ثبت نشده است.")
+        return
+    await update.message.reply_text(f"⏳ در حال ساخت {len(rows):,} پیش‌فاکتور...")
+    if as_zip:
+        await send_invoices_zip(update, month, rows)
+        return
+    try:
+        started = time.perf_counter()
+        data = await batch_queue.run(create_invoices_pdf, map(ledger_invoice, rows))
+        metrics.observe('volta_invoice_render_seconds', time.perf_counter() - started, kind='batch')
+        metrics.inc('volta_invoice_renders_total', len(rows), kind='batch')
+        metrics.inc('volta_invoice_pdf_bytes_total', len(data), kind='batch')
+    except asyncio.QueueFull:
+        await update.message.reply_text(BUSY_TEXT)
+        return
+    except Exception as e:
+        logging.error(f"❌ خطای ساخت پیش‌فاکتورهای ماه {month}: {e}")
+        await update.message.reply_text("⚠️ در ساخت فایل پیش‌فاکتورها خطایی رخ داد.")
+        return
+    await update.message.reply_document(
+        document=data,
+        filename=f"پیش_فاکتورهای_{month}.pdf",
+        caption=f"📄 {len(rows):,} پیش‌فاکتور ماه {month}"
+    )
 
-                # ارسال دوباره منوی سفارش
-                order_text = """📋 مشخصات سفارش شما:
-🎯 نوع سنسور: {}
-📐 ابعاد غلاف: {}
-📏 طول سیم: {}
-🔢 تعداد: {}""".format(
-                    f"✨ {context.user_data.get('sensor_type')}" if context.user_data.get('sensor_type') else "❌ انتخاب نشده",
-                    f"✨ {context.user_data.get('dimensions')}" if context.user_data.get('dimensions') else "❌ انتخاب نشده",
-                    f"✨ {context.user_data.get('wire_length')} سانتی‌متر" if context.user_data.get('wire_length') else "❌ انتخاب نشده",
-                    f"✨ {quantity} عدد"
-                )
-                reply_markup = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🎯 انتخاب نوع سنسور", callback_data='select_sensor_type')],
-                    [InlineKeyboardButton("📐 انتخاب ابعاد غلاف", callback_data='select_dimensions')],
-                    [InlineKeyboardButton("📍 طول سیم", callback_data='select_wire_length')],
-                    [InlineKeyboardButton("🔢 تعداد", callback_data='select_quantity')],
-                    [InlineKeyboardButton("📞 اطلاعات تماس", callback_data='enter_contact_info')],
-                    [InlineKeyboardButton("✅ ثبت نهایی سفارش", callback_data='final_order')],
-                    [InlineKeyboardButton("🔙 بازگشت به منوی قبل", callback_data='back_products')]
-                ])
-                await update.message.reply_text(text=order_text, reply_markup=reply_markup)
-            else:
-                await update.message.reply_text("❌ لطفاً یک عدد مثبت وارد کنید.")
-        except ValueError:
-            await update.message.reply_text("❌ فقط عدد وارد کنید.")
-
-    # --- ورود نام مشتری ---
-    elif 'awaiting_customer_name' in context.user_data and context.user_data['awaiting_customer_name']:
-        name = update.message.text.strip()
-        if len(name) < 2:
-            await update.message.reply_text("❌ لطفاً یک نام معتبر وارد کنید.")
+async def send_invoices_zip(update, month, rows):
+    """zip ها روی دیسک ساخته و یکی یکی از روی فایل فرستاده می‌شوند؛ هیچ‌وقت کل خروجی در حافظه نیست."""
+    scratch = tempfile.mkdtemp(prefix='volta-invoices-')
+    try:
+        try:
+            started = time.perf_counter()
+            parts = await batch_queue.run(create_invoices_zip, map(ledger_invoice, rows), scratch)
+            metrics.observe('volta_invoice_render_seconds', time.perf_counter() - started, kind='batch')
+            metrics.inc('volta_invoice_renders_total', len(rows), kind='batch')
+            metrics.inc('volta_invoice_pdf_bytes_total', sum(map(os.path.getsize, parts)), kind='batch')
+        except asyncio.QueueFull:
+            await update.message.reply_text(BUSY_TEXT)
+            return
+        except Exception as e:
+            logging.error(f"❌ خطای ساخت پیش‌فاکتورهای ماه {month}: {e}")
+            await update.message.reply_text("⚠️ در ساخت فایل پیش‌فاکتورها خطایی رخ داد.")
+            return
+        for index, path in enumerate(parts, 1):
+            suffix = f"_{index}" if len(parts) > 1 else ''
+            caption = f"📄 {len(rows):,} پیش‌فاکتور ماه {month}"
+            if len(parts) > 1:
+                caption += f" (بخش {index} از {len(parts)})"
+            with open(path, 'rb') as f:
+                await update.message.reply_document(document=f, filename=f"پیش_فاکتورهای_{month}{suffix}.zip", caption=caption)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+# --- جدول مسیریابی callback ها ---
+# کلیدهای دقیق با یک جستجوی dict پیدا می‌شوند؛ برای کلیدهای پیشوندی، پیشوند تا آخرین '_'
+# (مثلاً 'calc_sheath_' در 'calc_sheath_4x25') جدا و در PREFIX_ROUTES جستجو می‌شود. هر چه بعد از ':' بیاید
+# (مثل عبارت جستجو در 'orders_page_<id>:<term>') داده‌ی آزاد است و در پیدا کردن پیشوند حساب نمی‌شود.
+CALLBACK_ROUTES = {
+    'products': show_products,
+    'ntc10k': show_ntc10k,
+    'contact': show_contact,
+    **{key: show_product_info for key in PRODUCT_INFO},
+    'images': show_images,
+    **{key: send_gallery_image for key in GALLERY_IMAGES},
+    'order': show_order,
+    'select_sensor_type': select_sensor_type,
+    'select_dimensions': select_dimensions,
+    'select_wire_length': select_wire_length,
+    'select_quantity': select_quantity,
+    'enter_contact_info': enter_contact_info,
+    'final_order': final_order,
+    'calculator': show_calculator,
+    'back_main': back_main,
+    'back_products': back_products,
+    'payment_info': show_payment_info,
+    **{key: show_payment_method for key in PAYMENT_INFO},
+    'send_receipt': send_receipt,
+}
+
+PREFIX_ROUTES = {
+    'sensor_': choose_sensor,
+    'dim_': choose_dimensions,
+    'calc_sensor_': choose_calc_sensor,
+    'calc_sheath_': choose_calc_sheath,
+    'orders_page_': show_orders_page,
+}
+
+def route_callback(data):
+    # callback بازی‌ها data ندارد
+    data = data or ''
+    handler = CALLBACK_ROUTES.get(data)
+    if handler is None:
+        key = data.partition(':')[0]
+        handler = PREFIX_ROUTES.get(key[:key.rfind('_') + 1])
+    return handler
+
+# --- هندل کلیک روی دکمه ---
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    handler = route_callback(query.data)
+    if handler is not None:
+        started = time.perf_counter()
+        try:
+            await handler(query, context)
+        finally:
+            metrics.observe('volta_callback_seconds', time.perf_counter() - started, callback=handler.__name__)
+
+# --- هندلر پیام‌های متنی: هر حالت سشن تابع خودش را دارد ---
+# --- ورود طول سیم ---
+async def read_wire_length(update, session, text):
+    try:
+        length = int(text)
+        catalog = get_catalog()
+        if catalog.min_wire_length <= length <= catalog.max_wire_length:
+            session.wire_length = length
+            session.state = SessionState.IDLE
+
+            # ارسال دوباره منوی سفارش
+            await update.message.reply_text(text=render_order_summary(session), reply_markup=ORDER_MENU)
         else:
-            parts = name.split()
-            first_name = parts[0]
-            last_name = " ".join(parts[1:]) if len(parts) > 1 else ""
-            context.user_data['customer_first_name'] = first_name
-            context.user_data['customer_last_name'] = last_name
-            context.user_data['awaiting_customer_name'] = False
-            context.user_data['awaiting_customer_phone'] = True
             await update.message.reply_text(
-                "📞 لطفاً شماره تماس خود را (با 0) وارد کنید:",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data='order')]])
+                f"❌ لطفاً عددی بین {catalog.min_wire_length} تا {catalog.max_wire_length} وارد کنید."
             )
+    except ValueError:
+        await update.message.reply_text("❌ فقط عدد معتبر وارد کنید.")
 
-    # --- ورود شماره تماس ---
-    elif 'awaiting_customer_phone' in context.user_data and context.user_data['awaiting_customer_phone']:
-        phone = update.message.text.strip()
-        if not phone.startswith("0") or not phone.isdigit() or not (10 <= len(phone) <= 11):
-            await update.message.reply_text("❌ لطفاً یک شماره معتبر (مثلاً 09123456789) وارد کنید.")
-        else:
-            context.user_data['customer_phone'] = phone
-            context.user_data['awaiting_customer_phone'] = False
+# --- ورود تعداد ---
+async def read_quantity(update, session, text):
+    try:
+        quantity = int(text)
+        if quantity > 0:
+            session.quantity = quantity
+            session.state = SessionState.IDLE
 
             # ارسال دوباره منوی سفارش
-            order_text = """📋 مشخصات سفارش شما:
-🎯 نوع سنسور: {}
-📐 ابعاد غلاف: {}
-📏 طول سیم: {}
-🔢 تعداد: {}""".format(
-                f"✨ {context.user_data.get('sensor_type')}" if context.user_data.get('sensor_type') else "❌ انتخاب نشده",
-                f"✨ {context.user_data.get('dimensions')}" if context.user_data.get('dimensions') else "❌ انتخاب نشده",
-                f"✨ {context.user_data.get('wire_length')} سانتی‌متر" if context.user_data.get('wire_length') else "❌ انتخاب نشده",
-                f"✨ {context.user_data.get('quantity')} عدد" if context.user_data.get('quantity') else "❌ انتخاب نشده"
-            )
-            reply_markup = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🎯 انتخاب نوع سنسور", callback_data='select_sensor_type')],
-                [InlineKeyboardButton("📐 انتخاب ابعاد غلاف", callback_data='select_dimensions')],
-                [InlineKeyboardButton("📍 طول سیم", callback_data='select_wire_length')],
-                [InlineKeyboardButton("🔢 تعداد", callback_data='select_quantity')],
-                [InlineKeyboardButton("📞 اطلاعات تماس", callback_data='enter_contact_info')],
-                [InlineKeyboardButton("✅ ثبت نهایی سفارش", callback_data='final_order')],
-                [InlineKeyboardButton("🔙 بازگشت به منوی قبل", callback_data='back_products')]
-            ])
-            await update.message.reply_text(text=order_text, reply_markup=reply_markup)
-
-    # --- ورود طول کابل برای ماشین حساب ---
-    elif 'awaiting_calc_length' in context.user_data and context.user_data['awaiting_calc_length']:
-        try:
-            length = float(update.message.text.strip())
-            if length < 0:
-                await update.message.reply_text("❌ طول کابل نمی‌تواند منفی باشد.")
-                return
-
-            sensor_price = context.user_data.get('calc_sensor_price', 0)
-            sheath_price = context.user_data.get('calc_sheath_price', 0)
-            cable_price_per_meter = 12000
-            cable_total = length * cable_price_per_meter
-            assembly = 25000
-            extra = 7000
-            profit = 15000
-
-            base_price = sensor_price + sheath_price + cable_total + assembly + extra + profit
-
-            # فاکتور سختی کار
-            if length <= 2:
-                factor = 1.00
-            elif length <= 5:
-                factor = 1.05
-            elif length <= 10:
-                factor = 1.10
-            elif length <= 15:
-                factor = 1.15
-            else:
-                factor = 1.20
+            await update.message.reply_text(text=render_order_summary(session), reply_markup=ORDER_MENU)
+        else:
+            await update.message.reply_text("❌ لطفاً یک عدد مثبت وارد کنید.")
+    except ValueError:
+        await update.message.reply_text("❌ فقط عدد وارد کنید.")
+
+# --- ورود نام مشتری ---
+async def read_customer_name(update, session, text):
+    if len(text) < 2:
+        await update.message.reply_text("❌ لطفاً یک نام معتبر وارد کنید.")
+    else:
+        parts = text.split()
+        session.customer_first_name = parts[0]
+        session.customer_last_name = " ".join(parts[1:]) if len(parts) > 1 else ""
+        session.state = SessionState.CUSTOMER_PHONE
+        await update.message.reply_text(
+            "📞 لطفاً شماره تماس خود را (با 0) وارد کنید:",
+            reply_markup=ORDER_BACK
+        )
+
+# --- ورود شماره تماس ---
+async def read_customer_phone(update, session, text):
+    if not text.startswith("0") or not text.isdigit() or not (10 <= len(text) <= 11):
+        await update.message.reply_text("❌ لطفاً یک شماره معتبر (مثلاً 09123456789) وارد کنید.")
+    else:
+        session.customer_phone = text
+        session.state = SessionState.IDLE
 
-            final_price = int(base_price * factor)
+        # ارسال دوباره منوی سفارش
+        await update.message.reply_text(text=render_order_summary(session), reply_markup=ORDER_MENU)
+
+# --- ورود طول کابل برای ماشین حساب ---
+async def read_calc_length(update, session, text):
+    try:
+        length = float(text)
+        if length < 0:
+            await update.message.reply_text("❌ طول کابل نمی‌تواند منفی باشد.")
+            return
 
-            # ✅ فقط قیمت نهایی نمایش داده میشه
-            result_text = f"""✅ قیمت تخمینی سنسور دما:
+        final_price = get_catalog().calc_price(session.calc_sensor, session.calc_sheath, length)
+
+        # ✅ فقط قیمت نهایی نمایش داده میشه
+        result_text = f"""✅ قیمت تخمینی سنسور دما:
 💰 قیمت نهایی: {final_price:,.0f} تومان"""
 
-            reply_markup = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔄 محاسبه مجدد", callback_data='calculator')],
-                [InlineKeyboardButton("🛍️ ثبت سفارش آنلاین", callback_data='order')],
-                [InlineKeyboardButton("🏠 منوی اصلی", callback_data='back_main')]
-            ])
+        await update.message.reply_text(result_text, reply_markup=CALC_RESULT_MENU)
+        session.state = SessionState.IDLE
+        session.calc_sensor = None
+        session.calc_sheath = None
+
+    except ValueError:
+        await update.message.reply_text("❌ لطفاً یک عدد معتبر وارد کنید (مثلاً 2.5).")
 
-            await update.message.reply_text(result_text, reply_markup=reply_markup)
-            context.user_data.pop('awaiting_calc_length', None)
-            context.user_data.pop('calc_sensor_price', None)
-            context.user_data.pop('calc_sheath_price', None)
+TEXT_INPUT_HANDLERS = {
+    SessionState.WIRE_LENGTH: read_wire_length,
+    SessionState.QUANTITY: read_quantity,
+    SessionState.CUSTOMER_NAME: read_customer_name,
+    SessionState.CUSTOMER_PHONE: read_customer_phone,
+    SessionState.CALC_LENGTH: read_calc_length,
+}
 
-        except ValueError:
-            await update.message.reply_text("❌ لطفاً یک عدد معتبر وارد کنید (مثلاً 2.5).")
+async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    handler = TEXT_INPUT_HANDLERS.get(context.user_data.state)
+    if handler is not None:
+        await handler(update, context.user_data, update.message.text.strip())
+
+# --- رسیدهای پرداخت: hash ادراکی برای پیدا کردن رسیدهای تکراری ---
+# برای hash کوچک‌ترین اندازه‌ی کافی عکس دانلود می‌شود و به کانال فقط file_id فرستاده می‌شود.
+# RECEIPT_HASH_SIDE: حداقل ضلع کوچک‌تر (پیکسل) عکسی که برای hash دانلود می‌شود
+# RECEIPT_FORWARD_SIDE: حداکثر ضلع بزرگ‌تر عکسی که به کانال می‌رود (برای خواندن رسید کافی است)
+# RECEIPT_MATCH_DISTANCE: حداکثر تعداد بیت‌های متفاوت (از ۱۰۲۴) تا دو رسید یکی حساب شوند
+# RECEIPT_INDEX_SIZE: تعداد رسیدهای اخیر که برای مقایسه در حافظه نگه داشته می‌شوند
+RECEIPT_HASH_SIDE = int(os.getenv("RECEIPT_HASH_SIDE", "320"))
+RECEIPT_FORWARD_SIDE = int(os.getenv("RECEIPT_FORWARD_SIDE", "1280"))
+RECEIPT_MATCH_DISTANCE = int(os.getenv("RECEIPT_MATCH_DISTANCE", "8"))
+RECEIPT_INDEX_SIZE = int(os.getenv("RECEIPT_INDEX_SIZE", "5000"))
+# RECEIPT_SHARED_TTL: مدت (ثانیه) نگه داشتن رسیدها در backend مشترک (STATE_BACKEND) برای مقایسه بین worker ها
+RECEIPT_SHARED_TTL = float(os.getenv("RECEIPT_SHARED_TTL", str(30 * 24 * 3600)))
+# شبکه‌ی dHash؛ ۸ (مقدار معمول) رسیدهای یک بانک را که فقط در ارقام فرق دارند یکی می‌بیند
+RECEIPT_HASH_GRID = 32
+# decode تصویر و جستجو در رسیدهای اخیر CPU می‌برند؛ هر دو روی همین thread انجام می‌شوند
+# (جدا از صف پیش‌فاکتورها تا گزارش ماهانه رسیدها را معطل نکند)
+receipt_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='receipts')
+
+def hash_photo_size(sizes):
+    """کوچک‌ترین اندازه‌ای که ضلع کوچکش حداقل RECEIPT_HASH_SIDE است (sizes از کوچک به بزرگ مرتب است)."""
+    return next((size for size in sizes if min(size.width, size.height) >= RECEIPT_HASH_SIDE), sizes[-1])
+
+def forward_photo_size(sizes):
+    return next((size for size in reversed(sizes) if max(size.width, size.height) <= RECEIPT_FORWARD_SIDE), sizes[0])
+
+def receipt_hash(data, grid=RECEIPT_HASH_GRID):
+    """dHash: تصویر خاکستری (grid+1)×grid و مقایسه‌ی روشنایی هر خانه با همسایه‌ی راستش."""
+    from PIL import Image
+    with Image.open(BytesIO(data)) as image:
+        # JPEG از همان ابتدا با مقیاس کوچک‌تر decode می‌شود
+        image.draft('L', (RECEIPT_HASH_SIDE, RECEIPT_HASH_SIDE))
+        pixels = image.convert('L').resize((grid + 1, grid), Image.BOX).tobytes()
+    value = 0
+    for row in range(0, (grid + 1) * grid, grid + 1):
+        for col in range(row, row + grid):
+            value = value << 1 | (pixels[col] > pixels[col + 1])
+    return value
+
+class ReceiptIndex:
+    """
+    hash رسیدهای اخیر (حداکثر size تا، قدیمی‌ترها اول حذف می‌شوند) به همراه صاحب و شماره‌ی فاکتورشان.
+    رسیدها مثل backend مشترک با تکه‌های receipt_bands هم فهرست می‌شوند تا match فقط hash هایی را مقایسه کند
+    که حداقل در یک تکه یکسان‌اند، نه کل فهرست را. فقط از thread رسیدها (receipt_executor) استفاده می‌شود. فقط رسیدهای همین worker را می‌بیند؛
+    با STATE_BACKEND رسیدهای worker های دیگر از shared_receipt_match پیدا می‌شوند.
+    """
+
+    def __init__(self, size=RECEIPT_INDEX_SIZE, distance=RECEIPT_MATCH_DISTANCE):
+        self.size = size
+        self.distance = distance
+        self.entries = OrderedDict()
+        self.bands = {}
+
+    def match(self, value):
+        owner = self.entries.get(value)
+        if owner is not None:
+            return owner
+        for key in receipt_bands(value, distance=self.distance):
+            for known in self.bands.get(key, ()):
+                if (known ^ value).bit_count() <= self.distance:
+                    return self.entries[known]
+        return None
+
+    def add(self, value, user_id, invoice_number):
+        if value not in self.entries:
+            for key in receipt_bands(value, distance=self.distance):
+                self.bands.setdefault(key, set()).add(value)
+        # صاحب اول رسید نگه داشته می‌شود تا استفاده‌ی دوباره‌ی دیگران همیشه به او اشاره کند
+        self.entries.setdefault(value, (user_id, invoice_number))
+        self.entries.move_to_end(value)
+        if len(self.entries) > self.size:
+            oldest, _ = self.entries.popitem(last=False)
+            for key in receipt_bands(oldest, distance=self.distance):
+                known = self.bands[key]
+                known.discard(oldest)
+                if not known:
+                    del self.bands[key]
+
+receipt_index = ReceiptIndex()
+
+def receipt_bands(value, bits=RECEIPT_HASH_GRID ** 2, distance=RECEIPT_MATCH_DISTANCE):
+    """
+    کلیدهای backend مشترک برای یک hash: hash به distance+1 تکه تقسیم می‌شود و دو hash که حداکثر
+    distance بیت تفاوت دارند حداقل در یک تکه کاملاً یکسان‌اند، پس رسید مشابه با چند get پیدا می‌شود.
+    """
+    count = distance + 1
+    width = -(-bits // count)
+    mask = (1 << width) - 1
+    return [f"receipt:{band}:{value >> band * width & mask:x}" for band in range(count)]
+
+def shared_receipt_match(value):
+    backend = shared_state.backend
+    for key in receipt_bands(value):
+        raw = backend.get(key)
+        if raw is None:
+            continue
+        known, user_id, invoice_number = json.loads(raw)
+        if (int(known, 16) ^ value).bit_count() <= RECEIPT_MATCH_DISTANCE:
+            return user_id, invoice_number
+    return None
+
+def share_receipt(value, user_id, invoice_number):
+    # add (SET NX): مثل ReceiptIndex صاحب اول هر تکه نگه داشته می‌شود
+    raw = json.dumps([f"{value:x}", user_id, invoice_number])
+    for key in receipt_bands(value):
+        shared_state.backend.add(key, raw, RECEIPT_SHARED_TTL)
+
+def check_receipt(data):
+    value = receipt_hash(data)
+    return value, receipt_index.match(value)
+
+async def run_receipts(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(receipt_executor, func, *args)
+
+async def fingerprint_receipt(bot, sizes):
+    """(hash، صاحب رسید مشابه یا None)"""
+    started = time.perf_counter()
+    photo_file = await bot.get_file(hash_photo_size(sizes).file_id)
+    data = await photo_file.download_as_bytearray()
+    value, match = await run_receipts(check_receipt, bytes(data))
+    if match is None and shared_state:
+        match = await shared_state.run(shared_receipt_match, value)
+    metrics.observe('volta_receipt_hash_seconds', time.perf_counter() - started)
+    return value, match
+
+def restore_receipts(rows):
+    for value, user_id, invoice_number in rows:
+        receipt_index.add(int(value, 16), user_id, invoice_number)
+
+async def load_recent_receipts():
+    if not order_ledger:
+        return
+    try:
+        rows = await order_ledger.run(order_ledger.recent_receipts, RECEIPT_INDEX_SIZE)
+        await run_receipts(restore_receipts, rows)
+    except Exception as e:
+        logging.error(f"❌ خطای خواندن رسیدهای اخیر: {e}")
 
 # --- هندلر عکس ---
 async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if 'awaiting_receipt' in context.user_data and context.user_data['awaiting_receipt']:
-        photo = update.message.photo[-1]
+    if context.user_data.state is SessionState.RECEIPT:
+        sizes = update.message.photo
+        user = update.effective_user
+        invoice_number = context.user_data.open_invoice
+        try:
+            fingerprint, match = await fingerprint_receipt(context.bot, sizes)
+        except Exception as e:
+            # رسید نباید به خاطر خطای hash گم شود؛ بدون بررسی تکراری ارسال می‌شود
+            logging.error(f"❌ خطای بررسی رسید: {e}")
+            fingerprint, match = None, None
+
+        # همان رسید دوباره از همان کاربر برای همان سفارش
+        if match == (user.id, invoice_number):
+            metrics.inc('volta_receipts_total', result='duplicate')
+            context.user_data.state = SessionState.IDLE
+            await update.message.reply_text(
+                "ℹ️ این رسید قبلاً دریافت شده و در حال بررسی است.",
+                reply_markup=HOME_BACK
+            )
+            return
+
         receipt_text = f"""📸 رسید پرداخت جدید
-🆔 شناسه کاربر: {update.effective_user.id}
-👤 نام کاربر: {update.effective_user.first_name}"""
+🆔 شناسه کاربر: {user.id}
+👤 نام کاربر: {user.first_name}
+🧾 شماره فاکتور: {invoice_number or 'نامشخص'}"""
+        if match:
+            receipt_text += f"\n⚠️ مشابه رسید قبلی کاربر {match[0]} (فاکتور {match[1] or 'نامشخص'})"
+        photo_id = forward_photo_size(sizes).file_id
         try:
-            # جلوگیری از ارسال دوباره
-            if not context.user_data.get('receipt_sent', False):
-                await context.bot.send_photo(
-                    chat_id=-1002591533364,
-                    photo=photo.file_id,
-                    caption=receipt_text
-                )
-                context.user_data['receipt_sent'] = True
+            context.application.create_task(channel_notifier.notify(context.bot, receipt_text, photo=photo_id))
+            if fingerprint is not None:
+                await run_receipts(receipt_index.add, fingerprint, user.id, invoice_number)
+                if shared_state:
+                    try:
+                        await shared_state.run(share_receipt, fingerprint, user.id, invoice_number)
+                    except Exception as e:
+                        logging.error(f"❌ خطای ثبت رسید در backend مشترک: {e}")
+            if order_ledger:
+                receipt_key = f"{fingerprint:x}" if fingerprint is not None else None
+                try:
+                    await order_ledger.run(order_ledger.add_receipt, invoice_number, user.id, receipt_key, photo_id)
+                except Exception as e:
+                    logging.error(f"❌ خطای ثبت رسید در دفتر: {e}")
+            result = 'unhashed' if fingerprint is None else 'reused' if match else 'new'
+            metrics.inc('volta_receipts_total', result=result)
 
             await update.message.reply_text(
                 "✅ رسید پرداخت شما با موفقیت ثبت شد.\nکارشناسان ما به زودی آن را بررسی خواهند کرد.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 بازگشت به منوی اصلی", callback_data='back_main')]])
+                reply_markup=HOME_BACK
             )
-            context.user_data['awaiting_receipt'] = False
+            context.user_data.state = SessionState.IDLE
         except Exception as e:
             logging.error(f"❌ خطای ارسال رسید: {e}")
             await update.message.reply_text("❌ متأسفانه در ثبت رسید خطایی رخ داد. لطفاً دوباره تلاش کنید.")
 
-# --- ساخت PDF پیش‌فاکتور ---
-def create_invoice_pdf(context, user_name, user_id):
+# --- استعلام قیمت گروهی با فایل CSV (برای نمایندگان فروش) ---
+# هر سطر با همان توابع Catalog که ربات برای یک سفارش استفاده می‌کند قیمت‌گذاری می‌شود،
+# پس نتیجه دقیقاً با ماشین حساب و ثبت سفارش یکی است.
+# QUOTE_MAX_ROWS: حداکثر تعداد سطر هر فایل
+QUOTE_MAX_ROWS = int(os.getenv("QUOTE_MAX_ROWS", "100000"))
+QUOTE_MAX_BYTES = 20 * 1024 * 1024  # سقف دانلود فایل توسط ربات در Bot API
+CALC_QUOTE_COLUMNS = ('sensor', 'sheath', 'length')
+ORDER_QUOTE_COLUMNS = ('sensor_type', 'dimensions', 'wire_length', 'quantity')
+QUOTE_HELP_TEXT = """📊 استعلام قیمت گروهی
+یک فایل CSV بفرستید که سطر اول آن نام ستون‌ها باشد، به یکی از این دو شکل:
+🔧 ماشین حساب: sensor, sheath, length (طول کابل به متر)
+🛍️ سفارش: sensor_type, dimensions, wire_length (سانتی‌متر), quantity
+قیمت هر سطر در ستون price فایل پاسخ نوشته می‌شود."""
+
+def parse_quote_number(value, cast, field):
+    try:
+        number = cast(value)
+    except ValueError:
+        raise ValueError(f"{field} نامعتبر") from None
+    if not math.isfinite(number) or number < 0:
+        raise ValueError(f"{field} نامعتبر")
+    return number
+
+def quote_calc_row(catalog, sensor, sheath, length):
+    sensor_id = resolve_alias(catalog.calc_sensor_aliases, sensor)
+    if sensor_id is None:
+        raise ValueError("sensor نامعتبر")
+    sheath_id = resolve_alias(catalog.calc_sheath_aliases, sheath)
+    if sheath_id is None:
+        raise ValueError("sheath نامعتبر")
+    return catalog.calc_price(sensor_id, sheath_id, parse_quote_number(length, float, 'length'))
+
+def quote_order_row(catalog, sensor_type, dimensions, wire_length, quantity):
+    order = {
+        'sensor_type': resolve_alias(catalog.sensor_aliases, sensor_type),
+        'dimensions': resolve_alias(catalog.dimension_aliases, dimensions),
+        'wire_length': parse_quote_number(wire_length, int, 'wire_length'),
+        'quantity': parse_quote_number(quantity, int, 'quantity'),
+    }
+    if order['sensor_type'] is None:
+        raise ValueError("sensor_type نامعتبر")
+    if order['dimensions'] is None:
+        raise ValueError("dimensions نامعتبر")
+    if not catalog.min_wire_length <= order['wire_length'] <= catalog.max_wire_length:
+        raise ValueError(f"wire_length باید بین {catalog.min_wire_length} و {catalog.max_wire_length} باشد")
+    if order['quantity'] == 0:
+        raise ValueError("quantity نامعتبر")
+    return catalog.order_price(order)
+
+def bulk_quote(catalog, data):
+    """CSV ورودی (bytes) را قیمت‌گذاری می‌کند و (CSV خروجی, تعداد سطر, تعداد سطر نامعتبر) برمی‌گرداند."""
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise ValueError("فایل باید با کدگذاری UTF-8 ذخیره شده باشد.") from None
+    try:
+        # اکسل در بعضی تنظیمات منطقه‌ای به جای ویرگول از ; استفاده می‌کند
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(StringIO(text), dialect)
+    header = next(reader, [])
+    names = [name.strip().lower() for name in header]
+    if all(column in names for column in CALC_QUOTE_COLUMNS):
+        quote_row, columns = quote_calc_row, CALC_QUOTE_COLUMNS
+    elif all(column in names for column in ORDER_QUOTE_COLUMNS):
+        quote_row, columns = quote_order_row, ORDER_QUOTE_COLUMNS
+    else:
+        raise ValueError("ستون‌های فایل شناخته نشد.")
+    indexes = [names.index(column) for column in columns]
+    fields = itemgetter(*indexes)
+    width = max(indexes) + 1
+
+    output = StringIO()
+    # پاسخ با همان جداکننده‌ی فایل ورودی نوشته می‌شود تا در همان تنظیمات اکسل باز شود
+    writer = csv.writer(output, dialect)
+    writer.writerow(header + ['price', 'error'])
+    rows = errors = 0
+    for record in reader:
+        if not any(record):
+            continue
+        rows += 1
+        if rows > QUOTE_MAX_ROWS:
+            raise ValueError(f"هر فایل حداکثر {QUOTE_MAX_ROWS:,} سطر می‌تواند داشته باشد.")
+        try:
+            if len(record) < width:
+                raise ValueError("سطر ناقص است")
+            price, error = quote_row(catalog, *fields(record)), ''
+        except ValueError as e:
+            price, error = '', str(e)
+            errors += 1
+        writer.writerow(record + [price, error])
+    # BOM برای اینکه اکسل متن فارسی را درست نمایش دهد
+    return output.getvalue().encode('utf-8-sig'), rows, errors
+
+# --- دستور /quote و دریافت فایل CSV ---
+async def quote_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(QUOTE_HELP_TEXT)
+
+async def quote_document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    document = update.message.document
+    if document.file_size and document.file_size > QUOTE_MAX_BYTES:
+        await update.message.reply_text("❌ حجم فایل بیش از حد مجاز (۲۰ مگابایت) است.")
+        return
+    try:
+        data = await (await document.get_file()).download_as_bytearray()
+        result, rows, errors = await batch_queue.run(bulk_quote, get_catalog(), bytes(data))
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n\n{QUOTE_HELP_TEXT}")
+        return
+    except asyncio.QueueFull:
+        await update.message.reply_text(BUSY_TEXT)
+        return
+    except Exception as e:
+        logging.error(f"❌ خطای استعلام قیمت گروهی: {e}")
+        await update.message.reply_text("⚠️ در پردازش فایل خطایی رخ داد. لطفاً دوباره تلاش کنید.")
+        return
+
+    caption = f"✅ قیمت {rows:,} سطر محاسبه شد."
+    if errors:
+        caption += f"\n⚠️ {errors:,} سطر نامعتبر بود (توضیح در ستون error)."
+    await update.message.reply_document(document=result, filename="quote.csv", caption=caption)
+
+# --- دستور /pricelist: لیست قیمت PDF از روی کاتالوگ فعلی ---
+async def price_list_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        data = await batch_queue.run(create_price_list_pdf, get_catalog())
+    except asyncio.QueueFull:
+        await update.message.reply_text(BUSY_TEXT)
+        return
+    except Exception as e:
+        logging.error(f"❌ خطای ساخت لیست قیمت: {e}")
+        await update.message.reply_text("⚠️ در ساخت لیست قیمت خطایی رخ داد.")
+        return
+    await update.message.reply_document(document=data, filename="لیست_قیمت_ولتا_استور.pdf", caption="📋 لیست قیمت ولتا استور")
+
+# --- ارسال پیش‌فاکتور: ساخت PDF در worker و ارسال به کاربر ---
+async def send_invoice(bot, order, final_price, user_name, user_id):
+    async def queued():
+        await bot.send_message(
+            chat_id=user_id,
+            text="⏳ پیش‌فاکتور شما در صف ساخت قرار گرفت و به زودی ارسال می‌شود."
+        )
+
+    metrics.inc('volta_invoices_inflight')
+    try:
+        try:
+            # انتظار در صف هم شمرده می‌شود؛ لغو task در همین انتظار هم gauge را کم می‌کند
+            started = time.perf_counter()
+            pdf_bytes = await invoice_queue.run(create_invoice_pdf, order, final_price, user_name, user_id, queued=queued)
+        finally:
+            metrics.inc('volta_invoices_inflight', -1)
+        metrics.observe('volta_invoice_render_seconds', time.perf_counter() - started, kind='order')
+        metrics.inc('volta_invoice_renders_total', kind='order')
+        metrics.inc('volta_invoice_pdf_bytes_total', len(pdf_bytes), kind='order')
+        await bot.send_document(
+            chat_id=user_id,
+            document=pdf_bytes,
+            filename=f"پیش_فاکتور_{user_id}.pdf",
+            caption="📄 پیش‌فاکتور سفارش شما"
+        )
+    except asyncio.QueueFull:
+        # سفارش ثبت شده و به کانال رفته است؛ پیش‌فاکتور را ادمین با /invoices می‌سازد
+        await bot.send_message(
+            chat_id=user_id,
+            text="⏳ صف ساخت پیش‌فاکتور الان پر است؛ سفارش شما ثبت شد و پیش‌فاکتور را هنگام نهایی کردن سفارش از @admin بگیرید."
+        )
+    except Exception as pdf_error:
+        logging.error(f"❌ خطای ساخت PDF: {pdf_error}")
+        await bot.send_message(
+            chat_id=user_id,
+            text="⚠️ در ایجاد پیش‌فاکتور مشکلی پیش آمد، اما سفارش شما ثبت شد."
+        )
+
+# --- قالب از پیش ساخته‌ی پیش‌فاکتور ---
+# فونت، watermark و بخش‌های ثابت (سربرگ، اطلاعات فروشگاه، خط جداکننده) فقط یک بار
+# ساخته می‌شوند و هر پیش‌فاکتور از یک کپی همین قالب شروع می‌شود.
+WATERMARK_PATH = 'volta_store_logo_watermark.png'
+# watermark یک بار آماده می‌شود: روی زمینه‌ی سفید صاف (بدون SMask)، خاکستری، کوچک شده و با سطح‌های رنگ کم
+# تا فشرده‌سازی Flate بهتر شود. فایل اصلی خودش کم‌رنگ است، پس صاف کردن روی سفید همان ظاهر را نگه می‌دارد.
+# WATERMARK_MAX_PX: ضلع watermark بعد از کوچک‌سازی (روی ۱۵۰ میلی‌متر حدود ۶۵ dpi؛ برای پس‌زمینه کافی است)
+# WATERMARK_LEVELS: تعداد سطح‌های خاکستری
+WATERMARK_MAX_PX = int(os.getenv("WATERMARK_MAX_PX", "384"))
+WATERMARK_LEVELS = int(os.getenv("WATERMARK_LEVELS", "16"))
+invoice_template = None
+invoice_font_bytes = None
+invoice_template_lock = threading.Lock()
+
+def build_invoice_template():
+    from fpdf import FPDF
     pdf = FPDF(orientation='P', unit='mm', format='A4')
     pdf.add_page()
     pdf.set_auto_page_break(auto=True, margin=15)
@@ -632,15 +2039,38 @@ def create_invoice_pdf(context, user_name, user_id):
 
     # --- افزودن فونت فارسی ---
     pdf.add_font('Vazir', '', FONT_PATH)
+    draw_invoice_header(pdf)
+    return pdf
+
+@lru_cache(maxsize=1)
+def invoice_watermark():
+    """watermark آماده به صورت PNG (یا None اگر فایل نباشد)؛ fpdf آن را با hash بایت‌ها فقط یک بار embed می‌کند."""
+    if not os.path.exists(WATERMARK_PATH):
+        return None
+    from PIL import Image
+    with Image.open(WATERMARK_PATH) as source:
+        source = source.convert('RGBA')
+        image = Image.new('RGB', source.size, (255, 255, 255))
+        image.paste(source, mask=source.getchannel('A'))
+    image = image.convert('L')
+    image.thumbnail((WATERMARK_MAX_PX, WATERMARK_MAX_PX), Image.LANCZOS)
+    step = 255 / (WATERMARK_LEVELS - 1)
+    image = image.point([round(round(value / step) * step) for value in range(256)])
+    output = BytesIO()
+    image.save(output, 'PNG', optimize=True)
+    return output.getvalue()
+
+# --- بخش ثابت بالای هر صفحه (در PDF های چند صفحه‌ای برای هر صفحه دوباره کشیده می‌شود؛
+#     فونت و تصویر watermark با این حال فقط یک بار در فایل embed می‌شوند) ---
+def draw_invoice_header(pdf, title=INVOICE_TEXT['title']):
+    title = shape_text(title)
     pdf.set_font('Vazir', size=16)
 
     # --- اضافه کردن لوگو به عنوان watermark در پس‌زمینه (فقط بزرگ‌تر) ---
-    WATERMARK_PATH = 'volta_store_logo_watermark.png'
-
     if os.path.exists(WATERMARK_PATH):
         try:
             # اندازه لوگو رو بزرگ‌تر کن (مثلاً 150x150)
-            pdf.image(WATERMARK_PATH, x=30, y=60, w=150, h=150)  # بزرگ‌تر و مرکز صفحه
+            pdf.image(invoice_watermark(), x=30, y=60, w=150, h=150)  # بزرگ‌تر و مرکز صفحه
         except Exception as e:
             print(f"⚠️ مشکل در افزودن watermark: {e}")
     else:
@@ -650,19 +2080,14 @@ def create_invoice_pdf(context, user_name, user_id):
     pdf.set_fill_color(0, 120, 215)  # آبی کاربنی
     pdf.set_text_color(255, 255, 255)
     pdf.set_font('Vazir', '', 20)
-    pdf.cell(0, 20, txt=get_display(arabic_reshaper.reshape("پیش‌فاکتور سفارش")), ln=True, align='C', fill=True)
+    pdf.cell(0, 20, txt=title, ln=True, align='C', fill=True)
     pdf.ln(5)
 
     # --- اطلاعات فروشگاه ---
     pdf.set_text_color(0, 0, 0)
     pdf.set_font('Vazir', size=14)
-    shop_info = "ولتا استور | فروشگاه تخصصی سنسورهای صنعتی"
-    reshaped_shop = get_display(arabic_reshaper.reshape(shop_info))
-    pdf.cell(0, 8, txt=reshaped_shop, ln=True, align='C')
-
-    contact_info = "تلفن: 09359636526 | تهران، سه راه مرزداران"
-    reshaped_contact = get_display(arabic_reshaper.reshape(contact_info))
-    pdf.cell(0, 8, txt=reshaped_contact, ln=True, align='C')
+    pdf.cell(0, 8, txt=shape_text(INVOICE_TEXT['shop_info']), ln=True, align='C')
+    pdf.cell(0, 8, txt=shape_text(INVOICE_TEXT['contact_info']), ln=True, align='C')
     pdf.ln(10)
 
     # --- خط جداکننده ---
@@ -670,26 +2095,65 @@ def create_invoice_pdf(context, user_name, user_id):
     pdf.line(10, 45, 200, 45)
     pdf.ln(5)
 
+def load_invoice_template():
+    global invoice_template, invoice_font_bytes
+    if invoice_template is None:
+        with invoice_template_lock:
+            if invoice_template is None:
+                with open(FONT_PATH, 'rb') as f:
+                    invoice_font_bytes = f.read()
+                invoice_template = build_invoice_template()
+    return invoice_template
+
+def prewarm_invoice_template():
+    # آماده‌سازی قالب پیش‌فاکتور (و import کتابخانه‌های PDF) در پس‌زمینه، بعد از اینکه ربات آپدیت می‌گیرد
+    try:
+        load_invoice_template()
+    except Exception as e:
+        logging.error(f"❌ خطای آماده‌سازی قالب پیش‌فاکتور: {e}")
+
+def new_invoice_pdf():
+    from fontTools.ttLib import TTFont
+    pdf = deepcopy(load_invoice_template())
+    pdf.set_creation_date(datetime.now(timezone.utc))
+    # subset کردن فونت هنگام output جدول‌های فونت را درجا تغییر می‌دهد،
+    # پس هر پیش‌فاکتور نسخه‌ی خودش را از بایت‌های کش شده می‌گیرد
+    for font in pdf.fonts.values():
+        font.ttfont = TTFont(BytesIO(invoice_font_bytes), recalcTimestamp=False, recalcBBoxes=False, lazy=True)
+    return pdf
+
+# --- ساخت PDF پیش‌فاکتور ---
+def create_invoice_pdf(order, final_price, user_name, user_id):
+    pdf_bytes = render_invoice_pdf(order, final_price)
+    if INVOICE_ARCHIVE_DIR:
+        archive_invoice(pdf_bytes)
+    return pdf_bytes
+
+def render_invoice_pdf(order, final_price):
+    pdf = new_invoice_pdf()
+    draw_invoice_body(pdf, order, final_price)
+    # --- خروجی در حافظه (بدون فایل موقت روی دیسک) ---
+    return bytes(pdf.output())
+
+def draw_invoice_body(pdf, order, final_price):
     # --- اطلاعات فاکتور ---
     pdf.set_font('Vazir', size=16)
-    now = get_tehran_time()
-    factor_number = f"شماره فاکتور: {user_id}-{now.split('-')[0].replace('/', '')}"
-    reshaped_factor = get_display(arabic_reshaper.reshape(factor_number))
-    pdf.cell(0, 8, txt=reshaped_factor, ln=True, align='R')
+    # پیش‌فاکتورهایی که از دفتر سفارش‌ها دوباره ساخته می‌شوند تاریخ ثبت خودشان را دارند
+    now = order.get('order_date') or get_tehran_time()
+    factor_number = f"شماره فاکتور: {order.get('invoice_number', 'نامشخص')}"
+    pdf.cell(0, 8, txt=shape_text(factor_number), ln=True, align='R')
 
     date_text = f"تاریخ: {now}"
-    reshaped_date = get_display(arabic_reshaper.reshape(date_text))
-    pdf.cell(0, 8, txt=reshaped_date, ln=True, align='R')
+    pdf.cell(0, 8, txt=shape_text(date_text), ln=True, align='R')
     pdf.ln(5)
 
     # --- اطلاعات مشتری ---
-    customer_first_name = context.user_data.get('customer_first_name', 'نامشخص')
-    customer_last_name = context.user_data.get('customer_last_name', '')
-    customer_phone = context.user_data.get('customer_phone', 'نامشخص')
+    customer_first_name = order.get('customer_first_name', 'نامشخص')
+    customer_last_name = order.get('customer_last_name', '')
+    customer_phone = order.get('customer_phone', 'نامشخص')
 
     customer_info = f"نام: {customer_first_name} {customer_last_name}\nشماره تماس: {customer_phone}"
-    reshaped_customer = get_display(arabic_reshaper.reshape(customer_info))
-    pdf.multi_cell(0, 8, txt=reshaped_customer, align='R')
+    pdf.multi_cell(0, 8, txt=shape_text(customer_info), align='R')
     pdf.ln(5)
 
     # --- جدول سفارش (کامل عرض، از لبه راست شروع میشه) ---
@@ -701,72 +2165,959 @@ def create_invoice_pdf(context, user_name, user_id):
     pdf.set_text_color(0, 0, 0)
     pdf.set_font('Vazir', size=16)
 
-    items = [
-        ("نوع سنسور", context.user_data.get('sensor_type', 'نامشخص')),
-        ("ابعاد غلاف", context.user_data.get('dimensions', 'نامشخص')),
-        ("طول سیم", f"{context.user_data.get('wire_length', 'نامشخص')} سانتی‌متر"),
-        ("تعداد", context.user_data.get('quantity', 'نامشخص')),
-        ("قیمت کل", f"{calculate_price(context):,} تومان" if calculate_price(context) else "نامشخص")
-    ]
+    values = {
+        'sensor_type': order.get('sensor_type', 'نامشخص'),
+        'dimensions': order.get('dimensions', 'نامشخص'),
+        'wire_length': f"{order.get('wire_length', 'نامشخص')} سانتی‌متر",
+        'quantity': order.get('quantity', 'نامشخص'),
+        'final_price': f"{final_price:,} تومان" if final_price else "نامشخص"
+    }
 
-    for label, value in items:
-        reshaped_label = get_display(arabic_reshaper.reshape(label))
-        reshaped_value = get_display(arabic_reshaper.reshape(str(value)))
+    for key, label in INVOICE_TABLE_LABELS:
+        reshaped_label = shape_text(label)
+        reshaped_value = shape_text(str(values[key]))
         # اول "مقدار" (سمت چپ)، بعد "مشخصه" (سمت راست)
         pdf.cell(col1_width, 12, reshaped_value, border=1, align="R")
         pdf.cell(col2_width, 12, reshaped_label, border=1, align="R", ln=True)
 
     # --- فوتر ---
     pdf.ln(10)
-    footer1 = "با تشکر از اعتماد شما به ولتا استور"
-    footer2 = "سفارش شما در دسترسی است و به زودی پیگیری می‌شود."
-
     pdf.set_font('Vazir', '', 16)
     pdf.set_text_color(0, 120, 215)
-    pdf.cell(0, 10, txt=get_display(arabic_reshaper.reshape(footer1)), ln=True, align='C')
+    pdf.cell(0, 10, txt=shape_text(INVOICE_TEXT['footer1']), ln=True, align='C')
 
     pdf.set_text_color(100, 100, 100)
     pdf.set_font('Vazir', size=14)
-    pdf.cell(0, 8, txt=get_display(arabic_reshaper.reshape(footer2)), ln=True, align='C')
+    pdf.cell(0, 8, txt=shape_text(INVOICE_TEXT['footer2']), ln=True, align='C')
+
+# --- ساخت گروهی پیش‌فاکتورها (مثلاً گزارش پایان ماه) ---
+# orders یک iterable از (order, final_price) است و فقط یک بار پیمایش می‌شود.
+def create_invoices_pdf(orders):
+    """همه‌ی سفارش‌ها در یک PDF، هر پیش‌فاکتور در یک صفحه."""
+    pdf = None
+    for order, final_price in orders:
+        if pdf is None:
+            pdf = new_invoice_pdf()
+        else:
+            pdf.add_page()
+            draw_invoice_header(pdf)
+        draw_invoice_body(pdf, order, final_price)
+    return bytes(pdf.output()) if pdf else None
+
+def iter_invoice_pdfs(orders):
+    """برای هر سفارش (order, PDF جداگانه) را می‌دهد؛ هر PDF بعد از مصرف آزاد می‌شود."""
+    for order, final_price in orders:
+        yield order, render_invoice_pdf(order, final_price)
+
+# INVOICE_ZIP_PART_BYTES: حداکثر حجم هر فایل zip (تلگرام فایل بزرگ‌تر از ۵۰ مگابایت را از ربات نمی‌پذیرد)
+INVOICE_ZIP_PART_BYTES = int(os.getenv("INVOICE_ZIP_PART_BYTES", str(45 * 1024 * 1024)))
+
+def create_invoices_zip(orders, directory, part_bytes=INVOICE_ZIP_PART_BYTES):
+    """
+    پیش‌فاکتورهای جدا در یک یا چند فایل zip داخل directory، هر کدام حداکثر part_bytes؛ هر PDF مستقیم در
+    فایل نوشته می‌شود و در حافظه فقط همان یک PDF می‌ماند. مسیر فایل‌ها را به ترتیب برمی‌گرداند.
+    """
+    paths = []
+    archive = None
+    try:
+        for order, pdf_bytes in iter_invoice_pdfs(orders):
+            name = f"{order.get('invoice_number', 'invoice')}.pdf"
+            name_bytes = len(name.encode('utf-8'))
+            # سربرگ محلی (30 بایت) و سطر فهرست مرکزی (46 بایت) هر فایل، به اضافه‌ی انتهای فهرست (22 بایت)
+            if archive is None or written + 30 + name_bytes + len(pdf_bytes) + central + 46 + name_bytes + 22 > part_bytes:
+                if archive is not None:
+                    archive.close()
+                paths.append(os.path.join(directory, f"part{len(paths) + 1}.zip"))
+                # PDF ها خودشان فشرده‌اند؛ فشرده‌سازی دوباره فقط زمان می‌گیرد
+                archive = zipfile.ZipFile(paths[-1], 'w', zipfile.ZIP_STORED)
+                written = central = 0
+            archive.writestr(name, pdf_bytes)
+            written += 30 + name_bytes + len(pdf_bytes)
+            central += 46 + name_bytes
+    finally:
+        if archive is not None:
+            archive.close()
+    return paths
+
+# --- لیست قیمت از روی کاتالوگ: قیمت نهایی ماشین حساب برای چند طول کابل ---
+def create_price_list_pdf(catalog):
+    from fpdf import FPDF
+    pdf = FPDF(orientation='P', unit='mm', format='A4')
+    pdf.add_page()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.add_font('Vazir', '', FONT_PATH)
+    draw_invoice_header(pdf, INVOICE_TEXT['price_list_title'])
+    lengths = catalog.price_list_lengths
+    label_width = 70
+    length_width = (190 - label_width) / len(lengths)
+
+    pdf.set_font('Vazir', size=11)
+    pdf.cell(0, 8, txt=shape_text(INVOICE_TEXT['price_list_note']), ln=True, align='R')
+    pdf.ln(2)
+    pdf.set_font('Vazir', size=12)
+    pdf.set_fill_color(230, 240, 250)
+    # جدول راست به چپ: ستون عنوان سمت راست، طول‌ها از کوتاه (راست) به بلند (چپ)
+    for length in reversed(lengths):
+        pdf.cell(length_width, 10, shape_text(f"{length:g} متر"), border=1, align='C', fill=True)
+    pdf.cell(label_width, 10, shape_text("سنسور / غلاف"), border=1, align='C', fill=True, ln=True)
+    for sensor_id, sensor_label in catalog.calc_sensor_labels.items():
+        for sheath_id, sheath_label in catalog.calc_sheath_labels.items():
+            for length in reversed(lengths):
+                pdf.cell(length_width, 9, f"{catalog.calc_price(sensor_id, sheath_id, length):,}", border=1, align='C')
+            pdf.cell(label_width, 9, shape_text(f"{sensor_label} / {sheath_label}"), border=1, align='R', ln=True)
+    return bytes(pdf.output())
+
+# --- بایگانی پیش‌فاکتورها (اختیاری) ---
+# اگر INVOICE_ARCHIVE_DIR تنظیم شده باشد هر پیش‌فاکتور با نام sha256 محتوایش ذخیره می‌شود؛
+# فایل تکراری دوباره نوشته نمی‌شود.
+def archive_invoice(pdf_bytes):
+    digest = hashlib.sha256(pdf_bytes).hexdigest()
+    path = os.path.join(INVOICE_ARCHIVE_DIR, digest[:2], f"{digest}.pdf")
+    if os.path.exists(path):
+        return path
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(pdf_bytes)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.error(f"❌ خطای بایگانی پیش‌فاکتور: {e}")
+        return None
+    return path
+
+# --- ذخیره‌ی پایدار سشن کاربران (context.user_data) ---
+# SESSION_DB_PATH: فایل SQLite سشن‌ها (خالی = فقط در حافظه، مثل قبل)
+# SESSION_TTL: سشن‌هایی که این مدت (ثانیه) استفاده نشده‌اند از حافظه خارج می‌شوند و
+#              در اولین آپدیت بعدی دوباره از دیتابیس خوانده می‌شوند
+# SESSION_FLUSH_INTERVAL: فاصله‌ی (ثانیه) نوشتن دسته‌ای تغییرات روی دیتابیس
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.db")
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "10"))
+
+class SQLiteSessionStore:
+    """ذخیره‌ی سشن‌ها در SQLite؛ همه‌ی متدها blocking هستند و فقط از thread مخصوص سشن‌ها صدا زده می‌شوند."""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+        return self.conn
+
+    def load(self, user_id):
+        row = self.connect().execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_many(self, sessions):
+        conn = self.connect()
+        now = time.time()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?)",
+                [(user_id, json.dumps(data, ensure_ascii=False), now) for user_id, data in sessions.items()]
+            )
 
-    # --- ذخیره فایل ---
-    filename = f"پیش_فاکتور_{user_id}.pdf"
-    pdf.output(filename)
-    return filename  # ✅ این خط داخل تابع است و درست است
-    
-# --- وب سرور ساده برای نگه داشتن ربات زنده ---
-flask_app = Flask('')
+    def delete(self, user_id):
+        conn = self.connect()
+        with conn:
+            conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+class SessionPersistence(BasePersistence):
+    """
+    persistence ربات برای user_data (Session):
+    - سشن‌ها هنگام شروع بارگذاری نمی‌شوند؛ هر کاربر در اولین آپدیتش (refresh_user_data) خوانده می‌شود.
+    - تغییرات در حافظه جمع می‌شوند و در یک تراکنش، روی thread جداگانه نوشته می‌شوند.
+    - هر store با متدهای load / save_many / delete قابل جایگزینی با SQLiteSessionStore است.
+    """
+
+    def __init__(self, store, update_interval=SESSION_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.store = store
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sessions')
+        self.pending = {}
+        self.flush_task = None
+        self.loaded = set()
+        self.last_seen = {}
+
+    async def run_in_store(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def get_user_data(self):
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        self.last_seen[user_id] = time.monotonic()
+        if user_id in self.loaded:
+            return
+        self.loaded.add(user_id)
+        data = self.pending.get(user_id)
+        if data is None:
+            data = await self.run_in_store(self.store.load, user_id)
+        if data:
+            # داده‌ای که همین حالا در حافظه تنظیم شده بر داده‌ی ذخیره شده اولویت دارد
+            user_data.load(data, overwrite=False)
+
+    async def update_user_data(self, user_id, data):
+        self.pending[user_id] = data.to_dict()
+        if self.flush_task is None:
+            self.flush_task = asyncio.get_running_loop().create_task(self.flush_pending())
+
+    async def flush_pending(self):
+        try:
+            # اجازه بده بقیه‌ی update_user_data های همین دور هم به pending اضافه شوند
+            await asyncio.sleep(0)
+            while self.pending:
+                batch, self.pending = self.pending, {}
+                try:
+                    await self.run_in_store(self.store.save_many, batch)
+                except Exception as e:
+                    logging.error(f"❌ خطای ذخیره‌ی سشن‌ها: {e}")
+                    # در دور بعد دوباره تلاش می‌شود؛ داده‌ی جدیدتر جایگزین قدیمی‌تر می‌شود
+                    self.pending = {**batch, **self.pending}
+                    break
+        finally:
+            self.flush_task = None
+
+    async def drop_user_data(self, user_id):
+        self.pending.pop(user_id, None)
+        self.forget(user_id)
+        await self.run_in_store(self.store.delete, user_id)
+
+    def forget(self, user_id):
+        self.loaded.discard(user_id)
+        self.last_seen.pop(user_id, None)
+
+    def idle_users(self, ttl):
+        deadline = time.monotonic() - ttl
+        return [user_id for user_id, seen in self.last_seen.items() if seen < deadline]
+
+    async def flush(self):
+        if self.flush_task is not None:
+            await self.flush_task
+        await self.flush_pending()
+
+    # --- بقیه‌ی داده‌ها ذخیره نمی‌شوند ---
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
 
-@flask_app.route('/')
-def home():
-    return "ربات ولتا استور در حال اجراست! 🚀"
+    async def get_conversations(self, name):
+        return {}
 
-def run_flask():
-    flask_app.run(host='0.0.0.0', port=8080)
+    async def update_conversation(self, name, key, new_state):
+        pass
 
-# --- اجرای ربات ---
-if __name__ == '__main__':
-    # راه‌اندازی وب سرور در پس‌زمینه
-    t = threading.Thread(target=run_flask)
-    t.start()
+    async def update_chat_data(self, chat_id, data):
+        pass
 
-    # ساخت و اجرای ربات
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    async def update_bot_data(self, data):
+        pass
 
-    application.add_handler(CommandHandler('start', start))
-    application.add_handler(CallbackQueryHandler(button_handler))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
-    application.add_handler(MessageHandler(filters.PHOTO, photo_handler))
+    async def update_callback_data(self, data):
+        pass
 
-    print("🚀 ربات در حال اجرا است...")
-    application.run_polling()
+    async def drop_chat_data(self, chat_id):
+        pass
 
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
 
+    async def refresh_bot_data(self, bot_data):
+        pass
 
+# --- خارج کردن سشن‌های بی‌استفاده از حافظه ---
+async def evict_idle_sessions(application):
+    persistence = application.persistence
+    while True:
+        await asyncio.sleep(max(SESSION_TTL / 4, 1))
+        idle = persistence.idle_users(SESSION_TTL)
+        if not idle:
+            continue
+        try:
+            # قبل از خارج کردن از حافظه، آخرین تغییرات حتماً روی دیتابیس نوشته شوند
+            await application.update_persistence()
+            await persistence.flush()
+        except Exception as e:
+            logging.error(f"❌ خطای ذخیره‌ی سشن‌ها قبل از پاکسازی: {e}")
+            continue
+        # کاربرانی که در همین فاصله دوباره فعال شده‌اند نگه داشته می‌شوند
+        for user_id in set(idle) & set(persistence.idle_users(SESSION_TTL)):
+            # PTB راهی عمومی برای خالی کردن حافظه بدون حذف از persistence ندارد
+            application._user_data.pop(user_id, None)
+            persistence.forget(user_id)
+        logging.info(f"🧹 {len(idle)} سشن بی‌استفاده از حافظه خارج شد.")
+
+# --- state مشترک بین چند worker (اجرای چند پروسه پشت یک load balancer در حالت webhook) ---
+# هر آپدیت کاربر با قفل همان کاربر پردازش می‌شود: سشن قبل از handler از backend خوانده و بعد از آن نوشته می‌شود،
+# پس دو کلیک پشت سر هم که به دو worker مختلف می‌رسند سشن هم را بازنویسی نمی‌کنند.
+# STATE_BACKEND: خالی = یک پروسه (سشن‌ها با SessionPersistence، مثل قبل)
+#                memory = درون همین پروسه (برای توسعه)
+#                sqlite:///path/state.db = چند پروسه روی یک سرور
+#                redis://host:6379/0 = چند سرور (نیاز به پکیج redis)
+# STATE_LOCK_TTL: عمر قفل کاربر (ثانیه)؛ قفل worker ای که از کار افتاده بعد از این مدت آزاد می‌شود
+# STATE_SESSION_TTL: سشنی که این مدت (ثانیه) استفاده نشده از backend حذف می‌شود (هر استفاده عمرش را تمدید می‌کند)
+# STATE_SWEEP_INTERVAL: فاصله‌ی (ثانیه) حذف کلیدهای منقضی از backend های memory و sqlite (Redis خودش حذف می‌کند)
+# صف کانال برای هر worker جداست (WORKER_ID) و دفتر سفارش‌ها SQLite مشترک است؛
+# سقف SEND_GLOBAL_RATE برای هر پروسه است، پس با N worker آن را تقسیم بر N تنظیم کنید.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "")
+STATE_LOCK_TTL = float(os.getenv("STATE_LOCK_TTL", "30"))
+STATE_SESSION_TTL = float(os.getenv("STATE_SESSION_TTL", str(7 * 24 * 3600)))
+STATE_SWEEP_INTERVAL = float(os.getenv("STATE_SWEEP_INTERVAL", "60"))
+
+class MemoryBackend:
+    """
+    backend درون پروسه‌ای. همه‌ی backend ها همین رابط blocking را دارند (هم‌معنی دستورات Redis):
+    get / set(ttl) / add (SET NX) / delete / delete_if (حذف فقط اگر مقدار برابر باشد، برای آزاد کردن قفل)
+    و sweep (حذف همه‌ی کلیدهای منقضی؛ کلیدهایی مثل dedupe:update:<id> دوباره خوانده نمی‌شوند و فقط این‌طور پاک می‌شوند).
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def live(self, key):
+        entry = self.data.get(key)
+        if entry and entry[1] is not None and entry[1] <= time.time():
+            del self.data[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self.lock:
+            entry = self.live(key)
+            return entry[0] if entry else None
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.data[key] = (value, time.time() + ttl if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        with self.lock:
+            if self.live(key):
+                return False
+            self.data[key] = (value, time.time() + ttl if ttl else None)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def delete_if(self, key, value):
+        with self.lock:
+            entry = self.live(key)
+            if not entry or entry[0] != value:
+                return False
+            del self.data[key]
+            return True
+
+    def sweep(self):
+        now = time.time()
+        with self.lock:
+            expired = [key for key, (_, expires_at) in self.data.items() if expires_at is not None and expires_at <= now]
+            for key in expired:
+                del self.data[key]
+        return len(expired)
+
+class SQLiteBackend:
+    """backend روی یک فایل SQLite (حالت WAL) که چند پروسه‌ی روی یک سرور با هم باز می‌کنند."""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            # قفل نوشتن SQLite بین پروسه‌هاست؛ تا ۵ ثانیه برای آزاد شدنش صبر می‌شود
+            self.conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS state_expires_at ON state (expires_at)")
+        return self.conn
+
+    def get(self, key):
+        row = self.connect().execute(
+            "SELECT value FROM state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        self.connect().execute(
+            "INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, now + ttl if ttl else None)
+        )
 
+    def add(self, key, value, ttl=None):
+        conn = self.connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM state WHERE key = ? AND expires_at <= ?", (key, now))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO state (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, now + ttl if ttl else None)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        self.connect().execute("DELETE FROM state WHERE key = ?", (key,))
+
+    def delete_if(self, key, value):
+        return self.connect().execute("DELETE FROM state WHERE key = ? AND value = ?", (key, value)).rowcount == 1
+
+    def sweep(self):
+        return self.connect().execute("DELETE FROM state WHERE expires_at <= ?", (time.time(),)).rowcount
+
+class RedisBackend:
+    """
+    backend روی Redis برای چند سرور. client هر شیء سازگار با redis.Redis است
+    (get / set(nx, ex) / delete / eval)، پس در تست با یک fake ساده جایگزین می‌شود.
+    """
+
+    # حذف اتمیک قفل فقط اگر هنوز مال همین worker باشد
+    DELETE_IF_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, key):
+        value = self.client.get(key)
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, value, ex=math.ceil(ttl) if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        return bool(self.client.set(key, value, nx=True, ex=math.ceil(ttl) if ttl else None))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def delete_if(self, key, value):
+        return bool(self.client.eval(self.DELETE_IF_SCRIPT, 1, key, value))
+
+    def sweep(self):
+        # Redis کلیدهای منقضی را خودش حذف می‌کند
+        return 0
+
+def open_state_backend(url):
+    if url == 'memory':
+        return MemoryBackend()
+    if url.startswith('sqlite:///'):
+        return SQLiteBackend(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        # پکیج redis فقط برای همین حالت لازم است و جزو وابستگی‌های اصلی نیست
+        import redis
+        return RedisBackend(redis.Redis.from_url(url))
+    raise ValueError(f"❌ STATE_BACKEND نامعتبر است: {url}")
+
+class SharedState:
+    """دسترسی async به backend؛ همه‌ی فراخوانی‌ها روی یک thread جداگانه انجام می‌شوند."""
+
+    def __init__(self, backend, lock_ttl=STATE_LOCK_TTL, session_ttl=STATE_SESSION_TTL):
+        self.backend = backend
+        self.lock_ttl = lock_ttl
+        self.session_ttl = session_ttl
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='state')
+        self.worker = f"{WORKER_ID or os.getpid()}"
+        self.tokens = itertools.count()
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def try_checkout(self, user_id, token):
+        """قفل کاربر را می‌گیرد و سشنش را در همان رفت و برگشت می‌خواند؛ اگر قفل دست دیگری بود None."""
+        if not self.backend.add(f"lock:user:{user_id}", token, self.lock_ttl):
+            return None
+        data = self.backend.get(f"session:{user_id}")
+        return json.loads(data) if data else {}
+
+    def checkin(self, user_id, token, data):
+        self.backend.set(f"session:{user_id}", json.dumps(data, ensure_ascii=False), self.session_ttl)
+        if not self.backend.delete_if(f"lock:user:{user_id}", token):
+            logging.warning(f"⚠️ قفل کاربر {user_id} قبل از پایان پردازش منقضی شده بود.")
+
+    async def checkout(self, user_id):
+        token = f"{self.worker}:{next(self.tokens)}"
+        delay = 0.005
+        while True:
+            data = await self.run(self.try_checkout, user_id, token)
+            if data is not None:
+                return token, data
+            # آپدیت قبلی همین کاربر هنوز روی worker دیگری در حال پردازش است
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+
+    async def sweep_expired(self, interval=STATE_SWEEP_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                removed = await self.run(self.backend.sweep)
+            except Exception as e:
+                logging.error(f"❌ خطای پاکسازی کلیدهای منقضی state مشترک: {e}")
+                continue
+            if removed:
+                logging.info(f"🧹 {removed} کلید منقضی از state مشترک حذف شد.")
+
+shared_state = SharedState(open_state_backend(STATE_BACKEND)) if STATE_BACKEND else None
+
+def with_shared_session(handler):
+    """handler را با قفل کاربر اجرا می‌کند و context.user_data را از backend مشترک می‌خواند و در آن می‌نویسد."""
+
+    @wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is None:
+            return await handler(update, context)
+        token, data = await shared_state.checkout(user.id)
+        context.user_data.clear()
+        context.user_data.load(data)
+        try:
+            return await handler(update, context)
+        finally:
+            try:
+                await shared_state.run(shared_state.checkin, user.id, token, context.user_data.to_dict())
+            except Exception as e:
+                logging.error(f"❌ خطای ذخیره‌ی سشن مشترک کاربر {user.id}: {e}")
+            # نسخه‌ی اصلی در backend است؛ در حافظه‌ی این worker چیزی نگه داشته نمی‌شود
+            context.application._user_data.pop(user.id, None)
+
+    return wrapper
+
+# --- زمان‌بندی ارسال پیام‌ها مطابق محدودیت‌های تلگرام ---
+# همه‌ی درخواست‌های ربات از این rate limiter رد می‌شوند (getUpdates هرگز محدود نمی‌شود):
+# SEND_GLOBAL_RATE: حداکثر پیام در ثانیه برای کل ربات
+# SEND_PRIVATE_RATE: حداکثر پیام در ثانیه برای هر چت خصوصی
+# SEND_GROUP_PER_MINUTE: حداکثر پیام در دقیقه برای هر گروه یا کانال
+# SEND_BURST: تعداد پیامی که هر چت خصوصی می‌تواند پشت سر هم و بدون انتظار دریافت کند
+# SEND_MAX_RETRIES: دفعات تلاش دوباره پس از خطای RetryAfter
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_PRIVATE_RATE = float(os.getenv("SEND_PRIVATE_RATE", "1"))
+SEND_GROUP_PER_MINUTE = float(os.getenv("SEND_GROUP_PER_MINUTE", "20"))
+SEND_BURST = int(os.getenv("SEND_BURST", "3"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+
+# اولویت‌ها: عدد کمتر زودتر ارسال می‌شود
+PRIORITY_USER = 0
+PRIORITY_CHANNEL = 1
+
+# متدهایی که پیام می‌فرستند یا ویرایش می‌کنند و مشمول محدودیت تلگرام هستند
+LIMITED_ENDPOINT_PREFIXES = ('send', 'edit', 'forward', 'copy')
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """زمان (ثانیه) تا آزاد شدن یک توکن، بدون مصرف آن."""
+        self.refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def reserve(self):
+        """یک توکن رزرو می‌کند (حتی اگر هنوز آزاد نشده باشد) و زمان انتظار را برمی‌گرداند."""
+        self.refill()
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_full(self):
+        self.refill()
+        return self.tokens >= self.capacity
+
+class SendScheduler(BaseRateLimiter):
+    """
+    rate limiter ربات:
+    - هر چت سطل توکن خودش را دارد (چت خصوصی در ثانیه، گروه و کانال در دقیقه).
+    - سطل سراسری توسط یک dispatcher به ترتیب اولویت تقسیم می‌شود؛ پاسخ به کاربر قبل از پست کانال.
+    - پس از RetryAfter همه‌ی ارسال‌ها تا پایان زمان اعلام شده متوقف و درخواست دوباره فرستاده می‌شود.
+    اولویت را می‌توان با rate_limit_args=PRIORITY_... روی هر متد bot تعیین کرد.
+    """
+
+    def __init__(self, global_rate=SEND_GLOBAL_RATE, private_rate=SEND_PRIVATE_RATE,
+                 group_rate=SEND_GROUP_PER_MINUTE / 60, burst=SEND_BURST, max_retries=SEND_MAX_RETRIES):
+        # سقف‌های سراسری و گروه‌ها روی هر پنجره‌ی زمانی اعمال می‌شوند، پس بدون burst یکنواخت پخش می‌شوند
+        self.global_bucket = TokenBucket(global_rate, 1)
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.chat_buckets = {}
+        self.queue = None
+        self.dispatcher = None
+        self.sequence = itertools.count()
+        self.paused_until = 0.0
+        self.stats = {
+            'sent': 0,
+            'waiting': 0,
+            'delayed': 0,
+            'total_wait': 0.0,
+            'max_wait': 0.0,
+            'retry_after': 0,
+            'gave_up': 0,
+        }
 
+    async def initialize(self):
+        if self.dispatcher is None:
+            self.queue = asyncio.PriorityQueue()
+            self.dispatcher = asyncio.get_running_loop().create_task(self.dispatch())
+
+    async def shutdown(self):
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+            self.dispatcher = None
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                # سطل‌های پر یعنی چت‌هایی که مدتی پیامی نداشته‌اند
+                self.chat_buckets = {key: b for key, b in self.chat_buckets.items() if not b.is_full()}
+            is_private = isinstance(chat_id, int) and chat_id > 0
+            bucket = TokenBucket(self.private_rate, self.burst) if is_private else TokenBucket(self.group_rate, 1)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def dispatch(self):
+        while True:
+            # انتظار قبل از برداشتن از صف، تا درخواست پراولویتی که در این فاصله رسیده جلو بیفتد
+            pause = max(self.paused_until - time.monotonic(), self.global_bucket.delay())
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            _, _, future = await self.queue.get()
+            if future.done():
+                continue
+            self.global_bucket.reserve()
+            future.set_result(None)
+
+    async def acquire(self, chat_id, priority):
+        started = time.monotonic()
+        self.stats['waiting'] += 1
+        try:
+            if chat_id is not None:
+                delay = self.chat_bucket(chat_id).reserve()
+                if delay:
+                    await asyncio.sleep(delay)
+            future = asyncio.get_running_loop().create_future()
+            self.queue.put_nowait((priority, next(self.sequence), future))
+            await future
+        finally:
+            self.stats['waiting'] -= 1
+        waited = time.monotonic() - started
+        metrics.observe('volta_send_wait_seconds', waited)
+        if waited > 0.001:
+            self.stats['delayed'] += 1
+            self.stats['total_wait'] += waited
+            self.stats['max_wait'] = max(self.stats['max_wait'], waited)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        limited = endpoint.startswith(LIMITED_ENDPOINT_PREFIXES)
+        chat_id = data.get('chat_id')
+        if isinstance(rate_limit_args, int):
+            priority = rate_limit_args
+        else:
+            priority = PRIORITY_USER if isinstance(chat_id, int) and chat_id > 0 else PRIORITY_CHANNEL
 
+        for attempt in range(self.max_retries + 1):
+            if limited:
+                await self.acquire(chat_id, priority)
+            else:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+            started = time.perf_counter()
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    self.stats['gave_up'] += 1
+                    raise
+                self.stats['retry_after'] += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                logging.warning(f"⏳ محدودیت تلگرام روی {endpoint}؛ تلاش دوباره پس از {e.retry_after} ثانیه")
+                continue
+            finally:
+                metrics.observe('volta_telegram_request_seconds', time.perf_counter() - started, endpoint=endpoint)
+            if limited:
+                self.stats['sent'] += 1
+            return result
+
+    def snapshot(self):
+        stats = dict(self.stats)
+        stats['queued'] = self.queue.qsize() if self.queue else 0
+        stats['chats'] = len(self.chat_buckets)
+        stats['avg_wait'] = stats['total_wait'] / stats['delayed'] if stats['delayed'] else 0.0
+        stats['paused_for'] = max(self.paused_until - time.monotonic(), 0.0)
+        return stats
+
+# --- وب سرور (health check و webhook) روی همان event loop ربات ---
+# PORT: پورت وب سرور
+# WEBHOOK_URL: آدرس عمومی ربات؛ اگر تنظیم نشده باشد یا با --polling اجرا شود، ربات در حالت polling کار می‌کند
+# WEBHOOK_PATH: مسیر دریافت آپدیت‌ها روی وب سرور
+# WEBHOOK_SECRET: توکن مخفی که تلگرام در هدر X-Telegram-Bot-Api-Secret-Token می‌فرستد
+# هر کس آدرس webhook را پیدا کند می‌تواند آپدیت جعلی (مثلاً از طرف یک ادمین) بفرستد، پس مسیر و توکن مخفی اگر تنظیم
+# نشده باشند از BOT_TOKEN ساخته می‌شوند (غیرقابل حدس، و بعد از هر شروع دوباره یکسان) و هدر همیشه بررسی می‌شود.
+# UPDATE_RECORD_PATH: اگر تنظیم شود، هر آپدیت webhook (یک JSON در هر خط) در این فایل ضبط می‌شود تا با
+# python replay.py <فایل> دوباره اجرا شود. این فایل اطلاعات واقعی مشتری‌ها را دارد.
+PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+def derive_webhook_value(purpose):
+    return hmac.new((BOT_TOKEN or '').encode(), f"volta-webhook-{purpose}".encode(), hashlib.sha256).hexdigest()[:40]
+
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH") or f"telegram-{derive_webhook_value('path')}"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or derive_webhook_value('secret')
+UPDATE_RECORD_PATH = os.getenv("UPDATE_RECORD_PATH", "")
+
+# زمان رسیدن هر آپدیت از webhook تا شروع پردازشش (volta_update_queue_seconds)
+update_arrivals = {}
+
+async def track_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """اولین handler هر آپدیت (گروه -2)، قبل از حذف تکراری‌ها."""
+    metrics.inc('volta_updates_total')
+    received = update_arrivals.pop(update.update_id, None)
+    if received is not None:
+        metrics.observe('volta_update_queue_seconds', time.perf_counter() - received)
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write("ربات ولتا استور در حال اجراست! 🚀")
+
+class WebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, bot_app, recorder=None):
+        self.bot_app = bot_app
+        self.recorder = recorder
+
+    async def post(self):
+        token = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            raise tornado.web.HTTPError(403)
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot_app.bot)
+        except Exception as e:
+            logging.error(f"❌ آپدیت نامعتبر از webhook: {e}")
+            raise tornado.web.HTTPError(400)
+        if self.recorder:
+            self.recorder.write(self.request.body.replace(b'\n', b'') + b'\n')
+        update_arrivals[update.update_id] = time.perf_counter()
+        await self.bot_app.update_queue.put(update)
+
+class SendStatsHandler(tornado.web.RequestHandler):
+    def initialize(self, bot_app):
+        self.bot_app = bot_app
+
+    def get(self):
+        rate_limiter = self.bot_app.bot.rate_limiter
+        self.write(rate_limiter.snapshot() if isinstance(rate_limiter, SendScheduler) else {})
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
+
+def collect_queue_metrics(application):
+    metrics.set('volta_update_queue_depth', application.update_queue.qsize())
+    metrics.set('volta_channel_buffered', channel_notifier.buffered)
+    if isinstance(application.update_processor, PerUserUpdateProcessor):
+        metrics.set('volta_updates_running', application.update_processor.running)
+        metrics.set('volta_updates_waiting', application.update_processor.waiting)
+    rate_limiter = application.bot.rate_limiter
+    if isinstance(rate_limiter, SendScheduler):
+        stats = rate_limiter.snapshot()
+        metrics.set('volta_send_queue_depth', stats['waiting'])
+        metrics.set('volta_telegram_sent_total', stats['sent'])
+        metrics.set('volta_telegram_retry_after_total', stats['retry_after'])
+        metrics.set('volta_telegram_gave_up_total', stats['gave_up'])
+
+def build_web_app(application, use_webhook):
+    # با هر بار ساخته شدن، collector قبلی جایگزین می‌شود تا سری‌ها تکراری نشوند
+    metrics.collectors['queues'] = lambda: collect_queue_metrics(application)
+    routes = [
+        (r"/", HealthHandler),
+        (r"/metrics", MetricsHandler),
+        (r"/stats", SendStatsHandler, dict(bot_app=application)),
+    ]
+    if use_webhook:
+        # بدون بافر، تا آپدیت‌های ضبط شده با توقف ناگهانی پروسه از دست نروند
+        recorder = open(UPDATE_RECORD_PATH, 'ab', buffering=0) if UPDATE_RECORD_PATH else None
+        routes.append((rf"/{WEBHOOK_PATH}", WebhookHandler, dict(bot_app=application, recorder=recorder)))
+    return tornado.web.Application(routes)
+
+async def run_bot(application, use_webhook):
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    server = build_web_app(application, use_webhook).listen(PORT)
+    async with application:
+        await application.start()
+        eviction_task = asyncio.create_task(evict_idle_sessions(application)) if application.persistence else None
+        channel_task = asyncio.create_task(channel_notifier.run(application.bot))
+        lag_task = asyncio.create_task(watch_event_loop_lag())
+        sweep_task = asyncio.create_task(shared_state.sweep_expired()) if shared_state else None
+        application.create_task(load_recent_receipts())
+        if MEDIA_WARMUP_CHAT_ID:
+            application.create_task(media_registry.prewarm(application.bot, MEDIA_WARMUP_CHAT_ID, GALLERY_IMAGES))
+        if use_webhook:
+            await application.bot.set_webhook(
+                url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES
+            )
+        else:
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+
+        print(f"🚀 ربات در حال اجرا است... (حالت {'webhook' if use_webhook else 'polling'})")
+        if INVOICE_PREWARM:
+            application.create_task(invoice_queue.warm())
+        await stop_event.wait()
+
+        if eviction_task:
+            eviction_task.cancel()
+        channel_task.cancel()
+        lag_task.cancel()
+        if sweep_task:
+            sweep_task.cancel()
+        try:
+            # اعلان‌های باقی‌مانده در صف روی دیسک می‌مانند و بعد از شروع دوباره ارسال می‌شوند
+            await channel_notifier.drain(application.bot)
+        except Exception as e:
+            logging.error(f"❌ اعلان‌های کانال برای اجرای بعدی در صف ماندند: {e}")
+        if not use_webhook:
+            await application.updater.stop()
+        await application.stop()
+    server.stop()
+
+# --- پردازش هم‌زمان آپدیت‌ها: کاربرهای مختلف موازی، آپدیت‌های هر کاربر به ترتیب و یکی یکی ---
+# تا کاربری که منتظر پیش‌فاکتور یا پیام کانال است، منوی بقیه را معطل نکند؛ ورودی و دکمه‌های یک کاربر
+# (state سشن، سبد سفارش) هیچ‌وقت هم‌زمان اجرا نمی‌شوند.
+# UPDATE_CONCURRENCY: حداکثر آپدیت‌هایی که هم‌زمان اجرا می‌شوند (1 = پردازش ترتیبی مثل قبل)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+
+def update_owner(update):
+    """کاربری که آپدیت‌هایش باید ترتیبی اجرا شوند (یا چت، برای آپدیت‌های بدون کاربر)."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    return update.effective_chat.id if update.effective_chat else None
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    update processor برای ApplicationBuilder.concurrent_updates:
+    - هر کاربر یک asyncio.Lock دارد؛ قفل به ترتیب درخواست (FIFO) داده می‌شود و Application برای هر آپدیت
+      به ترتیب رسیدن task می‌سازد، پس آپدیت‌های یک کاربر به همان ترتیب اجرا می‌شوند.
+    - سقف limit بعد از گرفتن قفل کاربر اعمال می‌شود. سمافور خود PTB (process_update) قبل از do_process_update
+      گرفته می‌شود؛ اگر سقف آنجا بود، آپدیت‌های صف کشیده‌ی یک کاربر پرکار جای همه‌ی کاربرهای دیگر را می‌گرفتند.
+    """
+
+    def __init__(self, limit):
+        super().__init__(max_concurrent_updates=sys.maxsize)
+        self.limit = limit
+        self.slots = asyncio.Semaphore(limit)
+        self.users = {}  # owner -> [قفل، تعداد آپدیت‌های در جریان]
+        self.running = 0
+        self.waiting = 0
+
+    async def do_process_update(self, update, coroutine):
+        owner = update_owner(update)
+        if owner is None:
+            await self.run(coroutine)
+            return
+        entry = self.users.get(owner)
+        if entry is None:
+            entry = self.users[owner] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self.run(coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.users[owner]
+
+    async def run(self, coroutine):
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            await coroutine
+        finally:
+            self.running -= 1
+            self.slots.release()
 
+    async def initialize(self):
+        pass
 
+    async def shutdown(self):
+        pass
 
+def build_application(builder, session_db_path=SESSION_DB_PATH, concurrency=UPDATE_CONCURRENCY):
+    """Application با همه‌ی handler ها؛ builder توکن، آدرس Bot API و rate limiter را از قبل دارد."""
+    builder = builder.context_types(ContextTypes(user_data=Session))
+    if concurrency > 1:
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(concurrency))
+    if session_db_path and not shared_state:
+        builder = builder.persistence(SessionPersistence(SQLiteSessionStore(session_db_path)))
+    application = builder.build()
+
+    application.add_handler(TypeHandler(Update, track_update), group=-2)
+    application.add_handler(TypeHandler(Update, drop_duplicate_updates), group=-1)
+    # با state مشترک، سشن هر آپدیت از backend خوانده و در آن نوشته می‌شود
+    session = with_shared_session if shared_state else (lambda handler: handler)
+    application.add_handler(CommandHandler('start', timed(session(start))))
+    application.add_handler(CommandHandler('orders', timed(orders_command)))
+    application.add_handler(CommandHandler('quote', timed(quote_command)))
+    application.add_handler(CommandHandler('pricelist', timed(price_list_command)))
+    application.add_handler(CommandHandler('invoices', timed(invoices_command)))
+    application.add_handler(CallbackQueryHandler(timed(session(button_handler))))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed(session(message_handler))))
+    application.add_handler(MessageHandler(filters.PHOTO, timed(session(photo_handler))))
+    application.add_handler(MessageHandler(
+        filters.Document.FileExtension("csv") | filters.Document.MimeType("text/csv"), timed(quote_document_handler)
+    ))
+    return application
 
+# --- اجرای ربات ---
+if __name__ == '__main__':
+    # ساخت ربات
+    application = build_application(ApplicationBuilder().token(BOT_TOKEN).rate_limiter(SendScheduler()))
+
+    # برای توسعه‌ی محلی: python bot.py --polling
+    use_webhook = bool(WEBHOOK_URL) and '--polling' not in sys.argv
+    if shared_state and not use_webhook:
+        logging.warning("⚠️ در حالت polling فقط یک worker می‌تواند آپدیت بگیرد؛ برای چند worker از webhook استفاده کنید.")
+    asyncio.run(run_bot(application, use_webhook))
@@ -0,0 +1,1676 @@
+import asyncio
+import csv
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from collections import Counter
+from datetime import datetime
+from multiprocessing.managers import BaseManager
+from io import BytesIO, StringIO
+from operator import itemgetter
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import ApplicationBuilder, ContextTypes, MessageHandler, filters
+import tornado.httpclient
+import tornado.httpserver
+import tornado.netutil
+import tornado.web
+
+import bot
+
+# --- replay آپدیت‌ها و بنچمارک handler ها ---
+# python replay.py [updates.jsonl] [--save-baseline]؛ حالت‌های دیگر (--checks، --scaling، --webhook، --rate-limit،
+# --workers، --startup و ...) هر کدام بخش خودشان را در همین فایل دارند.
+# آپدیت‌های ضبط شده (UPDATE_RECORD_PATH) یا سناریوهای ساختگی (گشت در منوها، ماشین حساب، سفارش کامل، رسید پرداخت)
+# از Application واقعی با همه‌ی handler ها رد می‌شوند. به جای تلگرام یک Bot API محلی روی همان event loop جواب می‌دهد
+# و دفتر سفارش‌ها، صف کانال و سشن‌ها در یک پوشه‌ی موقت ساخته می‌شوند؛ داده‌ی واقعی ربات دست نمی‌خورد.
+# جریان REPLAY_ROUNDS بار برای زمان‌ها اجرا می‌شود (میانه‌ی اجراها گزارش می‌شود تا یک اجرای پرنویز نتیجه را عوض نکند)
+# و یک بار زیر tracemalloc برای حافظه‌ی allocate شده در هر آپدیت.
+# نتیجه با نتایج پایه مقایسه می‌شود و اگر چیزی کندتر یا پرمصرف‌تر شده باشد، خروجی پروسه 1 است.
+# قبل از زمان‌گیری بررسی‌های درستی (run_checks) اجرا می‌شوند و خطای هر کدام هم خروجی را 1 می‌کند.
+# REPLAY_USERS: تعداد کاربرهای ساختگی هر سناریو
+# REPLAY_ROUNDS: تعداد اجراهای زمان‌گیری
+# REPLAY_INVOICES: تعداد پیش‌فاکتورهای بنچمارک جداگانه‌ی create_invoice_pdf
+# REPLAY_BASELINE_PATH: فایل نتایج پایه. به سخت‌افزار وابسته است و در git نیست؛ روی هر ماشین یک بار با --save-baseline
+# ساخته می‌شود و اگر وجود نداشته باشد replay شکست می‌خورد (بدون نتایج پایه چیزی برای مقایسه نیست).
+# INVOICE_SIZE_BUDGET: حداکثر حجم (بایت) پیش‌فاکتور بنچمارک؛ اگر بزرگ‌تر شود replay شکست می‌خورد
+# REPLAY_TOLERANCE: بدتر شدن مجاز نسبت به نتایج پایه (0.25 = ۲۵٪)
+# REPLAY_NOISE_MS / REPLAY_NOISE_KB: اختلاف‌های کوچک‌تر از این نویز حساب می‌شوند. وقتی PDF در thread دیگری ساخته
+# می‌شود، هر handler تا یک sys.getswitchinterval() (۵ms) منتظر GIL می‌ماند، پس p99 های چند میلی‌ثانیه‌ای همین‌قدر می‌لرزند.
+# با --scaling به جای مقایسه با نتایج پایه، آپدیت در ثانیه برای تعداد کاربرهای هم‌زمان مختلف، ترتیبی و با
+# PerUserUpdateProcessor، گزارش می‌شود. آپدیت‌ها مثل webhook از صف Application می‌گذرند.
+# REPLAY_SCALING_USERS: تعداد کاربرهای هر سناریو در هر مرحله (با کاما جدا شده)
+# REPLAY_API_LATENCY: تاخیر (ثانیه) هر درخواست Bot API محلی در حالت --scaling و --webhook، به جای رفت و برگشت تا تلگرام
+# با --webhook آپدیت‌ها مثل تلگرام با HTTP به WebhookHandler (همان build_web_app ربات) فرستاده می‌شوند و آپدیت در
+# ثانیه و p50/p99 زمان جواب webhook گزارش می‌شود.
+# REPLAY_WEBHOOK_CONNECTIONS: تعداد اتصال‌های هم‌زمان به webhook (max_connections پیش‌فرض تلگرام ۴۰ است)؛
+# آپدیت‌های هر کاربر روی یک اتصال و به ترتیب فرستاده می‌شوند
+REPLAY_USERS = int(os.getenv("REPLAY_USERS", "25"))
+REPLAY_ROUNDS = int(os.getenv("REPLAY_ROUNDS", "3"))
+REPLAY_INVOICES = int(os.getenv("REPLAY_INVOICES", "20"))
+REPLAY_BASELINE_PATH = os.getenv("REPLAY_BASELINE_PATH", "replay_baseline.json")
+INVOICE_SIZE_BUDGET = int(os.getenv("INVOICE_SIZE_BUDGET", "30000"))
+REPLAY_TOLERANCE = float(os.getenv("REPLAY_TOLERANCE", "0.25"))
+REPLAY_NOISE_MS = float(os.getenv("REPLAY_NOISE_MS", "5"))
+REPLAY_NOISE_KB = float(os.getenv("REPLAY_NOISE_KB", "16"))
+REPLAY_SCALING_USERS = [int(value) for value in os.getenv("REPLAY_SCALING_USERS", "1,2,4,8,16").split(',')]
+REPLAY_API_LATENCY = float(os.getenv("REPLAY_API_LATENCY", "0.05"))
+REPLAY_WEBHOOK_CONNECTIONS = int(os.getenv("REPLAY_WEBHOOK_CONNECTIONS", "40"))
+
+def chat_key(chat_id):
+    chat_id = str(chat_id)
+    return int(chat_id) if chat_id.lstrip('-').isdigit() else chat_id
+
+def fake_api_result(method, params):
+    if method == 'getMe':
+        return {'id': 1, 'is_bot': True, 'first_name': 'Volta', 'username': 'volta_replay_bot'}
+    if method == 'getFile':
+        return {'file_id': params['file_id'], 'file_unique_id': params['file_id'], 'file_path': f"photos/{params['file_id']}.jpg"}
+    if method in ('answerCallbackQuery', 'setWebhook', 'deleteWebhook'):
+        return True
+    chat_id = chat_key(params.get('chat_id', 0))
+    message = {
+        'message_id': 1,
+        'date': int(time.time()),
+        'chat': {'id': chat_id if isinstance(chat_id, int) else 0, 'type': 'private'}
+    }
+    if method == 'sendDocument':
+        message['document'] = {'file_id': 'replay-document', 'file_unique_id': 'replay-document'}
+    elif method == 'sendPhoto':
+        message['photo'] = [{'file_id': 'replay-photo', 'file_unique_id': 'replay-photo', 'width': 1, 'height': 1}]
+    elif method == 'sendMediaGroup':
+        return [message] * len(json.loads(params.get('media', '[]')))
+    return message
+
+class FakeBotApi(tornado.web.RequestHandler):
+    """Bot API محلی برای replay: هر متد با کوتاه‌ترین جواب معتبر و فایل رسیدها از حافظه."""
+
+    def initialize(self, files, calls, latency=0, limits=None):
+        self.files = files
+        self.calls = calls
+        self.latency = latency
+        self.limits = limits
+
+    def get(self, token, file_id):
+        self.calls['download'] += 1
+        # آپدیت‌های ضبط شده رسیدهایی دارند که اینجا نیستند؛ جای آن‌ها یک رسید ساختگی فرستاده می‌شود
+        self.write(self.files.get(file_id) or self.files.setdefault(file_id, replay_receipt_image(file_id)))
+
+    async def post(self, token, method):
+        self.calls[method] += 1
+        if self.latency and method != 'getMe':
+            await asyncio.sleep(self.latency)
+        if self.request.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(self.request.body or b'{}')
+        else:
+            params = {key: value[0].decode() for key, value in self.request.body_arguments.items()}
+        if self.limits and method.startswith(bot.LIMITED_ENDPOINT_PREFIXES):
+            retry_after = self.limits.retry_after(chat_key(params.get('chat_id')))
+            if retry_after:
+                self.calls['429'] += 1
+                self.set_status(429)
+                self.write({
+                    'ok': False, 'error_code': 429, 'description': f"Too Many Requests: retry after {retry_after}",
+                    'parameters': {'retry_after': retry_after},
+                })
+                return
+        self.write({'ok': True, 'result': fake_api_result(method, params)})
+
+class TelegramLimits:
+    """
+    سقف‌های سمت تلگرام برای Bot API محلی (بین همه‌ی درخواست‌ها مشترک): ۳۰ پیام در ثانیه برای کل ربات،
+    ۱ در ثانیه برای هر چت خصوصی و ۲۰ در دقیقه برای هر گروه یا کانال، کمی جادارتر از سقف‌های SendScheduler.
+    هر flood_every امین درخواست هم بدون توجه به سقف‌ها رد می‌شود، مثل flood control پیش‌بینی‌نشده‌ی تلگرام.
+    """
+
+    def __init__(self, flood_every):
+        self.global_bucket = bot.TokenBucket(30, 30)
+        self.chat_buckets = {}
+        self.flood_every = flood_every
+        self.requests = 0
+        self.rejected = 0
+
+    def retry_after(self, chat_id):
+        """0 اگر درخواست پذیرفته شود، وگرنه ثانیه‌هایی که در retry_after جواب 429 می‌آید."""
+        self.requests += 1
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            private = isinstance(chat_id, int) and chat_id > 0
+            bucket = self.chat_buckets[chat_id] = bot.TokenBucket(1, 5) if private else bot.TokenBucket(20 / 60, 20)
+        delay = max(self.global_bucket.delay(), bucket.delay())
+        if not delay and self.flood_every and self.requests % self.flood_every == 0:
+            delay = 1
+        if delay:
+            self.rejected += 1
+            return math.ceil(delay)
+        self.global_bucket.reserve()
+        bucket.reserve()
+        return 0
+
+def replay_receipt_image(seed):
+    """یک عکس رسید ساختگی (JPEG) که برای هر seed فرق می‌کند."""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    image = Image.new('RGB', (720, 1280), 'white')
+    draw = ImageDraw.Draw(image)
+    for _ in range(60):
+        x, y = rng.randrange(40, 600), rng.randrange(40, 1200)
+        draw.rectangle((x, y, x + rng.randrange(20, 120), y + rng.randrange(8, 30)), fill=(rng.randrange(160),) * 3)
+    out = BytesIO()
+    image.save(out, 'JPEG', quality=80)
+    return out.getvalue()
+
+def replay_scenarios():
+    """مراحل هر سناریو به شکل (نوع، مقدار)؛ متن‌ها می‌توانند به شناسه‌ی کاربر وابسته باشند."""
+    catalog = bot.get_catalog()
+    sensor = next(iter(catalog.sensor_choices))
+    dimension = next(iter(catalog.dimension_choices))
+    calc_sensor = next(iter(catalog.calc_sensor_prices))
+    calc_sheath = next(iter(catalog.calc_sheath_prices))
+    wire_length = lambda user_id: str(min(catalog.min_wire_length + user_id % 100, catalog.max_wire_length))
+    return {
+        'browse': [
+            ('text', '/start'), ('callback', 'products'), ('callback', 'ntc10k'),
+            *[('callback', key) for key in bot.PRODUCT_INFO], ('callback', 'images'),
+            *[('callback', key) for key in bot.GALLERY_IMAGES], ('callback', 'back_products'),
+            ('callback', 'contact'), ('callback', 'back_main'),
+        ],
+        'calculator': [
+            ('text', '/start'), ('callback', 'calculator'), ('callback', f'calc_sensor_{calc_sensor}'),
+            ('callback', f'calc_sheath_{calc_sheath}'), ('text', 'abc'), ('text', '2.5'),
+        ],
+        'order': [
+            ('text', '/start'), ('callback', 'order'), ('callback', 'select_sensor_type'), ('callback', sensor),
+            ('callback', 'select_dimensions'), ('callback', dimension),
+            ('callback', 'select_wire_length'), ('text', wire_length),
+            ('callback', 'select_quantity'), ('text', lambda user_id: str(1 + user_id % 5)),
+            ('callback', 'enter_contact_info'), ('text', 'کاربر آزمایشی'), ('text', lambda user_id: f"0912{user_id:07d}"),
+            ('callback', 'final_order'),
+        ],
+        'receipt': [
+            ('text', '/start'), ('callback', 'payment_info'), ('callback', 'card_number'),
+            ('callback', 'send_receipt'), ('photo', lambda user_id: f"receipt-{user_id}"),
+        ],
+    }
+
+def replay_update(update_id, user_id, kind, value):
+    user = {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"}
+    message = {'message_id': update_id, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}, 'from': user}
+    if kind == 'callback':
+        callback_query = {'id': str(update_id), 'from': user, 'chat_instance': str(user_id), 'data': value}
+        callback_query['message'] = {**message, 'text': '.'}
+        return {'update_id': update_id, 'callback_query': callback_query}
+    if kind == 'photo':
+        message['photo'] = [
+            {'file_id': value, 'file_unique_id': value, 'width': width, 'height': height}
+            for width, height in ((180, 320), (720, 1280))
+        ]
+    else:
+        message['text'] = value
+        if value.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(value)}]
+    return {'update_id': update_id, 'message': message}
+
+def synthetic_updates(users_per_scenario):
+    """
+    آپدیت‌های همه‌ی سناریوها برای users_per_scenario کاربر در هر سناریو؛ قدم‌های کاربرها یک در میان
+    پشت هم می‌آیند، مثل کاربرهایی که هم‌زمان با ربات کار می‌کنند. عکس رسیدها هم برگردانده می‌شوند.
+    """
+    streams = []
+    user_id = 100000
+    for steps in replay_scenarios().values():
+        for _ in range(users_per_scenario):
+            user_id += 1
+            streams.append([(user_id, kind, value(user_id) if callable(value) else value) for kind, value in steps])
+    updates, files = [], {}
+    for step in itertools.zip_longest(*streams):
+        for user_id, kind, value in filter(None, step):
+            updates.append(replay_update(len(updates) + 1, user_id, kind, value))
+            if kind == 'photo':
+                files[value] = replay_receipt_image(value)
+    return updates, files
+
+def reset_replay_state(scratch):
+    """دفتر سفارش‌ها، صف کانال، کش رسانه، حذف تکراری‌ها و رسیدها برای هر اجرای replay از نو (در پوشه‌ی scratch)."""
+    bot.order_ledger = bot.OrderLedger(os.path.join(scratch, 'orders.db'))
+    bot.channel_notifier = bot.ChannelNotifier(bot.ChannelQueue(os.path.join(scratch, 'channel_queue.db')))
+    bot.media_registry = bot.MediaRegistry('')
+    bot.update_dedupe = bot.DedupeWindow('update', bot.UPDATE_DEDUPE_WINDOW)
+    bot.order_dedupe = bot.DedupeWindow('order', bot.ORDER_DEDUPE_WINDOW)
+    bot.receipt_index = bot.ReceiptIndex()
+    bot.shared_state = None
+    bot.INVOICE_ARCHIVE_DIR = ''
+    bot.UPDATE_RECORD_PATH = ''
+
+def replay_label(application, update):
+    """نام handler ای که این آپدیت را می‌گیرد (برای دکمه‌ها و متن‌ها، تابع مسیر یاب شده هم می‌آید)."""
+    if update.callback_query:
+        handler = bot.route_callback(update.callback_query.data)
+        return f"button_handler:{handler.__name__ if handler else '-'}"
+    message = update.message
+    if message.photo:
+        return 'photo_handler'
+    if message.text and message.text.startswith('/'):
+        return message.text.split()[0]
+    session = application.user_data.get(update.effective_user.id)
+    handler = bot.TEXT_INPUT_HANDLERS.get(session.state) if session else None
+    return f"message_handler:{handler.__name__ if handler else '-'}"
+
+def update_sender(data):
+    return next((value['from']['id'] for value in data.values() if isinstance(value, dict) and 'from' in value), 0)
+
+async def post_webhook(application, updates, connections=REPLAY_WEBHOOK_CONNECTIONS):
+    """آپدیت‌ها را با HTTP به webhook ربات می‌فرستد و برای هر کدام ('webhook', ثانیه تا جواب، 0) برمی‌گرداند."""
+    sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+    server = tornado.httpserver.HTTPServer(bot.build_web_app(application, True))
+    server.add_sockets(sockets)
+    url = f"http://127.0.0.1:{sockets[0].getsockname()[1]}/{bot.WEBHOOK_PATH}"
+    headers = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': bot.WEBHOOK_SECRET}
+    client = tornado.httpclient.AsyncHTTPClient(force_instance=True, max_clients=connections)
+    lanes = [[] for _ in range(connections)]
+    for data in updates:
+        lanes[update_sender(data) % connections].append(data)
+    samples = []
+
+    async def send(lane):
+        for data in lane:
+            started = time.perf_counter()
+            await client.fetch(url, method='POST', body=json.dumps(data), headers=headers)
+            samples.append(('webhook', time.perf_counter() - started, 0))
+
+    try:
+        await asyncio.gather(*map(send, lanes))
+    finally:
+        client.close()
+        server.stop()
+    return samples
+
+async def replay_pass(updates, files, calls, trace=False, concurrency=None, latency=0, webhook=False,
+                      limits=None, rate_limiter=None, background=None):
+    """
+    یک اجرای کامل جریان روی Application و state تازه. برای هر آپدیت (برچسب، ثانیه، بایت allocate شده)،
+    زمان کل تا تمام شدن کارهای پس‌زمینه (پیش‌فاکتورها، پیام‌های کانال، ذخیره‌ی سشن‌ها) و تعداد سفارش‌های ثبت شده
+    (user_id، طول سیم، تعداد) را برمی‌گرداند. با concurrency آپدیت‌ها مثل webhook از صف Application و update processor آن می‌گذرند
+    (زمان تک‌تک آپدیت‌ها ثبت نمی‌شود) و با webhook واقعاً با HTTP به WebhookHandler فرستاده می‌شوند
+    (نمونه‌ها زمان جواب webhook هستند). limits سقف‌های تلگرام را روی Bot API محلی می‌گذارد و rate_limiter
+    مثل ربات اصلی روی Application نصب می‌شود. background(application) اگر داده شود هم‌زمان با آپدیت‌ها
+    به عنوان task ای از Application اجرا می‌شود (و stop منتظر تمام شدنش می‌ماند).
+    """
+    scratch = tempfile.mkdtemp(prefix='volta-replay-')
+    reset_replay_state(scratch)
+    sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([
+        (r"/bot([^/]+)/(\w+)", FakeBotApi, dict(files=files, calls=calls, latency=latency, limits=limits)),
+        (r"/file/bot([^/]+)/photos/(.+)\.jpg", FakeBotApi, dict(files=files, calls=calls, latency=latency)),
+    ]))
+    server.add_sockets(sockets)
+    builder = (ApplicationBuilder().token(bot.BOT_TOKEN)
+               .base_url(f"http://127.0.0.1:{port}/bot").base_file_url(f"http://127.0.0.1:{port}/file/bot"))
+    if rate_limiter:
+        builder = builder.rate_limiter(rate_limiter)
+    application = bot.build_application(builder, os.path.join(scratch, 'sessions.db'), concurrency or 1)
+    samples = []
+    try:
+        async with application:
+            await application.start()
+            if trace:
+                tracemalloc.start()
+            started = time.perf_counter()
+            if background:
+                application.create_task(background(application))
+                # تا کارهای پس‌زمینه واقعاً شروع شوند
+                await asyncio.sleep(0)
+            try:
+                if webhook:
+                    samples = await post_webhook(application, updates)
+                    await application.update_queue.join()
+                elif concurrency:
+                    for data in updates:
+                        application.update_queue.put_nowait(Update.de_json(data, application.bot))
+                    await application.update_queue.join()
+                else:
+                    for data in updates:
+                        update = Update.de_json(data, application.bot)
+                        label = replay_label(application, update)
+                        if trace:
+                            tracemalloc.reset_peak()
+                            before = tracemalloc.get_traced_memory()[0]
+                        update_started = time.perf_counter()
+                        await application.process_update(update)
+                        elapsed = time.perf_counter() - update_started
+                        samples.append((label, elapsed, tracemalloc.get_traced_memory()[1] - before if trace else 0))
+            finally:
+                # stop منتظر کارهای create_task (پیش‌فاکتورها) می‌ماند و سشن‌ها را ذخیره می‌کند
+                await application.stop()
+                try:
+                    await bot.channel_notifier.flush(application.bot)
+                except TelegramError as e:
+                    # مثل shutdown ربات، اعلان‌ها در صف کانال می‌مانند (بدون rate limiter، 429 اینجا هم می‌رسد)
+                    calls['channel_flush_failed'] += 1
+                    logging.error(f"❌ اعلان‌های کانال در صف ماندند: {e}")
+                wall = time.perf_counter() - started
+                if trace:
+                    tracemalloc.stop()
+        orders = await bot.order_ledger.run(
+            lambda: bot.order_ledger.connect().execute("SELECT user_id, wire_length, quantity FROM orders").fetchall()
+        )
+    finally:
+        server.stop()
+        shutil.rmtree(scratch, ignore_errors=True)
+    return samples, wall, orders
+
+# --- بررسی‌های درستی: قبل از زمان‌گیری اجرا می‌شوند و هر کدام فهرست خطاها را برمی‌گرداند ---
+# REPLAY_QUOTE_ROWS: تعداد سطرهای تصادفی هر فایل در بررسی استعلام گروهی
+REPLAY_QUOTE_ROWS = int(os.getenv("REPLAY_QUOTE_ROWS", "500"))
+
+def random_alias(rng, *names):
+    name = rng.choice(names)
+    name = rng.choice((name, name.upper(), name.lower()))
+    return rng.choice(('', ' ')) + name + rng.choice(('', ' '))
+
+def quote_calc_case(rng, catalog):
+    """یک سطر ماشین حساب و قیمتی که ماشین حساب ربات برای همان ورودی نشان می‌دهد (None یعنی سطر نامعتبر)."""
+    sensor = rng.choice(list(catalog.calc_sensor_prices))
+    sheath = rng.choice(list(catalog.calc_sheath_prices))
+    # مرز پله‌های ضریب طول و کمی بعد از آن‌ها، به اضافه‌ی طول‌های تصادفی و نامعتبر
+    length = rng.choice([
+        *map(str, catalog.length_bounds), *(f"{bound + 0.01:g}" for bound in catalog.length_bounds),
+        str(round(rng.uniform(0, 200), 2)), str(rng.randrange(500)), '-1', 'abc', '',
+    ])
+    row = [
+        random_alias(rng, sensor, catalog.calc_sensor_labels[sensor]),
+        random_alias(rng, sheath, catalog.calc_sheath_labels[sheath]),
+        length,
+    ]
+    try:
+        value = float(length)
+    except ValueError:
+        return row, None
+    return row, catalog.calc_price(sensor, sheath, value) if value >= 0 else None
+
+def quote_order_case(rng, catalog):
+    """یک سطر سفارش و قیمتی که ثبت سفارش (calculate_price) برای همان انتخاب‌ها حساب می‌کند."""
+    sensor_id, sensor = rng.choice(list(catalog.sensor_choices.items()))
+    dimension_id, dimension = rng.choice(list(catalog.dimension_choices.items()))
+    wire_length = rng.randrange(catalog.min_wire_length - 5, catalog.max_wire_length + 6)
+    quantity = rng.randrange(6)
+    row = [
+        random_alias(rng, sensor_id[len('sensor_'):], sensor),
+        random_alias(rng, dimension_id[len('dim_'):], dimension),
+        str(wire_length),
+        str(quantity),
+    ]
+    if not catalog.min_wire_length <= wire_length <= catalog.max_wire_length or not quantity:
+        return row, None
+    order = {'sensor_type': sensor, 'dimensions': dimension, 'wire_length': wire_length, 'quantity': quantity}
+    return row, bot.calculate_price(order)
+
+def check_bulk_quote(rows=REPLAY_QUOTE_ROWS, seed=0):
+    """
+    قیمت هر سطر bulk_quote باید با قیمت تکی ماشین حساب یا ثبت سفارش برای همان ورودی برابر باشد
+    و فایل پاسخ با همان جداکننده‌ی فایل ورودی نوشته شود.
+    """
+    rng = random.Random(seed)
+    catalog = bot.get_catalog()
+    failures = []
+    for columns, case in ((bot.CALC_QUOTE_COLUMNS, quote_calc_case), (bot.ORDER_QUOTE_COLUMNS, quote_order_case)):
+        for delimiter in ',;\t':
+            cases = [case(rng, catalog) for _ in range(rows)]
+            source = StringIO()
+            writer = csv.writer(source, delimiter=delimiter)
+            writer.writerow(columns)
+            writer.writerows(row for row, _ in cases)
+            data, count, errors = bot.bulk_quote(catalog, source.getvalue().encode('utf-8'))
+            name = f"bulk_quote {columns[0]} {delimiter!r}"
+            result = list(csv.reader(StringIO(data.decode('utf-8-sig')), delimiter=delimiter))
+            if result[0] != list(columns) + ['price', 'error']:
+                failures.append(f"{name}: سرستون پاسخ {result[0]!r}")
+                continue
+            if count != rows or errors != sum(expected is None for _, expected in cases):
+                failures.append(f"{name}: {count} سطر و {errors} خطا")
+            for (row, expected), (*_, price, error) in zip(cases, result[1:]):
+                if price != ('' if expected is None else str(expected)) or bool(error) != (expected is None):
+                    failures.append(f"{name}: {row!r} → {price!r} {error!r} (قیمت تکی {expected!r})")
+                    break
+    return failures
+
+def duplicate_burst_updates(users):
+    """
+    سناریوی سفارش برای users کاربر با تحویل تکراری: هر آپدیت بعد از دور بعدی قدم‌ها یک بار دیگر با همان update_id
+    می‌رسد (مثل webhook ای که تلگرام دوباره می‌فرستد) و دکمه‌ی ثبت سفارش سه بار با update_id های جدا زده می‌شود.
+    (آپدیت‌ها، {کاربر: (طول سیم، تعداد)}) را برمی‌گرداند.
+    """
+    streams, expected = [], {}
+    for user_id in range(200001, 200001 + users):
+        stream = [(user_id, kind, value(user_id) if callable(value) else value) for kind, value in replay_scenarios()['order']]
+        # مقدار هر قدم بعد از دکمه‌ای که آن را خواسته است
+        answers = {value: answer for (_, _, value), (_, _, answer) in zip(stream, stream[1:])}
+        expected[user_id] = (int(answers['select_wire_length']), int(answers['select_quantity']))
+        streams.append(stream)
+    update_ids = itertools.count(1)
+    updates, previous = [], []
+    for step in itertools.zip_longest(*streams):
+        current = [
+            replay_update(next(update_ids), user_id, kind, value)
+            for user_id, kind, value in filter(None, step)
+            for _ in range(3 if value == 'final_order' else 1)
+        ]
+        updates += current + previous
+        previous = current
+    return updates + previous, expected
+
+def channel_notifications():
+    return bot.metrics.values.get(('volta_channel_notifications_total', ()), 0)
+
+async def check_duplicate_burst(users=REPLAY_USERS):
+    """آپدیت‌های تکراری و دکمه‌ی چندباره از webhook: هر کاربر دقیقاً یک سفارش، یک پیش‌فاکتور و یک پست کانال."""
+    updates, expected = duplicate_burst_updates(users)
+    calls = Counter()
+    notified = channel_notifications()
+    _, _, orders = await replay_pass(updates, {}, calls, concurrency=bot.UPDATE_CONCURRENCY, webhook=True)
+    notified = channel_notifications() - notified
+    print(f"🔁 {len(updates)} آپدیت ({len({update['update_id'] for update in updates})} یکتا) از {users} کاربر: "
+          f"{len(orders)} سفارش، {calls['sendDocument']} پیش‌فاکتور، {notified} پست کانال")
+    failures = []
+    if sorted(orders) != sorted((user_id, *values) for user_id, values in expected.items()):
+        failures.append(f"duplicate burst: سفارش‌های ثبت شده با ورودی کاربرها یکی نیست ({len(orders)} سفارش)")
+    if calls['sendDocument'] != users:
+        failures.append(f"duplicate burst: {calls['sendDocument']} پیش‌فاکتور به جای {users}")
+    if notified != users:
+        failures.append(f"duplicate burst: {notified} پست کانال به جای {users}")
+    return failures
+
+async def check_webhook_secret():
+    """آپدیت بدون هدر توکن مخفی یا با توکن اشتباه باید با 403 رد شود و به صف Application نرسد."""
+    application = ApplicationBuilder().token(bot.BOT_TOKEN).updater(None).build()
+    sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+    server = tornado.httpserver.HTTPServer(bot.build_web_app(application, True))
+    server.add_sockets(sockets)
+    url = f"http://127.0.0.1:{sockets[0].getsockname()[1]}/{bot.WEBHOOK_PATH}"
+    body = json.dumps(replay_update(1, next(iter(bot.ADMIN_IDS), 1), 'text', '/orders'))
+    client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+    failures = []
+    try:
+        for name, token, status in (('بدون توکن', None, 403), ('توکن اشتباه', 'forged', 403),
+                                    ('توکن درست', bot.WEBHOOK_SECRET, 200)):
+            headers = {'Content-Type': 'application/json'}
+            if token is not None:
+                headers['X-Telegram-Bot-Api-Secret-Token'] = token
+            response = await client.fetch(url, method='POST', body=body, headers=headers, raise_error=False)
+            if response.code != status:
+                failures.append(f"webhook {name}: {response.code} به جای {status}")
+        if application.update_queue.qsize() != 1:
+            failures.append(f"webhook: {application.update_queue.qsize()} آپدیت به صف رسید به جای 1")
+    finally:
+        client.close()
+        server.stop()
+    return failures
+
+class ReplayQuery:
+    """CallbackQuery ادمین با پاسخ‌ها و پیام‌های ثبت شده، برای صدا زدن مستقیم handler ها."""
+    def __init__(self, data, user_id):
+        self.data = data
+        self.from_user = type('User', (), {'id': user_id})()
+        self.message = self
+        self.answered = 0
+        self.replies = []
+
+    async def answer(self, *args, **kwargs):
+        self.answered += 1
+
+    async def reply_text(self, text, reply_markup=None):
+        self.replies.append((text, reply_markup))
+
+def orders_button(reply_markup):
+    return reply_markup.inline_keyboard[0][0].callback_data if reply_markup else None
+
+async def check_orders_callbacks():
+    """
+    دکمه‌ی صفحه‌ی سفارش‌ها با cursor خالی یا غیر عددی فقط پاسخ می‌گیرد و خطا نمی‌دهد. با عبارت جستجوی بلند
+    callback_data در 64 بایت می‌ماند و ورق زدن همه‌ی سفارش‌های همان عبارت را بدون تکرار می‌آورد.
+    """
+    scratch = tempfile.mkdtemp(prefix='volta-orders-')
+    ledger, admins = bot.order_ledger, set(bot.ADMIN_IDS)
+    bot.order_ledger = bot.OrderLedger(os.path.join(scratch, 'orders.db'))
+    bot.ADMIN_IDS.add(1)
+    failures = []
+    try:
+        for data in ('orders_page_', 'orders_page_x', 'orders_page_:abc', 'orders_page_-1'):
+            query = ReplayQuery(data, 1)
+            try:
+                await bot.show_orders_page(query, None)
+            except Exception as e:
+                failures.append(f"orders: {data!r} خطای {type(e).__name__} داد")
+                continue
+            if query.answered != 1 or query.replies:
+                failures.append(f"orders: {data!r} باید فقط پاسخ می‌گرفت")
+        term, count = 'سنسور دمای صنعتی' * 3, 2 * bot.ORDERS_PAGE_SIZE + 3
+        for index in range(count):
+            bot.order_ledger.append({'sensor_type': term if index % 2 else 'NTC10K'}, 1000, 1)
+            bot.order_ledger.append({'sensor_type': term}, 1000, 1)
+        context = type('Context', (), {'user_data': bot.Session()})()
+        text, reply_markup = await bot.render_orders_page(None, term, context.user_data)
+        seen, buttons = text.count('🧾'), []
+        while (data := orders_button(reply_markup)) is not None:
+            buttons.append(data)
+            query = ReplayQuery(data, 1)
+            await bot.show_orders_page(query, context)
+            if not query.replies:
+                failures.append(f"orders: دکمه‌ی {data!r} صفحه‌ای نیاورد")
+                break
+            text, reply_markup = query.replies[0]
+            seen += text.count('🧾')
+        expected = count + (count // 2)
+        if seen != expected:
+            failures.append(f"orders: ورق زدن جستجوی بلند {seen} سفارش آورد به جای {expected}")
+        # سقف خود Bot API، نه ثابت bot.py
+        if oversized := [data for data in buttons if len(data.encode('utf-8')) > 64]:
+            failures.append(f"orders: callback_data بیش از 64 بایت: {oversized[0]!r}")
+        if buttons:
+            other = 'سنسور فشار صنعتی' * 3
+            for _ in range(bot.ORDERS_PAGE_SIZE):
+                bot.order_ledger.append({'sensor_type': other}, 1000, 1)
+            await bot.render_orders_page(None, other, context.user_data)
+            query = ReplayQuery(buttons[0], 1)
+            await bot.show_orders_page(query, context)
+            if query.replies or query.answered != 1:
+                failures.append("orders: دکمه‌ی جستجوی قبلی بعد از جستجوی تازه باید منقضی شود")
+    finally:
+        bot.order_ledger = ledger
+        bot.ADMIN_IDS.intersection_update(admins)
+        shutil.rmtree(scratch, ignore_errors=True)
+    return failures
+
+async def check_channel_shutdown(count=6, timeout=1.0):
+    """
+    خاموش شدن با count اعلان فوری کانال پشت سقف ۲۰ در دقیقه‌ی SendScheduler: drain و application.stop() باید
+    حدود timeout ثانیه طول بکشند و هر اعلان یا ارسال شده باشد یا (فقط یک بار) در صف روی دیسک مانده باشد.
+    """
+    scratch = tempfile.mkdtemp(prefix='volta-shutdown-')
+    reset_replay_state(scratch)
+    calls = Counter()
+    sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([
+        (r"/bot([^/]+)/(\w+)", FakeBotApi, dict(files={}, calls=calls)),
+    ]))
+    server.add_sockets(sockets)
+    application = (ApplicationBuilder().token(bot.BOT_TOKEN).updater(None).rate_limiter(bot.SendScheduler())
+                   .base_url(f"http://127.0.0.1:{sockets[0].getsockname()[1]}/bot").build())
+    notifier = bot.channel_notifier
+    failures = []
+    try:
+        async with application:
+            await application.start()
+            for index in range(count):
+                application.create_task(notifier.notify(application.bot, f"سفارش {index}", urgent=True))
+            # تا همه به صف روی دیسک و SendScheduler برسند
+            while len(notifier.senders) < count:
+                await asyncio.sleep(0.01)
+            started = time.perf_counter()
+            try:
+                await notifier.drain(application.bot, timeout)
+            except asyncio.TimeoutError:
+                pass
+            await notifier.notify(application.bot, "سفارش بعد از drain")
+            await application.stop()
+            seconds = time.perf_counter() - started
+        left = [text for _, text, _ in await notifier.queue.run(notifier.queue.pending, count + 10)]
+        sent = calls['sendMessage']
+        print(f"🛑 خاموش شدن با {count} اعلان کانال: {seconds:.2f}s، {sent} ارسال شد، {len(left)} در صف ماند")
+        if seconds > timeout + 0.5:
+            failures.append(f"shutdown: {seconds:.2f}s طول کشید (سقف {timeout}s)")
+        if sent + len(left) != count + 1 or len(set(left)) != len(left) or "سفارش بعد از drain" not in left:
+            failures.append(f"shutdown: {sent} ارسال و {len(left)} در صف به جای {count + 1} اعلان")
+    finally:
+        server.stop()
+        shutil.rmtree(scratch, ignore_errors=True)
+    return failures
+
+def ledger_rows(count):
+    """سطرهای دفتر سفارش‌ها به شکل OrderLedger.month برای ساخت گروهی."""
+    return [
+        (f"1403070{index:05d}", '1403-07-01 10:00', f"مشتری{index}", f"0912{index:07d}", 'NTC10K', '6×50',
+         50 + index % 150, 1 + index % 5, 1_000_000 + index)
+        for index in range(count)
+    ]
+
+def check_zip_parts(count=60, part_bytes=400 * 1024):
+    """خروجی zip گروهی باید در بخش‌های حداکثر part_bytes باشد و هر پیش‌فاکتور دقیقاً یک بار در یکی از آن‌ها بیاید."""
+    scratch = tempfile.mkdtemp(prefix='volta-zip-')
+    failures = []
+    try:
+        parts = bot.create_invoices_zip(map(bot.ledger_invoice, ledger_rows(count)), scratch, part_bytes)
+        names = []
+        for path in parts:
+            if os.path.getsize(path) > part_bytes:
+                failures.append(f"zip: {os.path.basename(path)} {os.path.getsize(path):,} بایت است (سقف {part_bytes:,})")
+            with zipfile.ZipFile(path) as archive:
+                if archive.testzip() is not None:
+                    failures.append(f"zip: {os.path.basename(path)} خراب است")
+                names += archive.namelist()
+        if len(parts) < 2:
+            failures.append(f"zip: {count} پیش‌فاکتور باید در چند بخش می‌آمد ({len(parts)})")
+        if sorted(names) != sorted(f"{row[0]}.pdf" for row in ledger_rows(count)):
+            failures.append(f"zip: {len(names)} فایل به جای {count} پیش‌فاکتور")
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return failures
+
+async def run_checks():
+    failures = check_bulk_quote() + check_zip_parts() + await check_orders_callbacks() + await check_channel_shutdown()
+    failures += await check_webhook_secret() + await check_duplicate_burst()
+    for failure in failures:
+        print(f"❌ {failure}")
+    return failures
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def latency_stats(rounds, allocated):
+    """rounds: زمان‌های (ثانیه) هر اجرا؛ p50 و p99 میانه‌ی همان صدک در اجراهاست."""
+    return {
+        'count': len(allocated),
+        'p50_ms': round(statistics.median(percentile(seconds, 0.5) for seconds in rounds) * 1000, 3),
+        'p99_ms': round(statistics.median(percentile(seconds, 0.99) for seconds in rounds) * 1000, 3),
+        'alloc_kb': round(sum(allocated) / len(allocated) / 1024, 1),
+    }
+
+def bench_invoice(count):
+    """create_invoice_pdf به تنهایی، روی همین thread (قالب از قبل ساخته شده)."""
+    order = {
+        'sensor_type': 'NTC10K', 'dimensions': '6×50', 'wire_length': 120, 'quantity': 2,
+        'customer_first_name': 'کاربر', 'customer_last_name': 'آزمایشی', 'customer_phone': '09120000000',
+        'invoice_number': 'REPLAY-1',
+    }
+    final_price = bot.calculate_price(order)
+    bot.prewarm_invoice_template()
+    rounds = []
+    for _ in range(REPLAY_ROUNDS):
+        seconds = []
+        for user_id in range(count):
+            started = time.perf_counter()
+            pdf_bytes = bot.create_invoice_pdf(order, final_price, 'کاربر آزمایشی', user_id)
+            seconds.append(time.perf_counter() - started)
+        rounds.append(seconds)
+    allocated = []
+    tracemalloc.start()
+    for user_id in range(count):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        bot.create_invoice_pdf(order, final_price, 'کاربر آزمایشی', user_id)
+        allocated.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    stats = latency_stats(rounds, allocated)
+    stats['renders_per_second'] = round(count / statistics.median(sum(seconds) for seconds in rounds), 1)
+    stats['pdf_bytes'] = len(pdf_bytes)
+    return stats
+
+def replay_regressions(result, baseline):
+    regressions = []
+
+    def compare(name, new, old):
+        if new['p50_ms'] > old['p50_ms'] * (1 + REPLAY_TOLERANCE) and new['p50_ms'] - old['p50_ms'] > REPLAY_NOISE_MS:
+            regressions.append(f"{name} p50: {old['p50_ms']:.2f} → {new['p50_ms']:.2f} ms")
+        if new['p99_ms'] > old['p99_ms'] * (1 + REPLAY_TOLERANCE) and new['p99_ms'] - old['p99_ms'] > REPLAY_NOISE_MS:
+            regressions.append(f"{name} p99: {old['p99_ms']:.2f} → {new['p99_ms']:.2f} ms")
+        if new['alloc_kb'] > old['alloc_kb'] * (1 + REPLAY_TOLERANCE) and new['alloc_kb'] - old['alloc_kb'] > REPLAY_NOISE_KB:
+            regressions.append(f"{name} alloc: {old['alloc_kb']:.1f} → {new['alloc_kb']:.1f} KB")
+
+    if result['updates_per_second'] < baseline['updates_per_second'] * (1 - REPLAY_TOLERANCE):
+        regressions.append(f"throughput: {baseline['updates_per_second']:.1f} → {result['updates_per_second']:.1f} updates/s")
+    for label, stats in result['handlers'].items():
+        if label in baseline['handlers']:
+            compare(label, stats, baseline['handlers'][label])
+    compare('create_invoice_pdf', result['invoice'], baseline['invoice'])
+    if result['invoice']['renders_per_second'] < baseline['invoice']['renders_per_second'] * (1 - REPLAY_TOLERANCE):
+        regressions.append(
+            f"create_invoice_pdf: {baseline['invoice']['renders_per_second']:.1f} → "
+            f"{result['invoice']['renders_per_second']:.1f} renders/s"
+        )
+    return regressions
+
+def print_replay_report(result, calls):
+    print(f"\n📊 {result['updates']} آپدیت در {result['seconds']:.2f} ثانیه: {result['updates_per_second']:.1f} آپدیت در ثانیه")
+    print(f"{'handler':<44}{'count':>6}{'p50 ms':>10}{'p99 ms':>10}{'alloc KB':>10}")
+    for label, stats in sorted(result['handlers'].items()):
+        print(f"{label:<44}{stats['count']:>6}{stats['p50_ms']:>10.2f}{stats['p99_ms']:>10.2f}{stats['alloc_kb']:>10.1f}")
+    invoice = result['invoice']
+    print(f"{'create_invoice_pdf':<44}{invoice['count']:>6}{invoice['p50_ms']:>10.2f}{invoice['p99_ms']:>10.2f}{invoice['alloc_kb']:>10.1f}"
+          f"  ({invoice['renders_per_second']:.1f} در ثانیه، {invoice['pdf_bytes']:,} بایت)")
+    print("Bot API: " + ", ".join(f"{method}={count}" for method, count in sorted(calls.items())))
+
+async def run_scaling():
+    """آپدیت در ثانیه با تعداد کاربر هم‌زمان بیشتر: پردازش ترتیبی در برابر PerUserUpdateProcessor."""
+    print(f"\n📈 تاخیر هر درخواست Bot API: {REPLAY_API_LATENCY * 1000:.0f}ms، سقف هم‌زمانی: {bot.UPDATE_CONCURRENCY}")
+    print(f"{'users':>6}{'updates':>9}{'sequential/s':>14}{'concurrent/s':>14}{'speedup':>9}{'orders':>9}")
+    for users in REPLAY_SCALING_USERS:
+        updates, files = synthetic_updates(users)
+        rates, orders = [], []
+        for concurrency in (1, bot.UPDATE_CONCURRENCY):
+            _, seconds, rows = await replay_pass(updates, files, Counter(), concurrency=concurrency, latency=REPLAY_API_LATENCY)
+            rates.append(len(updates) / seconds)
+            orders.append(len(rows))
+        # هر کاربر سناریوی سفارش دقیقاً یک سفارش ثبت می‌کند، اگر ورودی‌هایش به ترتیب اجرا شده باشند
+        print(f"{users * len(replay_scenarios()):>6}{len(updates):>9}{rates[0]:>14.1f}{rates[1]:>14.1f}{rates[1] / rates[0]:>8.1f}x"
+              f"{'/'.join(map(str, orders)):>9}")
+        if orders != [users, users]:
+            print(f"❌ باید {users} سفارش ثبت می‌شد")
+            return 1
+    return 0
+
+# --- زمان شروع سرد: python replay.py --startup ---
+# ربات در یک پروسه‌ی تازه (مثل کانتینری که تازه بالا آمده) در حالت polling به Bot API محلی وصل می‌شود و زمان از
+# اجرای پروسه تا جواب اولین /start اندازه گرفته می‌شود. سنگین‌ترین import ها از python -X importtime -c "import bot"
+# گزارش می‌شوند تا معلوم باشد زمان کجا رفته است.
+# STARTUP_BUDGET: حداکثر زمان (ثانیه) تا جواب اولین آپدیت؛ اگر میانه‌ی اجراها بیشتر شود خروجی پروسه 1 است
+# STARTUP_RUNS: تعداد اجراها
+STARTUP_BUDGET = float(os.getenv("STARTUP_BUDGET", "1.5"))
+STARTUP_RUNS = int(os.getenv("STARTUP_RUNS", "3"))
+STARTUP_CHILD = """
+import asyncio, sys
+import bot
+from telegram.ext import ApplicationBuilder
+builder = ApplicationBuilder().token(bot.BOT_TOKEN).base_url(sys.argv[1]).rate_limiter(bot.SendScheduler())
+asyncio.run(bot.run_bot(bot.build_application(builder), False))
+"""
+
+class StartupBotApi(FakeBotApi):
+    """Bot API محلی برای --startup: اولین getUpdates یک /start برمی‌گرداند و اولین sendMessage زمان را ثبت می‌کند."""
+
+    def initialize(self, updates, first_reply):
+        super().initialize({}, Counter())
+        self.updates = updates
+        self.first_reply = first_reply
+
+    async def post(self, token, method):
+        if method == 'getUpdates':
+            if not self.updates:
+                # long polling بدون آپدیت تازه
+                await asyncio.sleep(0.5)
+            self.write({'ok': True, 'result': [self.updates.pop() for _ in range(len(self.updates))]})
+            return
+        if method == 'sendMessage' and not self.first_reply.done():
+            self.first_reply.set_result(time.perf_counter())
+        await super().post(token, method)
+
+def import_times():
+    """
+    (زمان کل import bot، سنگین‌ترین ماژول‌هایی که bot مستقیم import می‌کند، تعداد پروسه‌هایی که import bot بالا آورده)
+    از خروجی -X importtime (به میلی‌ثانیه). پروسه‌های فرزند هم -X importtime را می‌گیرند و site خودشان را چاپ می‌کنند.
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import bot'], capture_output=True, text=True)
+    spawned = process.stderr.count('| site\n') - 1
+    children, total = {}, 0
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # هر سطح دو فاصله تورفتگی دارد و هر ماژول بعد از ماژول‌هایی که import کرده چاپ می‌شود
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            children[name.strip()] = int(cumulative) / 1000
+        elif depth == 0:
+            if name.strip() == 'bot':
+                total = int(cumulative) / 1000
+                break
+            children = {}
+    return total, sorted(children.items(), key=itemgetter(1), reverse=True)[:8], spawned
+
+# ماژول‌هایی که bot فقط در اولین استفاده import می‌کند؛ import bot نباید آن‌ها را بار کند
+LAZY_MODULES = ('pytz', 'jdatetime', 'fpdf', 'fontTools', 'PIL', 'arabic_reshaper', 'bidi')
+
+def eager_modules():
+    """
+    ماژول‌های LAZY_MODULES که import bot (در پروسه‌ی تازه) بار کرده است. آن‌هایی که خود telegram و tornado
+    بار می‌کنند (telegram اگر pytz نصب باشد آن را import می‌کند) حساب نمی‌شوند.
+    """
+    code = (f"import sys, telegram.ext, tornado.web; before = set(sys.modules); import bot; "
+            f"print(' '.join(name for name in {LAZY_MODULES!r} if name in sys.modules and name not in before))")
+    return subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout.split()
+
+async def time_to_first_reply(scratch):
+    loop = asyncio.get_running_loop()
+    first_reply = loop.create_future()
+    sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([
+        (r"/bot([^/]+)/(\w+)", StartupBotApi, dict(updates=[replay_update(1, 100001, 'text', '/start')], first_reply=first_reply)),
+    ]))
+    server.add_sockets(sockets)
+    env = dict(
+        os.environ, PORT='0', WEBHOOK_URL='', UPDATE_RECORD_PATH='', STATE_BACKEND='', INVOICE_ARCHIVE_DIR='',
+        MEDIA_WARMUP_CHAT_ID='', MEDIA_CACHE_PATH=os.path.join(scratch, 'media_cache.json'),
+        SESSION_DB_PATH=os.path.join(scratch, 'sessions.db'), ORDER_DB_PATH=os.path.join(scratch, 'orders.db'),
+        CHANNEL_QUEUE_PATH=os.path.join(scratch, 'channel_queue.db'),
+    )
+    started = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, '-c', STARTUP_CHILD, f"http://127.0.0.1:{sockets[0].getsockname()[1]}/bot",
+        env=env, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+    try:
+        return await asyncio.wait_for(first_reply, max(STARTUP_BUDGET * 10, 30)) - started
+    finally:
+        process.terminate()
+        await process.wait()
+        server.stop()
+
+async def run_startup():
+    """خروجی پروسه: 0 اگر میانه‌ی زمان تا جواب اولین آپدیت در STARTUP_BUDGET باشد، وگرنه 1."""
+    total, packages, spawned = import_times()
+    print(f"\n⏱️ import bot: {total:.0f}ms")
+    for name, milliseconds in packages:
+        print(f"  {name:<30}{milliseconds:>8.0f}ms")
+    if spawned:
+        print(f"❌ import bot {spawned} پروسه بالا آورد")
+        return 1
+    if eager := eager_modules():
+        print(f"❌ import bot این ماژول‌ها را هم بار کرد: {', '.join(eager)}")
+        return 1
+    seconds = []
+    for _ in range(STARTUP_RUNS):
+        scratch = tempfile.mkdtemp(prefix='volta-startup-')
+        try:
+            seconds.append(await time_to_first_reply(scratch))
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+    median = statistics.median(seconds)
+    print("زمان تا جواب اولین آپدیت: " + " / ".join(f"{value:.2f}s" for value in seconds) + f" (میانه {median:.2f}s)")
+    if median > STARTUP_BUDGET:
+        print(f"❌ بیشتر از سقف {STARTUP_BUDGET:.2f}s")
+        return 1
+    print(f"✅ در سقف {STARTUP_BUDGET:.2f}s")
+    return 0
+
+async def run_webhook():
+    """بار webhook: آپدیت در ثانیه و زمان جواب WebhookHandler با PerUserUpdateProcessor."""
+    updates, files = synthetic_updates(REPLAY_USERS)
+    samples, seconds, orders = await replay_pass(
+        updates, files, Counter(), concurrency=bot.UPDATE_CONCURRENCY, latency=REPLAY_API_LATENCY, webhook=True
+    )
+    latencies = [elapsed for _, elapsed, _ in samples]
+    print(f"\n🌐 {len(updates)} آپدیت از {REPLAY_WEBHOOK_CONNECTIONS} اتصال در {seconds:.2f} ثانیه: "
+          f"{len(updates) / seconds:.1f} آپدیت در ثانیه")
+    print(f"زمان جواب webhook: p50 {percentile(latencies, 0.5) * 1000:.2f}ms، p99 {percentile(latencies, 0.99) * 1000:.2f}ms")
+    if len(orders) != REPLAY_USERS:
+        print(f"❌ باید {REPLAY_USERS} سفارش ثبت می‌شد ({len(orders)})")
+        return 1
+    return 0
+
+# --- پیش‌فاکتورهای هم‌زمان: python replay.py --invoice-load ---
+# تاخیر پردازش آپدیت‌ها (همان سناریوها، ترتیبی) بدون کار پس‌زمینه و با REPLAY_LOAD_INVOICES پیش‌فاکتور هم‌زمان از
+# send_invoice، یک بار روی invoice_queue و یک بار با LoopQueue که مثل قبل از صف worker ها PDF را مستقیم روی
+# event loop می‌سازد (ارسال‌ها در هر دو یکی است). invoice_queue جای همه را دارد تا واقعاً همه ساخته شوند؛ جدا از آن، همین تعداد با
+# تنظیمات فعلی (INVOICE_WORKERS و INVOICE_QUEUE_SIZE) فرستاده می‌شود و باید دقیقاً مازاد صف رد شود.
+# REPLAY_LOAD_INVOICES: تعداد پیش‌فاکتورهای هم‌زمان
+REPLAY_LOAD_INVOICES = int(os.getenv("REPLAY_LOAD_INVOICES", "50"))
+
+def load_invoice(index):
+    order = {
+        'sensor_type': 'NTC10K', 'dimensions': '6×50', 'wire_length': 120, 'quantity': 1 + index % 5,
+        'customer_first_name': 'کاربر', 'customer_last_name': 'آزمایشی', 'customer_phone': '09120000000',
+        'invoice_number': f"LOAD-{index}",
+    }
+    return order, bot.calculate_price(order)
+
+async def queued_invoices(application):
+    await asyncio.gather(*(
+        bot.send_invoice(application.bot, order, price, 'کاربر آزمایشی', 200001 + index)
+        for index, (order, price) in enumerate(map(load_invoice, range(REPLAY_LOAD_INVOICES)))
+    ))
+
+class LoopQueue(bot.WorkQueue):
+    def __init__(self):
+        super().__init__('loop', 1, 0)
+
+    async def run(self, func, *args, queued=None):
+        return func(*args)
+
+async def run_invoice_load():
+    """
+    خروجی پروسه: 1 اگر صف پیش‌فاکتورها بیشتر یا کمتر از مازاد ظرفیتش را رد کند یا بیشترین تاخیر آپدیت‌ها
+    را از ساخت مستقیم روی event loop بدتر کند.
+    """
+    updates, files = synthetic_updates(REPLAY_USERS)
+    bot.prewarm_invoice_template()
+    print(f"\n🧾 {len(updates)} آپدیت ترتیبی، {REPLAY_LOAD_INVOICES} پیش‌فاکتور هم‌زمان، {bot.INVOICE_WORKERS} worker")
+    print(f"{'':<16}{'seconds':>9}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    original = bot.invoice_queue
+    pool = bot.WorkQueue('invoice', bot.INVOICE_WORKERS, REPLAY_LOAD_INVOICES)
+    # مثل run_bot، worker ها قبل از اولین سفارش بالا می‌آیند
+    await pool.warm()
+    stats = {}
+    try:
+        for name, queue in (('idle', pool), ('invoice_queue', pool), ('event loop', LoopQueue())):
+            bot.invoice_queue = queue
+            background = queued_invoices if name != 'idle' else None
+            samples, seconds, _ = await replay_pass(updates, files, Counter(), background=background)
+            latencies = [elapsed for _, elapsed, _ in samples]
+            # بار فقط چند ثانیه‌ی اول است؛ بیشترین تاخیر همان توقف ربات پشت PDF ها است
+            stats[name] = max(latencies)
+            print(f"{name:<16}{seconds:>9.2f}{percentile(latencies, 0.5) * 1000:>9.2f}"
+                  f"{percentile(latencies, 0.99) * 1000:>9.2f}{stats[name] * 1000:>9.2f}")
+    finally:
+        bot.invoice_queue = original
+    expected = max(REPLAY_LOAD_INVOICES - bot.INVOICE_WORKERS - bot.INVOICE_QUEUE_SIZE, 0)
+    rejected = ('volta_work_rejected_total', (('queue', 'invoice'),))
+    before = bot.metrics.values.get(rejected, 0)
+    bot.invoice_queue = bot.WorkQueue('invoice', bot.INVOICE_WORKERS, bot.INVOICE_QUEUE_SIZE)
+    try:
+        await replay_pass([], {}, Counter(), background=queued_invoices)
+    finally:
+        bot.invoice_queue = original
+    rejected = bot.metrics.values.get(rejected, 0) - before
+    print(f"با INVOICE_QUEUE_SIZE={bot.INVOICE_QUEUE_SIZE}: {rejected} پیش‌فاکتور رد شد (انتظار {expected})")
+    failed = False
+    if rejected != expected:
+        print("❌ صف پیش‌فاکتورها سقفش را رعایت نکرد")
+        failed = True
+    if stats['invoice_queue'] > stats['event loop']:
+        print("❌ با صف worker ها بیشترین تاخیر آپدیت‌ها از ساخت روی event loop بدتر است")
+        failed = True
+    return 1 if failed else 0
+
+# --- ساخت گروهی پیش‌فاکتورها: python replay.py --batch ---
+# صفحه در ثانیه برای /invoices با REPLAY_BATCH_ORDERS سفارش، یک PDF یکجا و zip بخش‌بندی شده روی دیسک.
+# REPLAY_BATCH_ORDERS: تعداد سفارش‌های هر مرحله (با کاما جدا شده)
+REPLAY_BATCH_ORDERS = [int(value) for value in os.getenv("REPLAY_BATCH_ORDERS", "10,1000,10000").split(',')]
+
+def run_batch():
+    bot.prewarm_invoice_template()
+    print(f"\n📚 بخش‌های zip حداکثر {bot.INVOICE_ZIP_PART_BYTES / 1024 / 1024:.0f}MB")
+    print(f"{'orders':>8}{'pdf pages/s':>13}{'pdf MB':>8}{'zip pages/s':>13}{'zip MB':>8}{'parts':>7}")
+    for count in REPLAY_BATCH_ORDERS:
+        rows = ledger_rows(count)
+        started = time.perf_counter()
+        data = bot.create_invoices_pdf(map(bot.ledger_invoice, rows))
+        pdf_seconds = time.perf_counter() - started
+        scratch = tempfile.mkdtemp(prefix='volta-batch-')
+        try:
+            started = time.perf_counter()
+            parts = bot.create_invoices_zip(map(bot.ledger_invoice, rows), scratch)
+            zip_seconds = time.perf_counter() - started
+            zip_size = sum(map(os.path.getsize, parts))
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+        print(f"{count:>8}{count / pdf_seconds:>13.1f}{len(data) / 1024 / 1024:>8.1f}{count / zip_seconds:>13.1f}"
+              f"{zip_size / 1024 / 1024:>8.1f}{len(parts):>7}")
+    return 0
+
+# --- حافظه‌ی سشن‌ها: python replay.py --session-memory ---
+# REPLAY_MEMORY_SESSIONS سبد بعد از ثبت سفارش، یک بار به شکل dict نسخه‌ی اول (user_data با پرچم‌های awaiting_*
+# و order_sent_to_channel / receipt_sent) و یک بار به شکل Session. مقدارها (نام‌ها، شماره‌ها و ...) بین دو
+# حالت مشترک‌اند تا فقط خود ظرف‌ها اندازه گرفته شوند. زمان dispatch هر پیام هم مقایسه می‌شود: زنجیره‌ی پرچم‌های
+# نسخه‌ی اول در برابر یک جستجو در TEXT_INPUT_HANDLERS، برای کاربری که منتظر شماره تماس است و کاربری که منتظر چیزی نیست.
+# REPLAY_MEMORY_SESSIONS: تعداد سشن‌ها
+REPLAY_MEMORY_SESSIONS = int(os.getenv("REPLAY_MEMORY_SESSIONS", "100000"))
+ORIGINAL_STATE_FLAGS = ('awaiting_wire_length', 'awaiting_quantity', 'awaiting_customer_name',
+                        'awaiting_customer_phone', 'awaiting_calc_length')
+
+def original_user_data(values, waiting):
+    sensor_type, dimensions, wire_length, quantity, first_name, last_name, phone = values
+    return {
+        'sensor_type': sensor_type, 'dimensions': dimensions, 'wire_length': wire_length, 'quantity': quantity,
+        'awaiting_wire_length': False, 'awaiting_quantity': False, 'awaiting_customer_name': False,
+        'customer_first_name': first_name, 'customer_last_name': last_name,
+        'awaiting_customer_phone': waiting, 'customer_phone': phone,
+        'order_sent_to_channel': True, 'awaiting_receipt': False, 'receipt_sent': False,
+    }
+
+def compact_session(values, waiting):
+    session = bot.Session()
+    (session.sensor_type, session.dimensions, session.wire_length, session.quantity,
+     session.customer_first_name, session.customer_last_name, session.customer_phone) = values
+    if waiting:
+        session.state = bot.SessionState.CUSTOMER_PHONE
+    return session
+
+def original_dispatch(user_data):
+    # همان ترتیب if/elif های message_handler نسخه‌ی اول
+    for flag in ORIGINAL_STATE_FLAGS:
+        if flag in user_data and user_data[flag]:
+            return flag
+    return None
+
+def compact_dispatch(session):
+    return bot.TEXT_INPUT_HANDLERS.get(session.state)
+
+def container_bytes(build, values):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    containers = [build(value, index % 2 == 0) for index, value in enumerate(values)]
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    # خود لیست جزو سشن‌ها نیست
+    return size - sys.getsizeof(containers), containers
+
+def dispatch_seconds(dispatch, container, rounds=200000):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        dispatch(container)
+    return (time.perf_counter() - started) / rounds
+
+def run_session_memory():
+    """خروجی پروسه: 1 اگر Session از dict نسخه‌ی اول حافظه‌ی بیشتری بگیرد."""
+    values = [
+        ('NTC10K', '6×50', 50 + index % 150, 1 + index % 5, f"مشتری{index}", 'آزمایشی', f"0912{index:07d}")
+        for index in range(REPLAY_MEMORY_SESSIONS)
+    ]
+    original, dicts = container_bytes(original_user_data, values)
+    compact, sessions = container_bytes(compact_session, values)
+    per = 100000 / len(values) / 1024 / 1024
+    print(f"\n🧠 {len(values):,} سشن")
+    print(f"{'':<22}{'MB / 100k':>11}{'bytes':>8}{'phone ns':>10}{'idle ns':>9}")
+    for name, size, containers, dispatch in (('dict + awaiting_*', original, dicts, original_dispatch),
+                                             ('Session', compact, sessions, compact_dispatch)):
+        waiting, idle = dispatch_seconds(dispatch, containers[0]), dispatch_seconds(dispatch, containers[1])
+        print(f"{name:<22}{size * per:>11.1f}{size / len(values):>8.0f}{waiting * 1e9:>10.0f}{idle * 1e9:>9.0f}")
+    if compact >= original:
+        print("❌ Session از dict نسخه‌ی اول بزرگ‌تر است")
+        return 1
+    return 0
+
+# --- رسیدهای پرداخت: python replay.py --receipts ---
+# اول خود خط لوله روی thread رسیدها: hash هر عکس در اندازه‌ای که hash_photo_size انتخاب می‌کند و جستجو در
+# ReceiptIndex پر (RECEIPT_INDEX_SIZE رسید) برای hash های بی‌ربط و برای نسخه‌هایی از رسیدهای فهرست با
+# RECEIPT_MATCH_DISTANCE بیت تفاوت که همه باید پیدا شوند. بعد جریان کامل ارسال رسید برای REPLAY_RECEIPT_USERS
+# کاربر (ترتیبی، تا زمان photo_handler جدا اندازه گرفته شود)، دو بار با همان عکس‌ها: دور اول همه باید new و
+# دور دوم همه duplicate شمرده شوند، وگرنه خروجی 1 است.
+# REPLAY_RECEIPT_USERS: تعداد کاربرها (و عکس‌های متفاوت)
+REPLAY_RECEIPT_USERS = int(os.getenv("REPLAY_RECEIPT_USERS", "100"))
+
+def hash_size_image(seed):
+    """همان رسید ساختگی در اندازه‌ی کوچکی (180×320) که تلگرام برای hash می‌فرستد."""
+    from PIL import Image
+
+    out = BytesIO()
+    Image.open(BytesIO(replay_receipt_image(seed))).resize((180, 320)).save(out, 'JPEG', quality=80)
+    return out.getvalue()
+
+def receipt_updates(users):
+    steps = replay_scenarios()['receipt']
+    updates = []
+    for _ in range(2):
+        for user_id in users:
+            for kind, value in steps:
+                updates.append(replay_update(len(updates) + 1, user_id, kind, value(user_id) if callable(value) else value))
+    return updates
+
+async def run_receipts():
+    rng = random.Random(0)
+    images = [hash_size_image(f"receipt-{index}") for index in range(REPLAY_RECEIPT_USERS)]
+    started = time.perf_counter()
+    for data in images:
+        bot.receipt_hash(data)
+    hashing = (time.perf_counter() - started) / len(images)
+    bits = bot.RECEIPT_HASH_GRID ** 2
+    index = bot.ReceiptIndex()
+    known = [rng.getrandbits(bits) for _ in range(bot.RECEIPT_INDEX_SIZE)]
+    for user_id, value in enumerate(known):
+        index.add(value, user_id, None)
+    values = [rng.getrandbits(bits) for _ in range(len(images))]
+    started = time.perf_counter()
+    for value in values:
+        index.match(value)
+    matching = (time.perf_counter() - started) / len(values)
+    # رسید مشابه: همان hash با حداکثر RECEIPT_MATCH_DISTANCE بیت عوض شده
+    similar = []
+    for user_id in rng.sample(range(len(known)), len(images)):
+        value = known[user_id]
+        for bit in rng.sample(range(bits), bot.RECEIPT_MATCH_DISTANCE):
+            value ^= 1 << bit
+        similar.append((value, user_id))
+    missed = sum(index.match(value) != (user_id, None) for value, user_id in similar)
+
+    users = range(500001, 500001 + REPLAY_RECEIPT_USERS)
+    updates = receipt_updates(users)
+    files = {f"receipt-{user_id}": replay_receipt_image(f"receipt-{user_id}") for user_id in users}
+    keys = {result: ('volta_receipts_total', (('result', result),)) for result in ('new', 'duplicate', 'reused', 'unhashed')}
+    before = {result: bot.metrics.values.get(key, 0) for result, key in keys.items()}
+    samples, _, _ = await replay_pass(updates, files, Counter())
+    counts = {result: bot.metrics.values.get(key, 0) - before[result] for result, key in keys.items()}
+    photos = [elapsed for label, elapsed, _ in samples if label == 'photo_handler']
+
+    print(f"\n🧾 {len(images)} عکس، ReceiptIndex با {bot.RECEIPT_INDEX_SIZE:,} رسید")
+    print(f"receipt_hash: {hashing * 1000:.2f}ms ({1 / hashing:,.0f} رسید در ثانیه روی یک thread)")
+    print(f"ReceiptIndex.match: {matching * 1000:.3f}ms ({1 / matching:,.0f} در ثانیه)، "
+          f"{len(similar) - missed}/{len(similar)} رسید مشابه پیدا شد")
+    print(f"photo_handler: p50 {percentile(photos, 0.5) * 1000:.2f}ms، p99 {percentile(photos, 0.99) * 1000:.2f}ms "
+          f"({len(photos) / sum(photos):.1f} رسید در ثانیه، با دانلود عکس و ثبت در دفتر)")
+    print("نتیجه‌ها: " + ", ".join(f"{result}={count}" for result, count in counts.items()))
+    failed = False
+    if missed:
+        print(f"❌ {missed} رسید مشابه در ReceiptIndex پیدا نشد")
+        failed = True
+    if counts != {'new': len(users), 'duplicate': len(users), 'reused': 0, 'unhashed': 0}:
+        print(f"❌ باید {len(users)} رسید new و {len(users)} رسید duplicate شمرده می‌شد")
+        failed = True
+    return 1 if failed else 0
+
+# --- ساعت تهران: python replay.py --clock ---
+# هزینه‌ی هر فراخوانی tehran_now (با کش دقیقه و بدون آن) در برابر get_tehran_time نسخه‌ی اول که هر بار منطقه‌ی
+# زمانی را resolve و تاریخ شمسی را می‌ساخت و شماره‌ی فاکتور را با split از متن بیرون می‌کشید. متن تاریخ و بخش
+# شماره‌ی فاکتور هر دو باید با نسخه‌ی اول یکی باشند.
+# REPLAY_CLOCK_CALLS: تعداد فراخوانی‌های هر حالت
+REPLAY_CLOCK_CALLS = int(os.getenv("REPLAY_CLOCK_CALLS", "100000"))
+
+def original_tehran_time():
+    import pytz
+    from jdatetime import datetime as jdatetime
+    tehran_tz = pytz.timezone('Asia/Tehran')
+    now = datetime.now(tehran_tz)
+    j_now = jdatetime.fromgregorian(datetime=now)
+    return f"{j_now.strftime('%Y/%m/%d')} - {now.strftime('%H:%M')}"
+
+def original_invoice_date():
+    return original_tehran_time().split('-')[0].replace('/', '').strip()
+
+def uncached_invoice_date():
+    bot.tehran_time_cache = (None, None)
+    return bot.tehran_now().date_compact
+
+def cached_invoice_date():
+    return bot.tehran_now().date_compact
+
+def run_clock():
+    """خروجی پروسه: 1 اگر tehran_now متن یا تاریخ شماره‌ی فاکتور دیگری بدهد یا از نسخه‌ی اول کندتر باشد."""
+    for _ in range(3):
+        # اگر دو فراخوانی دو طرف مرز یک دقیقه بیفتند دوباره مقایسه می‌شود
+        expected, text = original_tehran_time(), bot.get_tehran_time()
+        if expected == text:
+            break
+    failed = expected != text or original_invoice_date() != cached_invoice_date()
+    if failed:
+        print(f"❌ tehran_now: {text!r} / {cached_invoice_date()!r} به جای {expected!r} / {original_invoice_date()!r}")
+    print(f"\n🕒 {REPLAY_CLOCK_CALLS:,} فراخوانی برای تاریخ شماره‌ی فاکتور")
+    rows = []
+    for name, func in (('get_tehran_time + split', original_invoice_date), ('tehran_now (بدون کش)', uncached_invoice_date),
+                       ('tehran_now', cached_invoice_date)):
+        started = time.perf_counter()
+        for _ in range(REPLAY_CLOCK_CALLS):
+            func()
+        rows.append((name, (time.perf_counter() - started) / REPLAY_CLOCK_CALLS))
+    for name, seconds in rows:
+        print(f"{name:<28}{seconds * 1e6:>9.2f}µs{rows[0][1] / seconds:>8.1f}x")
+    if rows[-1][1] >= rows[0][1]:
+        print("❌ tehran_now از نسخه‌ی اول کندتر است")
+        failed = True
+    return 1 if failed else 0
+
+# --- هزینه‌ی شکل‌دهی متن فارسی: python replay.py --shaping ---
+# رشته‌هایی که ساخت قالب و REPLAY_SHAPING_INVOICES پیش‌فاکتور با مشتری و سفارش متفاوت به shape_text می‌دهند ضبط
+# می‌شوند. «قبل»: هر پیش‌فاکتور همه‌ی رشته‌هایش (شامل قالب) را بدون کش شکل می‌دهد، مثل وقتی که قالب و کش نبود.
+# «بعد»: قالب یک بار ساخته شده و فقط رشته‌های بدنه از shape_text (با کش خالی در شروع) رد می‌شوند.
+# REPLAY_SHAPING_INVOICES: تعداد پیش‌فاکتورها
+REPLAY_SHAPING_INVOICES = int(os.getenv("REPLAY_SHAPING_INVOICES", "200"))
+
+def shaping_order(index):
+    order = {
+        'sensor_type': 'NTC10K', 'dimensions': '6×50', 'wire_length': 50 + index % 150, 'quantity': 1 + index % 5,
+        'customer_first_name': f"مشتری{index}", 'customer_last_name': 'آزمایشی', 'customer_phone': f"0912{index:07d}",
+        'invoice_number': f"SHAPE-{index}",
+    }
+    return order, bot.calculate_price(order)
+
+def run_shaping():
+    """خروجی پروسه: 1 اگر شکل‌دهی هر پیش‌فاکتور با کش و قالب از حالت بدون آن‌ها ارزان‌تر نشده باشد."""
+    original = bot.shape_text
+    shaped = []
+    bot.shape_text = lambda text: shaped.append(text) or original(text)
+    try:
+        bot.build_invoice_template()
+        template = shaped[:]
+        bodies = []
+        render = 0.0
+        for index in range(REPLAY_SHAPING_INVOICES):
+            del shaped[:]
+            started = time.perf_counter()
+            bot.render_invoice_pdf(*shaping_order(index))
+            render += time.perf_counter() - started
+            bodies.append(shaped[:])
+    finally:
+        bot.shape_text = original
+    uncached = original.__wrapped__
+    started = time.perf_counter()
+    for body in bodies:
+        for text in template + body:
+            uncached(text)
+    before = (time.perf_counter() - started) / len(bodies)
+    original.cache_clear()
+    started = time.perf_counter()
+    for body in bodies:
+        for text in body:
+            original(text)
+    after = (time.perf_counter() - started) / len(bodies)
+    info = original.cache_info()
+    render /= len(bodies)
+    print(f"\n🔤 {len(bodies)} پیش‌فاکتور، {len(template)} رشته‌ی قالب و {len(bodies[0])} رشته‌ی بدنه در هر کدام")
+    print(f"قبل (بدون قالب و کش): {before * 1000:.3f}ms در هر پیش‌فاکتور ({before / render:.1%} از ساخت PDF)")
+    print(f"بعد: {after * 1000:.3f}ms در هر پیش‌فاکتور ({after / render:.1%} از ساخت PDF، {before / after:.1f}x)")
+    print(f"کش shape_text: {info.hits} hit، {info.misses} miss ({info.hits / (info.hits + info.misses):.0%})، "
+          f"{info.currsize}/{info.maxsize} رشته")
+    if after >= before:
+        print("❌ کش و قالب شکل‌دهی را ارزان‌تر نکرده‌اند")
+        return 1
+    return 0
+
+# --- سشن‌های پایدار: python replay.py --sessions ---
+# REPLAY_SESSION_USERS سبد نیمه‌کاره از SessionPersistence روی SQLiteSessionStore یک‌جا ذخیره (write-behind، همان
+# update_user_data و flush ربات) و بعد با persistence تازه، مثل شروع دوباره‌ی ربات، تک‌تک در اولین آپدیت هر کاربر
+# (refresh_user_data) خوانده می‌شوند. هر سشنی که متفاوت خوانده شود یعنی خروجی 1.
+# REPLAY_SESSION_USERS: تعداد کاربرها
+REPLAY_SESSION_USERS = int(os.getenv("REPLAY_SESSION_USERS", "100000"))
+
+def replay_session(user_id):
+    session = bot.Session()
+    session.sensor_type = 'NTC10K'
+    session.dimensions = '6×50'
+    session.wire_length = 50 + user_id % 150
+    session.quantity = 1 + user_id % 5
+    session.customer_first_name = f"مشتری{user_id}"
+    session.customer_phone = f"0912{user_id % 10 ** 7:07d}"
+    session.state = bot.SessionState.CUSTOMER_PHONE if user_id % 2 else bot.SessionState.IDLE
+    return session
+
+async def run_sessions():
+    users = range(400001, 400001 + REPLAY_SESSION_USERS)
+    scratch = tempfile.mkdtemp(prefix='volta-sessions-')
+    try:
+        path = os.path.join(scratch, 'sessions.db')
+        persistence = bot.SessionPersistence(bot.SQLiteSessionStore(path))
+        sessions = {user_id: replay_session(user_id) for user_id in users}
+        started = time.perf_counter()
+        for user_id, session in sessions.items():
+            await persistence.update_user_data(user_id, session)
+        await persistence.flush()
+        flush = time.perf_counter() - started
+        persistence.executor.shutdown()
+
+        # شروع دوباره: persistence و اتصال تازه، هیچ سشنی در حافظه نیست
+        persistence = bot.SessionPersistence(bot.SQLiteSessionStore(path))
+        loaded = {}
+        started = time.perf_counter()
+        for user_id in users:
+            loaded[user_id] = bot.Session()
+            await persistence.refresh_user_data(user_id, loaded[user_id])
+        cold = time.perf_counter() - started
+        persistence.executor.shutdown()
+        size = sum(os.path.getsize(name) for name in (path, f"{path}-wal") if os.path.exists(name))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    lost = sum(loaded[user_id].to_dict() != session.to_dict() for user_id, session in sessions.items())
+    print(f"\n💾 {len(users):,} سشن، {size / 1024 / 1024:.1f}MB روی دیسک")
+    print(f"flush: {flush:.2f}s ({len(users) / flush:,.0f} سشن در ثانیه)")
+    print(f"cold load: {cold:.2f}s ({len(users) / cold:,.0f} سشن در ثانیه، {cold / len(users) * 1e6:.0f}µs برای اولین آپدیت هر کاربر)")
+    if lost:
+        print(f"❌ {lost:,} سشن متفاوت خوانده شد")
+        return 1
+    return 0
+
+# --- هزینه‌ی متریک‌ها: python replay.py --metrics ---
+# همان سناریوها (صف Application، بدون تاخیر Bot API تا سهم متریک‌ها بزرگ‌ترین حالتش باشد) یک در میان با Metrics
+# واقعی و با NullMetrics که هیچ کاری نمی‌کند اجرا می‌شوند و میانه‌ی زمان‌ها مقایسه می‌شود. چون اختلاف دو میانه
+# زیر نویز ماشین است، زمان صرف شده در خود inc/set/observe هم با TimedMetrics جمع زده می‌شود، به اضافه‌ی هزینه‌ی
+# scrape های /metrics در همان مدت؛ اگر سهم این‌ها از زمان کل بیشتر از METRICS_OVERHEAD_BUDGET باشد خروجی 1 است.
+# METRICS_OVERHEAD_BUDGET: حداکثر سهم متریک‌ها از زمان پردازش
+# METRICS_SCRAPE_INTERVAL: فاصله‌ی (ثانیه) scrape های Prometheus
+METRICS_OVERHEAD_BUDGET = float(os.getenv("METRICS_OVERHEAD_BUDGET", "0.01"))
+METRICS_SCRAPE_INTERVAL = float(os.getenv("METRICS_SCRAPE_INTERVAL", "15"))
+
+class NullMetrics(bot.Metrics):
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def set(self, name, value, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+class TimedMetrics(bot.Metrics):
+    """Metrics واقعی که مدت هر فراخوانی را در spent جمع می‌کند."""
+
+    def __init__(self):
+        super().__init__()
+        self.spent = 0.0
+        self.calls = 0
+
+    def timed(self, method, *args, **labels):
+        started = time.perf_counter()
+        method(self, *args, **labels)
+        self.spent += time.perf_counter() - started
+        self.calls += 1
+
+    def inc(self, name, value=1, **labels):
+        self.timed(bot.Metrics.inc, name, value, **labels)
+
+    def set(self, name, value, **labels):
+        self.timed(bot.Metrics.set, name, value, **labels)
+
+    def observe(self, name, value, **labels):
+        self.timed(bot.Metrics.observe, name, value, **labels)
+
+async def run_metrics():
+    updates, files = synthetic_updates(REPLAY_USERS)
+    original = bot.metrics
+    walls = {'on': [], 'off': []}
+    try:
+        for _ in range(REPLAY_ROUNDS):
+            for name, instance in (('off', NullMetrics()), ('on', bot.Metrics())):
+                bot.metrics = instance
+                _, seconds, _ = await replay_pass(updates, files, Counter(), concurrency=bot.UPDATE_CONCURRENCY)
+                walls[name].append(seconds)
+        timed = bot.metrics = TimedMetrics()
+        _, seconds, _ = await replay_pass(updates, files, Counter(), concurrency=bot.UPDATE_CONCURRENCY)
+        started = time.perf_counter()
+        body = timed.render()
+        render = time.perf_counter() - started
+    finally:
+        bot.metrics = original
+    off, on = statistics.median(walls['off']), statistics.median(walls['on'])
+    share = timed.spent / seconds
+    print(f"\n📏 {len(updates)} آپدیت، {REPLAY_ROUNDS} اجرا برای هر حالت")
+    print(f"متریک خاموش: {off:.3f}s ({len(updates) / off:.1f} آپدیت در ثانیه، بازه {min(walls['off']):.3f}–{max(walls['off']):.3f}s)")
+    print(f"متریک روشن:  {on:.3f}s ({len(updates) / on:.1f} آپدیت در ثانیه، بازه {min(walls['on']):.3f}–{max(walls['on']):.3f}s، "
+          f"{(on - off) / off:+.1%} نسبت به خاموش)")
+    print(f"داخل inc/set/observe: {timed.calls} فراخوانی، {timed.spent * 1000:.2f}ms از {seconds:.3f}s ({share:.2%})")
+    print(f"هر scrape: {render * 1000:.2f}ms برای {len(body):,} بایت ({render / METRICS_SCRAPE_INTERVAL:.3%} با فاصله‌ی {METRICS_SCRAPE_INTERVAL:g}s)")
+    if share + render / METRICS_SCRAPE_INTERVAL > METRICS_OVERHEAD_BUDGET:
+        print(f"❌ بیشتر از سقف {METRICS_OVERHEAD_BUDGET:.2%}")
+        return 1
+    print(f"✅ در سقف {METRICS_OVERHEAD_BUDGET:.2%}")
+    return 0
+
+# --- چند worker با state مشترک: python replay.py --workers ---
+# چند پروسه، مثل worker های پشت load balancer webhook، آپدیت‌های همان کاربرها را به نوبت (round robin، پس آپدیت‌های
+# یک کاربر هم‌زمان روی worker های مختلف) با with_shared_session پردازش می‌کنند. هر آپدیت در سشن کاربر یک واحد به
+# quantity اضافه می‌کند (خواندن، کار، نوشتن)؛ اگر قفل‌ها درست کار کنند در پایان quantity هر کاربر برابر تعداد
+# آپدیت‌هایش است و هر کمبودی یعنی نوشتنی گم شده. یک بار با SQLiteBackend (فایل مشترک) و یک بار با RedisBackend روی
+# FakeRedis که در پروسه‌ی manager اجرا می‌شود و همه‌ی worker ها از راه IPC به آن وصل می‌شوند.
+# REPLAY_WORKERS: تعداد پروسه‌های هر مرحله (با کاما جدا شده)
+# REPLAY_WORKER_USERS / REPLAY_WORKER_UPDATES: تعداد کاربرها و آپدیت‌های هر کاربر
+# REPLAY_WORKER_CONCURRENCY: آپدیت‌های هم‌زمان هر پروسه (ظرفیت یک worker)
+# REPLAY_WORKER_WORK: مدت (ثانیه) کار هر آپدیت بین خواندن و نوشتن سشن، به جای درخواست‌های Bot API
+REPLAY_WORKERS = [int(value) for value in os.getenv("REPLAY_WORKERS", "1,2,4").split(',')]
+REPLAY_WORKER_USERS = int(os.getenv("REPLAY_WORKER_USERS", "50"))
+REPLAY_WORKER_UPDATES = int(os.getenv("REPLAY_WORKER_UPDATES", "10"))
+REPLAY_WORKER_CONCURRENCY = int(os.getenv("REPLAY_WORKER_CONCURRENCY", "8"))
+REPLAY_WORKER_WORK = float(os.getenv("REPLAY_WORKER_WORK", "0.01"))
+
+class FakeRedis:
+    """همان بخش redis.Redis که RedisBackend استفاده می‌کند: get، set(nx, ex)، delete و eval برای DELETE_IF_SCRIPT."""
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def live(self, key):
+        value, expires_at = self.data.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.time():
+            del self.data[key]
+            return None
+        return value
+
+    def get(self, key):
+        with self.lock:
+            value = self.live(key)
+        return value.encode('utf-8') if value is not None else None
+
+    def set(self, key, value, nx=False, ex=None):
+        with self.lock:
+            if nx and self.live(key) is not None:
+                return None
+            self.data[key] = (str(value), time.time() + ex if ex else None)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            return int(self.data.pop(key, None) is not None)
+
+    def eval(self, script, numkeys, key, value):
+        if script != bot.RedisBackend.DELETE_IF_SCRIPT:
+            raise NotImplementedError(script)
+        with self.lock:
+            if self.live(key) != value:
+                return 0
+            del self.data[key]
+            return 1
+
+class FakeRedisManager(BaseManager):
+    pass
+
+FakeRedisManager.register('FakeRedis', FakeRedis)
+
+async def count_session_update(update, context):
+    session = context.user_data
+    quantity = session.quantity or 0
+    await asyncio.sleep(REPLAY_WORKER_WORK)
+    session.quantity = quantity + 1
+
+async def worker_pass(updates, started):
+    sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([
+        (r"/bot([^/]+)/(\w+)", FakeBotApi, dict(files={}, calls=Counter())),
+    ]))
+    server.add_sockets(sockets)
+    application = (ApplicationBuilder().token(bot.BOT_TOKEN).updater(None).base_url(f"http://127.0.0.1:{port}/bot")
+                   .context_types(ContextTypes(user_data=bot.Session)).build())
+    application.add_handler(MessageHandler(filters.TEXT, bot.with_shared_session(count_session_update)))
+    slots = asyncio.Semaphore(REPLAY_WORKER_CONCURRENCY)
+
+    async def process(data):
+        async with slots:
+            await application.process_update(Update.de_json(data, application.bot))
+
+    await application.initialize()
+    started.wait()
+    try:
+        await asyncio.gather(*map(process, updates))
+    finally:
+        await application.shutdown()
+        server.stop()
+
+def shared_state_worker(backend, updates, ready, started):
+    """پروسه‌ی worker: backend یا مسیر فایل SQLite است یا proxy ای به FakeRedis."""
+    logging.disable(logging.WARNING)
+    bot.shared_state = bot.SharedState(bot.SQLiteBackend(backend) if isinstance(backend, str) else bot.RedisBackend(backend))
+    ready.release()
+    asyncio.run(worker_pass(updates, started))
+
+def run_workers_once(backend, processes, updates):
+    """(ثانیه از شروع هم‌زمان worker ها تا پایان همه، تعداد کاربرهایی که نوشتنی از سشنشان گم شده)"""
+    spawn = multiprocessing.get_context('spawn')
+    ready, started = spawn.Semaphore(0), spawn.Event()
+    workers = [
+        spawn.Process(target=shared_state_worker, args=(backend, updates[index::processes], ready, started))
+        for index in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    for _ in workers:
+        ready.acquire()
+    # ساخت Application بعد از اعلام آمادگی
+    time.sleep(0.5)
+    began = time.perf_counter()
+    started.set()
+    for worker in workers:
+        worker.join()
+    seconds = time.perf_counter() - began
+    if any(worker.exitcode for worker in workers):
+        raise RuntimeError(f"worker با خطا تمام شد: {[worker.exitcode for worker in workers]}")
+    reader = bot.SQLiteBackend(backend) if isinstance(backend, str) else bot.RedisBackend(backend)
+    lost = 0
+    for user_id in range(300001, 300001 + REPLAY_WORKER_USERS):
+        data = json.loads(reader.get(f"session:{user_id}") or '{}')
+        lost += data.get('quantity', 0) != REPLAY_WORKER_UPDATES
+    return seconds, lost
+
+def run_workers():
+    """خروجی پروسه: 0 اگر با هیچ backend و تعداد پروسه‌ای نوشتن سشنی گم نشده باشد، وگرنه 1."""
+    updates = [
+        replay_update(update_id, 300001 + update_id % REPLAY_WORKER_USERS, 'text', '+1')
+        for update_id in range(1, REPLAY_WORKER_USERS * REPLAY_WORKER_UPDATES + 1)
+    ]
+    print(f"\n👥 {len(updates)} آپدیت برای {REPLAY_WORKER_USERS} کاربر، {REPLAY_WORKER_WORK * 1000:.0f}ms کار در هر آپدیت، "
+          f"{REPLAY_WORKER_CONCURRENCY} آپدیت هم‌زمان در هر پروسه")
+    print(f"{'backend':<10}{'processes':>10}{'seconds':>9}{'updates/s':>11}{'speedup':>9}{'lost':>6}")
+    failed = False
+    with FakeRedisManager() as manager:
+        for name in ('sqlite', 'redis'):
+            first = None
+            for processes in REPLAY_WORKERS:
+                scratch = tempfile.mkdtemp(prefix='volta-workers-')
+                try:
+                    backend = os.path.join(scratch, 'state.db') if name == 'sqlite' else manager.FakeRedis()
+                    seconds, lost = run_workers_once(backend, processes, updates)
+                finally:
+                    shutil.rmtree(scratch, ignore_errors=True)
+                rate = len(updates) / seconds
+                first = first or rate
+                print(f"{name:<10}{processes:>10}{seconds:>9.2f}{rate:>11.1f}{rate / first:>8.1f}x{lost:>6}")
+                failed = failed or lost > 0
+    if failed:
+        print("❌ نوشتن سشن بعضی کاربرها گم شد")
+    return 1 if failed else 0
+
+# --- محدودیت‌های تلگرام: python replay.py --rate-limit ---
+# Bot API محلی سقف‌های تلگرام (TelegramLimits) را اعمال می‌کند و درخواست‌های بیشتر را با 429 و retry_after رد می‌کند.
+# همان سناریوها یک بار بدون rate limiter و یک بار با SendScheduler از صف Application اجرا می‌شوند. با SendScheduler
+# هیچ درخواستی نباید کنار گذاشته شود (gave_up) و هر سفارش باید ثبت شود، وگرنه خروجی پروسه 1 است.
+# REPLAY_RATE_USERS: تعداد کاربرهای هر سناریو
+# REPLAY_FLOOD_EVERY: هر چندمین درخواست محدود، بدون توجه به سقف‌ها 429 می‌گیرد (0 = هیچ‌کدام)
+REPLAY_RATE_USERS = int(os.getenv("REPLAY_RATE_USERS", "10"))
+REPLAY_FLOOD_EVERY = int(os.getenv("REPLAY_FLOOD_EVERY", "50"))
+
+async def run_rate_limit():
+    updates, files = synthetic_updates(REPLAY_RATE_USERS)
+    print(f"\n🚦 {len(updates)} آپدیت، {REPLAY_RATE_USERS * len(replay_scenarios())} کاربر")
+    print(f"{'':<20}{'seconds':>9}{'requests':>10}{'429':>6}{'retried':>9}{'lost':>6}{'orders':>8}")
+    for name, rate_limiter in (('no rate limiter', None), ('SendScheduler', bot.SendScheduler())):
+        limits = TelegramLimits(REPLAY_FLOOD_EVERY)
+        # بدون rate limiter، 429 ها به handler ها می‌رسند و خطایشان مورد انتظار است
+        logging.disable(logging.ERROR if rate_limiter is None else logging.NOTSET)
+        try:
+            _, seconds, orders = await replay_pass(
+                updates, files, Counter(), concurrency=bot.UPDATE_CONCURRENCY, limits=limits, rate_limiter=rate_limiter
+            )
+        except Exception as e:
+            # سطر هر اجرا حتماً چاپ می‌شود؛ اجرای ناتمام یعنی همه‌ی سفارش‌ها از دست رفته‌اند
+            print(f"{name:<20}❌ اجرا ناتمام ماند: {e!r}")
+            seconds, orders = float('nan'), []
+        finally:
+            logging.disable(logging.NOTSET)
+        stats = rate_limiter.snapshot() if rate_limiter else {'retry_after': 0, 'gave_up': limits.rejected}
+        print(f"{name:<20}{seconds:>9.2f}{limits.requests:>10}{limits.rejected:>6}{stats['retry_after']:>9}"
+              f"{stats['gave_up']:>6}{len(orders):>8}")
+    if stats['gave_up'] or len(orders) != REPLAY_RATE_USERS:
+        print(f"❌ با SendScheduler همه‌ی درخواست‌ها باید برسند و {REPLAY_RATE_USERS} سفارش ثبت شود")
+        return 1
+    return 0
+
+async def run_replay(path=None, save_baseline=False):
+    """خروجی پروسه: 0 اگر بررسی‌ها درست باشند و نتیجه از نتایج پایه بدتر نشده باشد، وگرنه 1."""
+    if await run_checks():
+        return 1
+    if path:
+        with open(path, encoding='utf-8') as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+        files, source = {}, f"recorded:{os.path.basename(path)}:{len(updates)}"
+    else:
+        updates, files = synthetic_updates(REPLAY_USERS)
+        source = f"synthetic:{REPLAY_USERS}"
+    calls = Counter()
+    rounds = [await replay_pass(updates, files, calls if not i else Counter()) for i in range(REPLAY_ROUNDS)]
+    traced_samples, _, _ = await replay_pass(updates, files, Counter(), trace=True)
+
+    allocated = {}
+    for label, _, size in traced_samples:
+        allocated.setdefault(label, []).append(size)
+    handlers = {
+        label: latency_stats([[elapsed for name, elapsed, _ in samples if name == label] for samples, _, _ in rounds], sizes)
+        for label, sizes in allocated.items()
+    }
+    seconds = statistics.median(wall for _, wall, _ in rounds)
+    result = {
+        'source': source,
+        'updates': len(updates),
+        'seconds': round(seconds, 3),
+        'updates_per_second': round(len(updates) / seconds, 1),
+        'handlers': handlers,
+        'invoice': bench_invoice(REPLAY_INVOICES),
+    }
+    print_replay_report(result, calls)
+
+    if result['invoice']['pdf_bytes'] > INVOICE_SIZE_BUDGET:
+        print(f"❌ حجم پیش‌فاکتور {result['invoice']['pdf_bytes']:,} بایت است (سقف {INVOICE_SIZE_BUDGET:,}).")
+        return 1
+    if save_baseline:
+        with open(REPLAY_BASELINE_PATH, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"📌 نتایج پایه در {REPLAY_BASELINE_PATH} ذخیره شد.")
+        return 0
+    if not os.path.exists(REPLAY_BASELINE_PATH):
+        print(f"❌ فایل نتایج پایه ({REPLAY_BASELINE_PATH}) وجود ندارد؛ اول روی همین ماشین با --save-baseline بسازید.")
+        return 1
+    with open(REPLAY_BASELINE_PATH, encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline.get('source') != source:
+        print(f"❌ نتایج پایه برای جریان دیگری است ({baseline.get('source')})؛ با --save-baseline دوباره بسازید.")
+        return 1
+    regressions = replay_regressions(result, baseline)
+    for regression in regressions:
+        print(f"❌ {regression}")
+    if not regressions:
+        print("✅ نسبت به نتایج پایه کندتر یا پرمصرف‌تر نشده است.")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    # لاگ هر درخواست به Bot API محلی هم زمان می‌برد و هم گزارش را گم می‌کند (429 های --rate-limit هم عمدی‌اند)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    logging.getLogger('tornado.access').setLevel(logging.ERROR)
+    if '--checks' in sys.argv:
+        sys.exit(1 if asyncio.run(run_checks()) else 0)
+    if '--scaling' in sys.argv:
+        sys.exit(asyncio.run(run_scaling()))
+    if '--webhook' in sys.argv:
+        sys.exit(asyncio.run(run_webhook()))
+    if '--invoice-load' in sys.argv:
+        sys.exit(asyncio.run(run_invoice_load()))
+    if '--session-memory' in sys.argv:
+        sys.exit(run_session_memory())
+    if '--receipts' in sys.argv:
+        sys.exit(asyncio.run(run_receipts()))
+    if '--clock' in sys.argv:
+        sys.exit(run_clock())
+    if '--batch' in sys.argv:
+        sys.exit(run_batch())
+    if '--shaping' in sys.argv:
+        sys.exit(run_shaping())
+    if '--sessions' in sys.argv:
+        sys.exit(asyncio.run(run_sessions()))
+    if '--metrics' in sys.argv:
+        sys.exit(asyncio.run(run_metrics()))
+    if '--workers' in sys.argv:
+        sys.exit(run_workers())
+    if '--rate-limit' in sys.argv:
+        sys.exit(asyncio.run(run_rate_limit()))
+    if '--startup' in sys.argv:
+        sys.exit(asyncio.run(run_startup()))
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    sys.exit(asyncio.run(run_replay(args[0] if args else None, '--save-baseline' in sys.argv)))